@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import deque
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from ratelimit import TokenBucket
+from telegram_request import TimedRequest
+
+logger = logging.getLogger(__name__)
+
+
+class AdminNotifier:
+    """
+    Background, coalescing sender for admin group notifications.
+
+    notify() only queues the entry. A task collects everything queued within
+    `window` seconds and sends it as one message (or, when there is more than
+    fits, as few messages as possible), paced to `messages_per_minute` so a
+    signup burst cannot trip the group flood limit. Digests use the compact
+    form of each entry; a lone entry is sent in full.
+    """
+
+    def __init__(self, token, chat_id, window=10.0, messages_per_minute=20, max_pending=20000,
+                 parse_mode='Markdown', base_url='https://api.telegram.org/bot'):
+        self.bot = Bot(token, base_url=base_url, request=TimedRequest())
+        self.chat_id = chat_id
+        self.window = window
+        self.parse_mode = parse_mode
+        self.max_pending = max_pending
+        self.limit = TokenBucket(messages_per_minute / 60, capacity=3)
+        self.dropped = 0
+        self.sent_messages = 0
+        self._pending = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        await self.bot.initialize()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Deliver whatever is still queued before shutting down
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+        await self.bot.shutdown()
+
+    def notify(self, text, compact=None):
+        if len(self._pending) >= self.max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append((text, compact or text))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Let the window fill up before sending
+            await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            await self._flush()
+
+    def _digest(self, entries, dropped):
+        if len(entries) == 1 and not dropped:
+            return [entries[0][0]]
+        header = f"Digest(сводка): {len(entries)}"
+        if dropped:
+            header += f" (+{dropped} dropped/пропущено)"
+        chunks = []
+        current = header
+        for _, compact in entries:
+            if len(current) + 1 + len(compact) > MessageLimit.MAX_TEXT_LENGTH:
+                chunks.append(current)
+                current = compact
+            else:
+                current += '\n' + compact
+        chunks.append(current)
+        return chunks
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        entries = list(self._pending)
+        self._pending.clear()
+        dropped, self.dropped = self.dropped, 0
+        for chunk in self._digest(entries, dropped):
+            await self._send(chunk)
+
+    async def _send(self, text, attempts=5):
+        parse_mode = self.parse_mode
+        for attempt in range(attempts):
+            delay = self.limit.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                await self.bot.send_message(chat_id=self.chat_id, text=text, parse_mode=parse_mode)
+                self.sent_messages += 1
+                return
+            except BadRequest as e:
+                # Sending the same text again cannot succeed; a name with markup characters
+                # must not cost the whole chunk, so send it once more as plain text
+                if parse_mode is None:
+                    logger.error(f"Admin notification rejected: {e}")
+                    return
+                logger.warning(f"Admin notification rejected ({e}), resending without formatting")
+                parse_mode = None
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                await asyncio.sleep(retry_after)
+            except TelegramError as e:
+                logger.error(f"Failed to send admin notification: {e}")
+                await asyncio.sleep(2 ** attempt)
+        logger.error(f"Giving up on admin notification after {attempts} attempts")
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from telegram import Update
+
+from metrics import UPDATES_SHED
+from ratelimit import KeyedRateLimiter
+from update_processor import PerUserUpdateProcessor
+
+THROTTLED = 'throttled'
+STALE = 'stale'
+
+
+class AdmissionControl:
+    """
+    Decides which updates the bot handles at all, before they reach a handler.
+
+    Every user gets a token bucket of `rate` updates per second holding up to
+    `burst`; updates beyond it are shed as THROTTLED. Updates are also shed as
+    STALE when, by the time a processing slot frees up, more than
+    max_update_age seconds have passed since they were received (or since
+    Telegram stamped the message, if that is earlier). None disables either
+    check.
+
+    Updates are stamped when they enter the Application's update queue (see
+    AdmissionQueue), so throttling sees the real arrival rate even while the
+    updates themselves wait for a slot.
+    """
+
+    def __init__(self, rate=1.0, burst=5, max_update_age=30.0, busy_reply_interval=10.0, max_tracked=100000):
+        self.limiter = KeyedRateLimiter(rate, burst) if rate else None
+        self.max_update_age = max_update_age
+        # At most one "busy" reply per user per interval, so a flood is not answered in kind
+        self.busy_replies = KeyedRateLimiter(1 / busy_reply_interval, 1)
+        self.max_tracked = max_tracked
+        # update_id -> (monotonic arrival time, throttled)
+        self._arrivals = OrderedDict()
+        self.shed = {THROTTLED: 0, STALE: 0}
+        self.admitted = 0
+
+    def arrived(self, update):
+        if not isinstance(update, Update):
+            return
+        key = PerUserUpdateProcessor.key(update)
+        throttled = self.limiter is not None and key is not None and not self.limiter.try_acquire(key)
+        self._arrivals[update.update_id] = (time.monotonic(), throttled)
+        # Updates dropped by the Application before processing must not pile up here
+        while len(self._arrivals) > self.max_tracked:
+            self._arrivals.popitem(last=False)
+
+    def admit(self, update):
+        """None if the update should be handled, otherwise the reason to shed it."""
+        if not isinstance(update, Update):
+            return None
+        arrived, throttled = self._arrivals.pop(update.update_id, (time.monotonic(), False))
+        if throttled:
+            reason = THROTTLED
+        elif self.max_update_age is not None and self._age(update, arrived) > self.max_update_age:
+            reason = STALE
+        else:
+            self.admitted += 1
+            return None
+        self.shed[reason] += 1
+        UPDATES_SHED.inc(reason=reason)
+        return reason
+
+    @staticmethod
+    def _age(update, arrived):
+        age = time.monotonic() - arrived
+        # Telegram stamps messages when they are sent; callback queries carry no such date
+        message = update.message or update.edited_message
+        if message and message.date:
+            age = max(age, time.time() - message.date.timestamp())
+        return age
+
+    def should_reply(self, update):
+        user = update.effective_user
+        return user is not None and self.busy_replies.try_acquire(user.id)
+
+    def get_statistics(self):
+        return {'admitted': self.admitted, 'shed': dict(self.shed)}
+
+
+class AdmissionQueue(asyncio.Queue):
+    # The Application's update_queue; polling, webhooks and sharded workers all put updates here
+    def __init__(self, admission: AdmissionControl):
+        super().__init__()
+        self.admission = admission
+
+    def _put(self, item):
+        self.admission.arrived(item)
+        super()._put(item)
@@ -1,54 +1,81 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from balance_cache import BALANCE_CHANNEL
+from bulk import FORMATS, export_actions, import_users, stream_export
 from database import DatabaseManager
+from ledger import LEDGER_HEAD_CHANNEL, LedgerHead
+from listener import DatabaseListener
+from metrics import CONTENT_TYPE, REGISTRY, start_http_server
+from outbox import OutboxDispatcher
+import _thread
 import hashlib
-import requests
-from translations import get_translation
+import json
+import psycopg2
+import signal
+import socket
+import threading
+import time
 
 default_language_code = 'ru'
 
+# Upper bound on ids per /approve/batch or /remove/batch call
+max_batch_size = 1000
+
 class API:
-    def __init__(self, token: str, db: DatabaseManager):
+    def __init__(self, token: str, db: DatabaseManager, telegram_api_url='https://api.telegram.org', outbox_global_rate=25):
         self.app = Flask("telegram_flashback_api")
         self.db = db
         self.token = token
+        # Approval notifications are queued in the outbox by the database methods and sent from here
+        # outbox_global_rate is this process's share when several API workers send
+        self.outbox = OutboxDispatcher(db, token, api_url=telegram_api_url, default_language_code=default_language_code,
+                                       global_rate=outbox_global_rate)
+        # Chain head cached in-process; approvals elsewhere arrive through LISTEN ledger_head
+        self.ledger_head = LedgerHead(db)
+        handlers = {LEDGER_HEAD_CHANNEL: self.ledger_head.on_notify}
+        if db.balance_cache:
+            handlers[BALANCE_CHANNEL] = db.balance_cache.on_notify
+        self.listener = DatabaseListener(db.db_params, handlers, on_reconnect=self._on_listener_reconnect)
 
         # Manually set routes up
         self.app.route('/pending', methods=['GET'])(self.pending)
         self.app.route('/approve/<int:id>', methods=['POST'])(self.approve)
         self.app.route('/remove/<int:id>', methods=['POST'])(self.remove)
+        self.app.route('/approve/batch', methods=['POST'])(self.approve_batch)
+        self.app.route('/remove/batch', methods=['POST'])(self.remove_batch)
         self.app.route('/lastkey', methods=['GET'])(self.lastkey)
+        self.app.route('/import/users', methods=['POST'])(self.import_users)
+        self.app.route('/export/actions', methods=['GET'])(self.export_actions)
+        self.app.route('/metrics', methods=['GET'])(self.metrics)
 
-    def send_message(self, chat_id, text):
-        base_url = f"https://api.telegram.org/bot{self.token}/sendMessage"
-        params = {
-            'chat_id': chat_id,
-            'text': text,
-        }
+    def _on_listener_reconnect(self):
+        # Anything may have changed while the listener was disconnected
+        self.ledger_head.invalidate()
+        if self.db.balance_cache:
+            self.db.balance_cache.clear()
 
-        response = requests.post(base_url, params=params)
-        result = response.json()
-        if not result['ok']:
-            print(f"Failed to send message. Telegram API response: {result}")
+    # Prometheus scrape target; only counters and timings, so no md5 is needed
+    def metrics(self):
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
 
     def lastkey(self):
-        md5 = self.db.get_last_md5()
+        md5 = self.ledger_head.get()
         if md5:
-            return md5[0]
+            return md5
         else:
             return "NO", 200
 
     async def auth(self, received_md5):
-        latest_md5 = self.db.get_last_md5()
-
         if not received_md5:
             return None
 
+        latest_md5 = self.ledger_head.get()
         if not latest_md5:
             return received_md5
 
         calculated_md5 = hashlib.md5(received_md5.encode()).hexdigest()
 
-        if calculated_md5 == latest_md5[0]:
+        # On a mismatch re-read the head once, in case a notification has not arrived yet
+        if calculated_md5 == latest_md5 or calculated_md5 == self.ledger_head.refresh():
             return received_md5
         else:
             return None
@@ -59,22 +86,48 @@ class API:
         if not md5:
             return jsonify({'error': 'Failed to authenticate'}), 401
 
-        pending_actions = self.db.get_all_pending_actions()
-        result = []
-        for action in pending_actions:
-            balance = self.db.get_balance(action[1])
-            ltz = balance[0] < action[3]
-            result.append({
-                'id': action[0],
-                'sender_phone': action[1],
-                'receiver_phone': action[2],
-                'amount': action[3],
-                'comment': action[4],
-                'sender_info': action[5],
-                'receiver_info': action[6],
-                'less_than_zero': ltz,
-            })
-        return jsonify(result)
+        # Keyset pagination: pass the last id seen as after_id to get the next page
+        after_id = request.args.get('after_id', type=int)
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit <= 0:
+            return jsonify({'error': 'limit must be positive'}), 400
+
+        pending_actions = self.db.iter_pending_actions(
+            after_id=after_id,
+            limit=limit,
+            sender=request.args.get('sender'),
+            receiver=request.args.get('receiver'),
+        )
+        # Run the query before the 200 goes out, so a database error is a 500 rather than a cut-off array
+        first = next(pending_actions, None)
+        return Response(self._stream_pending(first, pending_actions), mimetype='application/json')
+
+    @staticmethod
+    def _stream_pending(first, pending_actions):
+        # Emit the JSON array row by row instead of building it in memory
+        try:
+            yield '['
+            if first is not None:
+                yield API._pending_json(first)
+                for action in pending_actions:
+                    yield ',' + API._pending_json(action)
+            yield ']'
+        finally:
+            # Ends the transaction even when the client goes away mid-array
+            pending_actions.close()
+
+    @staticmethod
+    def _pending_json(action):
+        return json.dumps({
+            'id': action[0],
+            'sender_phone': action[1],
+            'receiver_phone': action[2],
+            'amount': action[3],
+            'comment': action[4],
+            'sender_info': action[5],
+            'receiver_info': action[6],
+            'less_than_zero': action[7],
+        }, ensure_ascii=False)
 
     # Move pending action to a db with correct md5
     async def approve(self, id):
@@ -82,21 +135,16 @@ class API:
         if not md5:
             return jsonify({'error': 'Failed to authenticate'}), 401
 
-        dbres = self.db.apply_pending_action(id, md5)
-
-        if not (dbres == None):
-            # Send message
-            snd_phone, recv_phone, amount, comment = dbres
-            snd_id = self.db.get_reverse_assoc(snd_phone)[0]
-            recv_id = self.db.get_reverse_assoc(recv_phone)[0]
-            snd_lang = self.db.get_user_language(snd_id) or default_language_code
-            recv_lang = self.db.get_user_language(recv_id) or default_language_code
-            approve_message_snd = get_translation(snd_lang, 'approve_message_snd',amount=amount, recv_phone=recv_phone, comment=comment)
-            approve_message_recv = get_translation(recv_lang, 'approve_message_recv', amount=amount, snd_phone=snd_phone, comment=comment)
+        status, _ = self.db.apply_pending_action(id, md5)
 
-            self.send_message(snd_id, approve_message_snd)
-            self.send_message(recv_id, approve_message_recv)
+        if status == 'approved':
+            self.ledger_head.set(md5)
+            self.outbox.wake()
             return jsonify({'message': 'Action moved to actions successfully'})
+        elif status == 'auth_failed':
+            # Another approval moved the chain head after auth() checked it
+            self.ledger_head.invalidate()
+            return jsonify({'error': 'Failed to authenticate'}), 401
         else:
             return jsonify({'error': 'Action ID not found'}), 400
 
@@ -107,17 +155,147 @@ class API:
             return jsonify({'error': 'Failed to authenticate'}), 401
         result = self.db.remove_pending_action(id)
         if result:
-            # Send message
-            recv_phone, amount = result
-            snd_id = self.db.get_reverse_assoc(recv_phone)[0]
-            snd_lang = self.db.get_user_language(snd_id) or default_language_code
-            remove_message_snd = get_translation(snd_lang, 'remove_message_snd', amount=amount, recv_phone=recv_phone)
-
-            self.send_message(snd_id, remove_message_snd)
+            self.outbox.wake()
             return jsonify({'message': 'Action removed successfully'})
         else:
             return jsonify({'error': 'Action ID not found'}), 400
 
-    def run(self):
-        from waitress import serve
-        serve(self.app, host="0.0.0.0", port=5000)
+    @staticmethod
+    def _parse_batch(items, parse_item):
+        if not isinstance(items, list) or not items:
+            return None, (jsonify({'error': 'Expected a non-empty list'}), 400)
+        if len(items) > max_batch_size:
+            return None, (jsonify({'error': f'At most {max_batch_size} items per batch'}), 400)
+        try:
+            return [parse_item(item) for item in items], None
+        except (TypeError, ValueError, KeyError):
+            return None, (jsonify({'error': 'Malformed batch item'}), 400)
+
+    # Approve many pending actions in one transaction.
+    # Body: {"actions": [{"id": 1, "md5": "..."}, ...]}, each md5 chaining onto the previous one
+    async def approve_batch(self):
+        items, error = self._parse_batch(
+            (request.json or {}).get('actions'),
+            lambda item: (int(item['id']), str(item['md5'])),
+        )
+        if error:
+            return error
+        md5 = await self.auth(items[0][1])
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+
+        results = self.db.apply_pending_actions(items)
+        approved = [key for (id, status, _), (_, key) in zip(results, items) if status == 'approved']
+        if approved:
+            self.ledger_head.set(approved[-1])
+        self.outbox.wake()
+
+        return jsonify({'results': [{'id': id, 'status': status} for id, status, _ in results]})
+
+    # Remove many pending actions in one transaction.
+    # Body: {"md5": "...", "ids": [1, 2, ...]}
+    async def remove_batch(self):
+        body = request.json or {}
+        md5 = await self.auth(body.get('md5'))
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+        ids, error = self._parse_batch(body.get('ids'), int)
+        if error:
+            return error
+
+        results = self.db.remove_pending_actions(ids)
+        self.outbox.wake()
+
+        return jsonify({'results': [{'id': id, 'status': 'removed' if result else 'not_found'} for id, result in results.items()]})
+
+    # Upsert users from the request body (CSV with a header, or NDJSON), streamed into COPY.
+    # /import/users?md5=...&format=csv|ndjson
+    async def import_users(self):
+        md5 = await self.auth(request.args.get('md5'))
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+        format = request.args.get('format', 'csv')
+        if format not in FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(FORMATS)}'}), 400
+        try:
+            result = import_users(self.db, request.stream, format)
+        except (ValueError, psycopg2.DataError) as e:
+            return jsonify({'error': f'Import failed: {e}'}), 400
+        return jsonify(result)
+
+    # Stream the actions ledger in id order.
+    # /export/actions?md5=...&format=csv|ndjson&after_id=&to_id=&phone=
+    async def export_actions(self):
+        md5 = await self.auth(request.args.get('md5'))
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+        format = request.args.get('format', 'csv')
+        if format not in FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(FORMATS)}'}), 400
+        chunks = stream_export(
+            export_actions, self.db, format,
+            after_id=request.args.get('after_id', type=int),
+            to_id=request.args.get('to_id', type=int),
+            phone=request.args.get('phone'),
+        )
+        mimetype = 'application/x-ndjson' if format == 'ndjson' else 'text/csv'
+        return Response(chunks, mimetype=mimetype)
+
+    def _drain_on_sigterm(self, server, timeout):
+        """
+        On SIGTERM stop accepting, wait up to `timeout` seconds for requests
+        in flight to be answered, then leave server.run(). A second SIGTERM
+        leaves right away.
+        """
+        draining = []
+
+        def wait_idle():
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and any(
+                    channel.requests or channel.total_outbufs_len for channel in list(server.active_channels.values())):
+                time.sleep(0.05)
+            _thread.interrupt_main(signal.SIGTERM)
+
+        def handle(signum, frame):
+            if draining:
+                # server.run() shuts its threads down on SystemExit
+                raise SystemExit(0)
+            draining.append(True)
+            server.accepting = False
+            try:
+                # With SO_REUSEPORT the kernel sends new connections to the other workers from now on
+                server.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            threading.Thread(target=wait_idle, name='api-drain', daemon=True).start()
+
+        signal.signal(signal.SIGTERM, handle)
+
+    def run(self, host="0.0.0.0", port=5000, threads=4, sock=None, on_ready=None, drain_timeout=None, metrics_port=None):
+        """
+        Serve on host:port, or on the already listening `sock` (see supervisor.py).
+        on_ready() is called once the database has answered; drain_timeout
+        makes SIGTERM a graceful shutdown; metrics_port serves this process's
+        metrics on a port of its own.
+        """
+        from waitress import create_server
+        # Fails here, before taking any request, if the database is unreachable
+        self.ledger_head.refresh()
+        if sock is not None:
+            server = create_server(self.app, sockets=[sock], threads=threads)
+        else:
+            server = create_server(self.app, host=host, port=port, threads=threads)
+        server.print_listen("Serving on http://{}:{}")
+        if drain_timeout is not None:
+            self._drain_on_sigterm(server, drain_timeout)
+        if metrics_port is not None:
+            start_http_server(metrics_port)
+        self.listener.start()
+        self.outbox.start()
+        try:
+            if on_ready:
+                on_ready()
+            server.run()
+        finally:
+            self.outbox.stop()
+            self.listener.stop()
@@ -0,0 +1,272 @@
+import hashlib
+import json
+
+import asyncpg
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from api import API, default_language_code, max_batch_size
+from async_database import AsyncDatabaseManager
+from balance_cache import BALANCE_CHANNEL
+from bulk import FORMATS, import_users_async, stream_actions_async
+from database import DatabaseManager
+from ledger import LEDGER_HEAD_CHANNEL, AsyncLedgerHead
+from listener import AsyncDatabaseListener
+from metrics import CONTENT_TYPE, REGISTRY, start_http_server
+from outbox import OutboxDispatcher
+
+
+class AsyncAPI:
+    """
+    ASGI version of API: the same routes and responses, served by uvicorn
+    with every database call awaited on an asyncpg pool.
+
+    Approval notifications still go through the outbox, whose dispatcher is a
+    background thread on the small psycopg2 pool passed as outbox_db.
+    """
+
+    def __init__(self, token: str, db: AsyncDatabaseManager, outbox_db: DatabaseManager,
+                 telegram_api_url='https://api.telegram.org', outbox_global_rate=25):
+        self.db = db
+        self.token = token
+        self.outbox = OutboxDispatcher(outbox_db, token, api_url=telegram_api_url, default_language_code=default_language_code,
+                                       global_rate=outbox_global_rate)
+        self.ledger_head = AsyncLedgerHead(db)
+        handlers = {LEDGER_HEAD_CHANNEL: self.ledger_head.on_notify}
+        if db.balance_cache:
+            handlers[BALANCE_CHANNEL] = db.balance_cache.on_notify
+        self.listener = AsyncDatabaseListener(db.db_params, handlers, on_reconnect=self._on_listener_reconnect)
+        # Set by run(); called once lifespan startup has checked the database
+        self._on_ready = None
+
+        self.app = Starlette(
+            routes=[
+                Route('/pending', self.pending, methods=['GET']),
+                Route('/approve/batch', self.approve_batch, methods=['POST']),
+                Route('/remove/batch', self.remove_batch, methods=['POST']),
+                Route('/approve/{id:int}', self.approve, methods=['POST']),
+                Route('/remove/{id:int}', self.remove, methods=['POST']),
+                Route('/lastkey', self.lastkey, methods=['GET']),
+                Route('/import/users', self.import_users, methods=['POST']),
+                Route('/export/actions', self.export_actions, methods=['GET']),
+                Route('/metrics', self.metrics, methods=['GET']),
+            ],
+            lifespan=self.lifespan,
+        )
+
+    @asynccontextmanager
+    async def lifespan(self, app):
+        await self.db.connect()
+        # Fails here, before taking any request, if the database is unreachable
+        await self.ledger_head.refresh()
+        self.listener.start()
+        self.outbox.start()
+        if self._on_ready:
+            self._on_ready()
+        try:
+            yield
+        finally:
+            self.outbox.stop()
+            await self.listener.stop()
+            await self.db.close()
+
+    @staticmethod
+    async def _json(request: Request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return {}
+        return body if isinstance(body, dict) else {}
+
+    def _on_listener_reconnect(self):
+        # Anything may have changed while the listener was disconnected
+        self.ledger_head.invalidate()
+        if self.db.balance_cache:
+            self.db.balance_cache.clear()
+
+    async def metrics(self, request: Request):
+        return Response(REGISTRY.render(), headers={'Content-Type': CONTENT_TYPE})
+
+    async def lastkey(self, request: Request):
+        md5 = await self.ledger_head.get()
+        if md5:
+            return PlainTextResponse(md5, media_type='text/html')
+        else:
+            return PlainTextResponse("NO", media_type='text/html')
+
+    async def auth(self, received_md5):
+        if not received_md5:
+            return None
+
+        latest_md5 = await self.ledger_head.get()
+        if not latest_md5:
+            return received_md5
+
+        calculated_md5 = hashlib.md5(received_md5.encode()).hexdigest()
+
+        if calculated_md5 == latest_md5 or calculated_md5 == await self.ledger_head.refresh():
+            return received_md5
+        else:
+            return None
+
+    # Return pending actions
+    async def pending(self, request: Request):
+        md5 = await self.auth(request.query_params.get('md5'))
+        if not md5:
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+
+        try:
+            after_id = int(request.query_params['after_id']) if 'after_id' in request.query_params else None
+            limit = int(request.query_params['limit']) if 'limit' in request.query_params else None
+        except ValueError:
+            # Flask's type=int silently ignores malformed values
+            after_id = limit = None
+        if limit is not None and limit <= 0:
+            return JSONResponse({'error': 'limit must be positive'}, status_code=400)
+
+        pending_actions = self.db.iter_pending_actions(
+            after_id=after_id,
+            limit=limit,
+            sender=request.query_params.get('sender'),
+            receiver=request.query_params.get('receiver'),
+        )
+        # Run the query before the 200 goes out, so a database error is a 500 rather than a cut-off array
+        first = await anext(pending_actions, None)
+        return StreamingResponse(self._stream_pending(first, pending_actions), media_type='application/json')
+
+    @staticmethod
+    async def _stream_pending(first, pending_actions):
+        try:
+            yield '['
+            if first is not None:
+                yield API._pending_json(first)
+                async for action in pending_actions:
+                    yield ',' + API._pending_json(action)
+            yield ']'
+        finally:
+            await pending_actions.aclose()
+
+    # Move pending action to a db with correct md5
+    async def approve(self, request: Request):
+        md5 = await self.auth((await self._json(request)).get('md5'))
+        if not md5:
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+
+        status, _ = await self.db.apply_pending_action(request.path_params['id'], md5)
+
+        if status == 'approved':
+            self.ledger_head.set(md5)
+            self.outbox.wake()
+            return JSONResponse({'message': 'Action moved to actions successfully'})
+        elif status == 'auth_failed':
+            # Another approval moved the chain head after auth() checked it
+            self.ledger_head.invalidate()
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+        else:
+            return JSONResponse({'error': 'Action ID not found'}, status_code=400)
+
+    # Remove a pending action
+    async def remove(self, request: Request):
+        md5 = await self.auth((await self._json(request)).get('md5'))
+        if not md5:
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+        result = await self.db.remove_pending_action(request.path_params['id'])
+        if result:
+            self.outbox.wake()
+            return JSONResponse({'message': 'Action removed successfully'})
+        else:
+            return JSONResponse({'error': 'Action ID not found'}, status_code=400)
+
+    @staticmethod
+    def _parse_batch(items, parse_item):
+        if not isinstance(items, list) or not items:
+            return None, JSONResponse({'error': 'Expected a non-empty list'}, status_code=400)
+        if len(items) > max_batch_size:
+            return None, JSONResponse({'error': f'At most {max_batch_size} items per batch'}, status_code=400)
+        try:
+            return [parse_item(item) for item in items], None
+        except (TypeError, ValueError, KeyError):
+            return None, JSONResponse({'error': 'Malformed batch item'}, status_code=400)
+
+    async def approve_batch(self, request: Request):
+        items, error = self._parse_batch(
+            (await self._json(request)).get('actions'),
+            lambda item: (int(item['id']), str(item['md5'])),
+        )
+        if error:
+            return error
+        md5 = await self.auth(items[0][1])
+        if not md5:
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+
+        results = await self.db.apply_pending_actions(items)
+        approved = [key for (id, status, _), (_, key) in zip(results, items) if status == 'approved']
+        if approved:
+            self.ledger_head.set(approved[-1])
+        self.outbox.wake()
+
+        return JSONResponse({'results': [{'id': id, 'status': status} for id, status, _ in results]})
+
+    async def remove_batch(self, request: Request):
+        body = await self._json(request)
+        md5 = await self.auth(body.get('md5'))
+        if not md5:
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+        ids, error = self._parse_batch(body.get('ids'), int)
+        if error:
+            return error
+
+        results = await self.db.remove_pending_actions(ids)
+        self.outbox.wake()
+
+        return JSONResponse({'results': [{'id': id, 'status': 'removed' if result else 'not_found'} for id, result in results.items()]})
+
+    @staticmethod
+    def _int_param(request: Request, name):
+        try:
+            return int(request.query_params[name]) if name in request.query_params else None
+        except ValueError:
+            return None
+
+    async def import_users(self, request: Request):
+        md5 = await self.auth(request.query_params.get('md5'))
+        if not md5:
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+        format = request.query_params.get('format', 'csv')
+        if format not in FORMATS:
+            return JSONResponse({'error': f'format must be one of {", ".join(FORMATS)}'}, status_code=400)
+        try:
+            result = await import_users_async(self.db, request.stream(), format)
+        except (ValueError, asyncpg.DataError) as e:
+            return JSONResponse({'error': f'Import failed: {e}'}, status_code=400)
+        return JSONResponse(result)
+
+    async def export_actions(self, request: Request):
+        md5 = await self.auth(request.query_params.get('md5'))
+        if not md5:
+            return JSONResponse({'error': 'Failed to authenticate'}, status_code=401)
+        format = request.query_params.get('format', 'csv')
+        if format not in FORMATS:
+            return JSONResponse({'error': f'format must be one of {", ".join(FORMATS)}'}, status_code=400)
+        chunks = stream_actions_async(
+            self.db, format,
+            after_id=self._int_param(request, 'after_id'),
+            to_id=self._int_param(request, 'to_id'),
+            phone=request.query_params.get('phone'),
+        )
+        media_type = 'application/x-ndjson' if format == 'ndjson' else 'text/csv'
+        return StreamingResponse(chunks, media_type=media_type)
+
+    def run(self, host="0.0.0.0", port=5000, sock=None, on_ready=None, drain_timeout=None, metrics_port=None):
+        """Same arguments as API.run; uvicorn drains on SIGTERM by itself, drain_timeout bounds the wait."""
+        import uvicorn
+        self._on_ready = on_ready
+        if metrics_port is not None:
+            start_http_server(metrics_port)
+        server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level='warning',
+                                               timeout_graceful_shutdown=drain_timeout))
+        server.run(sockets=[sock] if sock is not None else None)
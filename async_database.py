@@ -0,0 +1,352 @@
+import asyncpg
+import json
+from contextlib import asynccontextmanager
+from time import perf_counter
+from database import LEDGER_LOCK_ID, DatabaseManager, WaitCounter, users_statistics_from_row
+from metrics import instrument_methods, log_slow_query
+from migrations import REBUILD_USERS_STATISTICS
+from phones import phone_key
+
+
+class AsyncDatabaseManager:
+    """asyncpg counterpart of DatabaseManager for the bot's event loop.
+
+    Methods mirror DatabaseManager and return plain tuples, so handlers can
+    index rows the same way. The pool is created by connect(), which must be
+    awaited inside the loop that will use it (the bot does it in post_init).
+    slow_query_seconds works as in DatabaseManager.
+    """
+
+    def __init__(self, db_params={'host': 'your_host', 'database': 'your_database', 'user': 'your_user', 'password': 'your_password', 'port': 'your_port'}, pool_size=(1, 10), session_cache=None, balance_cache=None,
+                 slow_query_seconds=None):
+        self.session_cache = session_cache
+        self.balance_cache = balance_cache
+        self.db_params = dict(db_params)
+        if 'port' in self.db_params:
+            self.db_params['port'] = int(self.db_params['port'])
+        self.pool_size = pool_size
+        self.slow_query_seconds = slow_query_seconds
+        self.pool = None
+        self.pool_wait = WaitCounter()
+
+    async def connect(self):
+        min_size, max_size = self.pool_size
+        init = self._init_connection if self.slow_query_seconds is not None else None
+        self.pool = await asyncpg.create_pool(min_size=min_size, max_size=max_size, init=init, **self.db_params)
+
+    async def _init_connection(self, conn):
+        conn.add_query_logger(self._log_query)
+
+    def _log_query(self, record):
+        log_slow_query('async', self.slow_query_seconds, record.elapsed, record.query)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def _transaction(self):
+        # One transaction per call, same scoping as DatabaseManager._transaction
+        started = perf_counter()
+        async with self.pool.acquire() as conn:
+            self.pool_wait.add(perf_counter() - started)
+            async with conn.transaction():
+                yield conn
+
+    async def _fetchone(self, query, *args):
+        started = perf_counter()
+        async with self.pool.acquire() as conn:
+            self.pool_wait.add(perf_counter() - started)
+            row = await conn.fetchrow(query, *args)
+        return tuple(row) if row is not None else None
+
+    async def _fetchall(self, query, *args):
+        started = perf_counter()
+        async with self.pool.acquire() as conn:
+            self.pool_wait.add(perf_counter() - started)
+            rows = await conn.fetch(query, *args)
+        return [tuple(row) for row in rows]
+
+    def get_pool_statistics(self):
+        return {
+            'mode': 'async',
+            'pool_wait': self.pool_wait.snapshot(),
+        }
+
+    async def get_users_statistics(self):
+        try:
+            row = await self._fetchone('''
+                SELECT total_users, positive_balance_users, zero_balance_users,
+                       negative_balance_users, total_balance, users_without_info
+                FROM users_statistics WHERE id = 1
+            ''')
+            if row is None:
+                row = await self.rebuild_users_statistics()
+            return users_statistics_from_row(row)
+        except asyncpg.PostgresError as e:
+            print(f"Error fetching users statistics: {e}")
+            return None
+
+    async def rebuild_users_statistics(self):
+        async with self._transaction() as conn:
+            await conn.execute('LOCK TABLE users IN SHARE MODE')
+            return tuple(await conn.fetchrow(REBUILD_USERS_STATISTICS + '''
+                RETURNING total_users, positive_balance_users, zero_balance_users,
+                          negative_balance_users, total_balance, users_without_info
+            '''))
+
+    async def add_user(self, phone_number):
+        async with self._transaction() as conn:
+            await conn.execute('INSERT INTO users (phone_number, balance) VALUES ($1, 0)', phone_number)
+
+    async def get_user(self, phone_number):
+        return await self._fetchone('SELECT * FROM users WHERE phone_key=$1', phone_key(phone_number))
+
+    async def add_assoc(self, user_id, phone_number):
+        """Link a telegram user id to a phone number; False when either is already linked."""
+        async with self._transaction() as conn:
+            linked = await conn.fetchval(
+                'INSERT INTO assoc (user_id, phone_number) VALUES ($1, $2) ON CONFLICT DO NOTHING RETURNING user_id',
+                user_id, phone_number)
+        if self.session_cache:
+            self.session_cache.invalidate(user_id)
+        return linked is not None
+
+    async def _get_session(self, user_id):
+        if self.session_cache:
+            session = self.session_cache.get(user_id)
+            if session:
+                return session
+            generation = self.session_cache.generation()
+        session = await self._fetchone('SELECT phone_number, language FROM assoc WHERE user_id=$1', user_id)
+        if session and self.session_cache:
+            self.session_cache.put(user_id, session[0], session[1], generation)
+        return session
+
+    async def get_assoc(self, user_id):
+        session = await self._get_session(user_id)
+        return (session[0],) if session else None
+
+    async def get_reverse_assoc(self, phone_number):
+        return await self._fetchone('SELECT user_id FROM assoc WHERE phone_key=$1', phone_key(phone_number))
+
+    async def get_balance(self, phone_number):
+        key = phone_key(phone_number)
+        if self.balance_cache:
+            balance = self.balance_cache.get(key)
+            if balance is not None:
+                return (balance,)
+            generation = self.balance_cache.generation()
+        row = await self._fetchone('SELECT balance FROM users WHERE phone_key=$1', key)
+        if row and self.balance_cache:
+            self.balance_cache.put(key, row[0], generation)
+        return row
+
+    async def get_all_pending_actions(self):
+        return await self._fetchall('SELECT * FROM pending_actions')
+
+    async def iter_pending_actions(self, after_id=None, limit=None, sender=None, receiver=None, batch_size=500):
+        """Async generator counterpart of DatabaseManager.iter_pending_actions."""
+        conditions = []
+        params = []
+        # Phones are compared by key; an unparseable phone still filters (to nothing)
+        filters = (('p.id > ', after_id, None), ('p.user_phone_key = ', sender, phone_key), ('p.receiver_phone_key = ', receiver, phone_key))
+        for condition, value, convert in filters:
+            if value is not None:
+                params.append(convert(value) if convert else value)
+                conditions.append(f'{condition}${len(params)}')
+        query = '''
+            SELECT p.id, p.user_phone_number, p.receiver_phone_number, p.amount, p.comment,
+                   p.sender_info, p.receiver_info, COALESCE(u.balance, 0) < p.amount AS less_than_zero
+            FROM pending_actions p
+            LEFT JOIN users u ON u.phone_key = p.user_phone_key
+        '''
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY p.id'
+        if limit is not None:
+            params.append(limit)
+            query += f' LIMIT ${len(params)}'
+
+        async with self._transaction() as conn:
+            async for row in conn.cursor(query, *params, prefetch=batch_size):
+                yield tuple(row)
+
+    async def get_user_info_by_phone(self, phone_number):
+        try:
+            user_info = await self._fetchone("SELECT info FROM users WHERE phone_key = $1", phone_key(phone_number))
+            return user_info[0] if user_info else None
+        except asyncpg.PostgresError as e:
+            print(f"Error fetching user info: {e}")
+            return None
+
+    async def get_user_info_with_balance(self, phone_number):
+        try:
+            user_info = await self._fetchone("SELECT info, balance FROM users WHERE phone_key = $1", phone_key(phone_number))
+            if user_info:
+                info, balance = user_info
+                if info:
+                    info = f"Баланс: {balance}\n" + info.strip()
+                else:
+                    info = f"Баланс: {balance}"
+                return info
+            else:
+                return None
+        except asyncpg.PostgresError as e:
+            print(f"Error fetching user info with balance: {e}")
+            return None
+
+    async def create_pending_action(self, user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment):
+        try:
+            async with self._transaction() as conn:
+                await conn.execute('''
+                    INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                ''', user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment)
+                return True
+        except asyncpg.PostgresError as e:
+            print(f"Error creating pending action: {e}")
+            return False
+
+    @staticmethod
+    async def _enqueue_notifications(conn, notifications):
+        # Same outbox rows as DatabaseManager._enqueue_notifications
+        if not notifications:
+            return
+        await conn.execute('''
+            INSERT INTO outbox (chat_id, language, template, params)
+            SELECT a.user_id, a.language, n.template, n.params::jsonb
+            FROM unnest($1::bigint[], $2::text[], $3::text[]) WITH ORDINALITY AS n(phone_key, template, params, position)
+            JOIN assoc a ON a.phone_key = n.phone_key
+            ORDER BY n.position
+        ''',
+            [phone_key(phone) for phone, _, _ in notifications],
+            [template for _, template, _ in notifications],
+            [json.dumps(params, ensure_ascii=False) for _, _, params in notifications],
+        )
+
+    async def remove_pending_action(self, id):
+        async with self._transaction() as conn:
+            result = await conn.fetchrow('DELETE FROM pending_actions WHERE id=$1 RETURNING user_phone_number, receiver_phone_number, amount', id)
+            if result:
+                snd_phone, recv_phone, amount = result
+                await self._enqueue_notifications(conn, DatabaseManager._remove_notifications(snd_phone, recv_phone, amount))
+                return snd_phone, amount
+            return None
+
+    async def apply_pending_action(self, id, md5):
+        # Same locking, checks and (status, data) result as DatabaseManager.apply_pending_action
+        async with self._transaction() as conn:
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', LEDGER_LOCK_ID)
+            head = await conn.fetchval('SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
+            pending_action_data = await conn.fetchrow('''
+                SELECT user_phone_number, receiver_phone_number, amount, comment
+                FROM pending_actions
+                WHERE id = $1
+                FOR UPDATE
+            ''', id)
+            pending = {id: tuple(pending_action_data)} if pending_action_data else {}
+            [(_, status, _)], _, _ = DatabaseManager._chain_batch([(id, md5)], head, pending)
+
+            if status == 'approved':
+                user_phone_number, receiver_phone_number, amount, comment = pending_action_data
+                await conn.execute('UPDATE users SET balance = balance - $1 WHERE phone_key=$2', amount, phone_key(user_phone_number))
+                await conn.execute('UPDATE users SET balance = balance + $1 WHERE phone_key=$2', amount, phone_key(receiver_phone_number))
+                await conn.execute('DELETE FROM pending_actions WHERE id=$1', id)
+                await conn.execute('''
+                    INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5, comment)
+                    VALUES ($1, $2, $3, $4, $5)
+                ''', user_phone_number, receiver_phone_number, amount, md5, comment)
+                await self._enqueue_notifications(conn, DatabaseManager._approve_notifications(user_phone_number, receiver_phone_number, amount, comment))
+                return status, (user_phone_number, receiver_phone_number, amount, comment)
+            return status, None
+
+    async def remove_pending_actions(self, ids):
+        async with self._transaction() as conn:
+            rows = await conn.fetch('''
+                DELETE FROM pending_actions WHERE id = ANY($1::int[])
+                RETURNING id, user_phone_number, receiver_phone_number, amount
+            ''', list(ids))
+            removed = {row[0]: tuple(row[1:]) for row in sorted(rows)}
+            await self._enqueue_notifications(conn, [
+                notification
+                for snd_phone, recv_phone, amount in removed.values()
+                for notification in DatabaseManager._remove_notifications(snd_phone, recv_phone, amount)
+            ])
+        return {id: (removed[id][0], removed[id][2]) if id in removed else None for id in ids}
+
+    async def apply_pending_actions(self, items):
+        # Same checks and statuses as DatabaseManager.apply_pending_actions
+        async with self._transaction() as conn:
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', LEDGER_LOCK_ID)
+            head = await conn.fetchval('SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
+            rows = await conn.fetch('''
+                SELECT id, user_phone_number, receiver_phone_number, amount, comment
+                FROM pending_actions
+                WHERE id = ANY($1::int[])
+                FOR UPDATE
+            ''', [id for id, _ in items])
+            pending = {row[0]: tuple(row[1:]) for row in rows}
+
+            results, deltas, ledger = DatabaseManager._chain_batch(items, head, pending)
+
+            if ledger:
+                await conn.execute('''
+                    UPDATE users u SET balance = u.balance + d.delta
+                    FROM unnest($1::bigint[], $2::bigint[]) AS d(phone_key, delta)
+                    WHERE u.phone_key = d.phone_key
+                ''', list(deltas), list(deltas.values()))
+                await conn.execute('DELETE FROM pending_actions WHERE id = ANY($1::int[])', [entry[0] for entry in ledger])
+                # ORDER BY position keeps the chain order in the serial ids
+                await conn.execute('''
+                    INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5, comment)
+                    SELECT s, r, a, m, c
+                    FROM unnest($1::text[], $2::text[], $3::bigint[], $4::text[], $5::text[]) WITH ORDINALITY AS l(s, r, a, m, c, position)
+                    ORDER BY position
+                ''', *[list(column) for column in zip(*[entry[1:] for entry in ledger])])
+                await self._enqueue_notifications(conn, [
+                    notification
+                    for _, snd_phone, recv_phone, amount, _, comment in ledger
+                    for notification in DatabaseManager._approve_notifications(snd_phone, recv_phone, amount, comment)
+                ])
+            return results
+
+    async def get_bot_state(self, kind, id):
+        row = await self._fetchone('SELECT data FROM bot_state WHERE kind = $1 AND id = $2', kind, id)
+        return json.loads(row[0]) if row else None
+
+    async def save_bot_state(self, upserts, deletes):
+        """Write a batch of persistence changes: upserts are (kind, id, json_text), deletes (kind, id)."""
+        async with self._transaction() as conn:
+            if upserts:
+                await conn.execute('''
+                    INSERT INTO bot_state (kind, id, data)
+                    SELECT kind, id, data::jsonb FROM unnest($1::text[], $2::bigint[], $3::text[]) AS s(kind, id, data)
+                    ON CONFLICT (kind, id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                ''', *[list(column) for column in zip(*upserts)])
+            if deletes:
+                await conn.execute('''
+                    DELETE FROM bot_state b
+                    USING unnest($1::text[], $2::bigint[]) AS d(kind, id)
+                    WHERE b.kind = d.kind AND b.id = d.id
+                ''', *[list(column) for column in zip(*deletes)])
+
+    async def get_last_md5(self):
+        return await self._fetchone('SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
+
+    async def set_user_language(self, user_id, language_code):
+        async with self._transaction() as conn:
+            await conn.execute("UPDATE assoc SET language = $1 WHERE user_id = $2", language_code, user_id)
+        if self.session_cache:
+            self.session_cache.invalidate(user_id)
+
+    async def get_user_language(self, user_id):
+        result = await self._get_session(user_id)
+        if result:
+            return result[1]
+        else:
+            return None
+
+
+instrument_methods(AsyncDatabaseManager, 'async')
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from phones import phone_key
+
+# Channel of the users trigger from migration 8
+BALANCE_CHANNEL = 'balance_changed'
+
+
+class BalanceCache:
+    """Bounded LRU/TTL cache of phone key (phones.phone_key) -> balance.
+
+    DatabaseManager and AsyncDatabaseManager consult it in get_balance, so
+    '+7 999...' and '7999...' share one entry like they share one users row.
+    Entries are dropped when the users trigger announces a change over
+    NOTIFY balance_changed (on_notify), which covers approvals from any
+    process and manual edits alike; the TTL only bounds staleness while the
+    listener is reconnecting.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        # Same race guard as SessionCache: a read that overlapped a change must not repopulate
+        self._generation = 0
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                balance, expires = entry
+                if expires > monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return balance
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, balance, generation):
+        with self.lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (balance, monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self.lock:
+            self._generation += 1
+            self.invalidations += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self._generation += 1
+            self.invalidations += 1
+            self._entries.clear()
+
+    def on_notify(self, payload):
+        # Payload is a comma separated list of phone keys (migration 11), or '*' after a bulk change;
+        # phone_key() also turns phones sent by the older trigger into keys
+        if payload == '*' or not payload:
+            self.clear()
+        else:
+            self.invalidate([phone_key(phone) for phone in payload.split(',')])
+
+    def get_statistics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
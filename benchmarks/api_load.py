@@ -0,0 +1,162 @@
+"""Requests per second and latency of the waitress API vs the ASGI API.
+
+Seeds --pending pending actions and a known ledger head into a scratch
+database, starts each server in its own process and drives it from
+--client-processes processes with --concurrency requests in flight for
+--duration seconds. The mix is authenticated GET /pending pages, GET
+/lastkey and POST /remove on ids that do not exist, so the data stays the
+same between runs.
+
+    python -m benchmarks.api_load --concurrency 64 --duration 10
+"""
+import argparse
+import asyncio
+import hashlib
+import multiprocessing
+import random
+import time
+
+import httpx
+import psycopg2
+
+from benchmarks.common import db_params_from_env, report, summarize
+from migrations import migrate
+
+KEY = 'benchmark-api-load-key'
+COMMENT = 'benchmark api_load'
+# Outbox sends are never triggered, but point them somewhere harmless anyway
+TELEGRAM_API_URL = 'http://127.0.0.1:9'
+
+
+def seed(db_params, pending):
+    conn = psycopg2.connect(**db_params)
+    with conn, conn.cursor() as cursor:
+        cursor.execute('DELETE FROM pending_actions WHERE comment = %s', (COMMENT,))
+        cursor.execute('''
+            INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, comment)
+            SELECT '+7999' || lpad((i %% 1000)::text, 7, '0'), '+7998' || lpad((i %% 1000)::text, 7, '0'), i %% 100, %s
+            FROM generate_series(1, %s) AS i
+        ''', (COMMENT, pending))
+        # The servers authenticate against the newest actions row
+        cursor.execute('''
+            INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5, comment)
+            VALUES ('+70000000000', '+70000000000', 0, %s, %s)
+        ''', (hashlib.md5(KEY.encode()).hexdigest(), COMMENT))
+    conn.close()
+
+
+def cleanup(db_params):
+    conn = psycopg2.connect(**db_params)
+    with conn, conn.cursor() as cursor:
+        cursor.execute('DELETE FROM pending_actions WHERE comment = %s', (COMMENT,))
+    conn.close()
+
+
+def serve(server, port, pool_size, threads, telegram_api_url=TELEGRAM_API_URL):
+    db_params = db_params_from_env()
+    if server == 'waitress':
+        from api import API
+        from database import DatabaseManager
+        API('0:bench', DatabaseManager(db_params, pool_size=(1, pool_size)), telegram_api_url=telegram_api_url).run(
+            host='127.0.0.1', port=port, threads=threads)
+    else:
+        from asgi_api import AsyncAPI
+        from async_database import AsyncDatabaseManager
+        from database import DatabaseManager
+        AsyncAPI(
+            '0:bench',
+            AsyncDatabaseManager(db_params, pool_size=(1, pool_size)),
+            DatabaseManager(db_params, pool_size=(1, 5)),
+            telegram_api_url=telegram_api_url,
+        ).run(host='127.0.0.1', port=port)
+
+
+def request_mix(client, base_url):
+    choice = random.random()
+    if choice < 0.6:
+        return client.get(f'{base_url}/pending', params={'md5': KEY, 'limit': 50})
+    if choice < 0.8:
+        return client.get(f'{base_url}/lastkey')
+    return client.post(f'{base_url}/remove/{random.randint(2 ** 30, 2 ** 31 - 1)}', json={'md5': KEY})
+
+
+async def drive(base_url, concurrency, duration):
+    samples = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await request_mix(client, base_url)
+                    if response.status_code not in (200, 400):
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                samples.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, errors
+
+
+def client_process(args):
+    base_url, concurrency, duration = args
+    return asyncio.run(drive(base_url, concurrency, duration))
+
+
+def wait_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f'{base_url}/lastkey', timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'{base_url} did not come up')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--servers', nargs='+', default=['waitress', 'asgi'], choices=['waitress', 'asgi'])
+    parser.add_argument('--pending', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--client-processes', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--waitress-threads', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5050)
+    args = parser.parse_args()
+
+    db_params = db_params_from_env()
+    migrate(db_params)
+    seed(db_params, args.pending)
+
+    results = []
+    try:
+        for server in args.servers:
+            process = multiprocessing.Process(target=serve, args=(server, args.port, args.pool_size, args.waitress_threads))
+            process.start()
+            base_url = f'http://127.0.0.1:{args.port}'
+            try:
+                wait_ready(base_url)
+                per_process = max(1, args.concurrency // args.client_processes)
+                with multiprocessing.Pool(args.client_processes) as pool:
+                    runs = pool.map(client_process, [(base_url, per_process, args.duration)] * args.client_processes)
+                samples = [sample for run_samples, _ in runs for sample in run_samples]
+                result = summarize(server, samples, args.duration)
+                result['errors'] = sum(errors for _, errors in runs)
+                results.append(result)
+            finally:
+                process.terminate()
+                process.join()
+    finally:
+        cleanup(db_params)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
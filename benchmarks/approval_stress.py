@@ -0,0 +1,254 @@
+"""Concurrent approvals from many processes: no double spend, no ledger fork.
+
+Seeds --pending pending actions and a ledger, then starts --processes
+worker processes, alternating DatabaseManager (--tasks threads on a pool)
+and AsyncDatabaseManager (--tasks tasks), each with its own connections,
+like separate API instances. Every worker reads the ledger head, picks one
+of the --window lowest pending ids it has not seen go away and approves it
+with the key that continues the chain, so workers keep colliding on the
+same rows and the same head. A --fork-rate share of the attempts replay
+the key of the current head instead, which must be refused.
+
+When the pending actions are gone it checks that:
+- no pending action was approved twice and every seeded one was approved,
+- the ledger grew by exactly the approvals and stays one md5 chain,
+- every balance moved by exactly its approved transfers.
+
+Prints the report and exits 1 on any violation.
+
+    python -m benchmarks.approval_stress --processes 8 --tasks 4 --pending 2000
+"""
+import argparse
+import asyncio
+import hashlib
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+import psycopg2
+
+from benchmarks.common import db_params_from_env, report
+from benchmarks.seed import COMMENT, PHONE_PREFIX, cleanup, seed
+from migrations import migrate
+
+STATUSES = ('approved', 'not_found', 'auth_failed')
+
+
+def md5(key):
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+class Attempts:
+    """One worker's view: the ids it saw leave pending_actions and what it approved."""
+
+    def __init__(self, pending_ids, keys, window, fork_rate):
+        self.pending_ids = pending_ids
+        # head md5 -> the key that continues the chain from it
+        self.next_key = {md5(key): key for key in keys}
+        self.keys = keys
+        self.window = window
+        self.fork_rate = fork_rate
+        self.gone = set()
+        self.approved = []
+        self.forks_approved = []
+        self.statuses = Counter()
+        self.lock = threading.Lock()
+
+    def next(self, head):
+        """(id, md5, is_fork) to try next, None when nothing is left."""
+        key = self.next_key.get(head)
+        if key is None:
+            # The chain is used up: every seeded pending action went through
+            return None
+        with self.lock:
+            candidates = []
+            for id in self.pending_ids:
+                if id not in self.gone:
+                    candidates.append(id)
+                    if len(candidates) == self.window:
+                        break
+        if not candidates:
+            return None
+        if random.random() < self.fork_rate:
+            # Replaying the key that made the current head would start a second branch
+            position = self.keys.index(key)
+            if position > 0:
+                return random.choice(candidates), self.keys[position - 1], True
+        return random.choice(candidates), key, False
+
+    def record(self, id, status, fork):
+        with self.lock:
+            self.statuses[status] += 1
+            if status == 'approved':
+                self.approved.append(id)
+                if fork:
+                    self.forks_approved.append(id)
+            if status in ('approved', 'not_found'):
+                self.gone.add(id)
+
+    def result(self):
+        return {'approved': self.approved, 'forks_approved': self.forks_approved, 'statuses': dict(self.statuses)}
+
+
+def sync_worker(db_params, attempts, tasks):
+    from database import DatabaseManager
+    db = DatabaseManager(db_params, pool_size=(1, tasks))
+
+    def run():
+        while True:
+            head = db.get_last_md5()
+            attempt = attempts.next(head[0] if head else None)
+            if attempt is None:
+                return
+            id, key, fork = attempt
+            status, _ = db.apply_pending_action(id, key)
+            attempts.record(id, status, fork)
+
+    threads = [threading.Thread(target=run) for _ in range(tasks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+async def async_worker(db_params, attempts, tasks):
+    from async_database import AsyncDatabaseManager
+    db = AsyncDatabaseManager(db_params, pool_size=(1, tasks))
+    await db.connect()
+
+    async def run():
+        while True:
+            head = await db.get_last_md5()
+            attempt = attempts.next(head[0] if head else None)
+            if attempt is None:
+                return
+            id, key, fork = attempt
+            status, _ = await db.apply_pending_action(id, key)
+            attempts.record(id, status, fork)
+
+    try:
+        await asyncio.gather(*(run() for _ in range(tasks)))
+    finally:
+        await db.close()
+
+
+def worker(args):
+    index, db_params, pending_ids, keys, tasks, window, fork_rate = args
+    attempts = Attempts(pending_ids, keys, window, fork_rate)
+    if index % 2:
+        asyncio.run(async_worker(db_params, attempts, tasks))
+    else:
+        sync_worker(db_params, attempts, tasks)
+    return attempts.result()
+
+
+def snapshot(db_params, pending_ids):
+    conn = psycopg2.connect(**db_params)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT id, user_phone_number, receiver_phone_number, amount
+                FROM pending_actions WHERE id = ANY(%s)
+            ''', (pending_ids,))
+            pending = {id: (sender, receiver, amount) for id, sender, receiver, amount in cursor.fetchall()}
+            cursor.execute('SELECT phone_number, balance FROM users WHERE phone_number LIKE %s', (PHONE_PREFIX + '%',))
+            balances = dict(cursor.fetchall())
+            cursor.execute('SELECT md5 FROM actions WHERE comment = %s ORDER BY id', (COMMENT,))
+            chain = [md5 for md5, in cursor.fetchall()]
+    finally:
+        conn.close()
+    return pending, balances, chain
+
+
+def check(before, after, approved, forks_approved):
+    pending, balances, chain = before
+    pending_after, balances_after, chain_after = after
+    violations = []
+
+    counts = Counter(approved)
+    twice = sorted(id for id, count in counts.items() if count > 1)
+    if twice:
+        violations.append(f'{len(twice)} pending actions approved more than once, e.g. {twice[:5]}')
+    if forks_approved:
+        violations.append(f'{len(forks_approved)} approvals with a replayed key, e.g. {forks_approved[:5]}')
+    if pending_after:
+        violations.append(f'{len(pending_after)} pending actions left unapproved')
+    unknown = set(counts) - set(pending)
+    if unknown:
+        violations.append(f'Approved ids that were never seeded: {sorted(unknown)[:5]}')
+
+    added = len(chain_after) - len(chain)
+    if chain_after[:len(chain)] != chain:
+        violations.append('The seeded ledger rows changed')
+    if added != len(approved):
+        violations.append(f'{added} ledger rows added for {len(approved)} approvals')
+    broken = [n for n in range(1, len(chain_after)) if md5(chain_after[n]) != chain_after[n - 1]]
+    if broken:
+        violations.append(f'Ledger chain broken at {len(broken)} rows, first at position {broken[0]}')
+
+    expected = dict(balances)
+    for id in set(counts) & set(pending):
+        sender, receiver, amount = pending[id]
+        expected[sender] -= amount * counts[id]
+        expected[receiver] += amount * counts[id]
+    wrong = sorted(phone for phone in expected if balances_after.get(phone) != expected[phone])
+    if wrong:
+        violations.append(f'{len(wrong)} balances differ from their approved transfers, e.g. {wrong[:5]}')
+    if sum(balances_after.values()) != sum(balances.values()):
+        violations.append(f'Total balance changed from {sum(balances.values())} to {sum(balances_after.values())}')
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--tasks', type=int, default=4, help='concurrent approvals per process')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--pending', type=int, default=2000)
+    parser.add_argument('--ledger', type=int, default=10)
+    parser.add_argument('--window', type=int, default=4, help='how many of the lowest pending ids workers pick from')
+    parser.add_argument('--fork-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    db_params = db_params_from_env()
+    migrate(db_params)
+    seeded = seed(db_params, args.users, args.pending, args.ledger, approvals=args.pending, seed=args.seed)
+    pending_ids, keys = seeded['pending_ids'], seeded['approval_keys']
+    try:
+        before = snapshot(db_params, pending_ids)
+        started = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(worker, [
+                (index, db_params, pending_ids, keys, args.tasks, args.window, args.fork_rate)
+                for index in range(args.processes)
+            ])
+        elapsed = time.perf_counter() - started
+        after = snapshot(db_params, pending_ids)
+    finally:
+        cleanup(db_params)
+
+    approved = [id for result in results for id in result['approved']]
+    forks_approved = [id for result in results for id in result['forks_approved']]
+    statuses = Counter()
+    for result in results:
+        statuses.update(result['statuses'])
+    violations = check(before, after, approved, forks_approved)
+    report({
+        'processes': args.processes,
+        'tasks': args.tasks,
+        'pending': len(pending_ids),
+        'attempts': sum(statuses.values()),
+        'statuses': {status: statuses[status] for status in STATUSES},
+        'approvals_per_second': len(approved) / elapsed if elapsed else 0.0,
+        'violations': violations,
+    })
+    if violations:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
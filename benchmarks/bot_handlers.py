@@ -0,0 +1,121 @@
+"""Concurrent handler latency with blocking vs native async database access.
+
+Seeds --users users into a scratch database, then pushes --updates fake
+"balance" button presses, arriving as one burst, through
+TelegramBot.keyboard_handler with up to --concurrency in flight. The
+blocking variant calls DatabaseManager inline, exactly like the handlers did
+before AsyncDatabaseManager, so every query stalls the event loop. --slow-ms
+adds pg_sleep to each call to model a slow query.
+
+    python -m benchmarks.bot_handlers --users 1000 --updates 2000 --slow-ms 5
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from async_database import AsyncDatabaseManager
+from benchmarks.common import db_params_from_env, report, summarize, use_repo_translations
+from benchmarks.fakes import FakeContext, callback_update
+from bot import TelegramBot
+from database import DatabaseManager
+from migrations import migrate
+
+
+class BlockingDatabase:
+    # Exposes DatabaseManager through awaitables that block the loop while they run
+    def __init__(self, db, slow_ms):
+        self._db = db
+        self._slow = slow_ms / 1000
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def __getattr__(self, name):
+        method = getattr(self._db, name)
+
+        async def call(*args, **kwargs):
+            if self._slow:
+                with self._db._transaction() as cursor:
+                    cursor.execute('SELECT pg_sleep(%s)', (self._slow,))
+            return method(*args, **kwargs)
+        return call
+
+
+class SlowAsyncDatabase(AsyncDatabaseManager):
+    def __init__(self, db_params, pool_size, slow_ms):
+        super().__init__(db_params, pool_size=pool_size)
+        self._slow = slow_ms / 1000
+
+    async def _fetchone(self, query, *args):
+        if self._slow:
+            async with self.pool.acquire() as conn:
+                await conn.execute('SELECT pg_sleep($1)', self._slow)
+        return await super()._fetchone(query, *args)
+
+
+def seed(db, users):
+    with db._transaction() as cursor:
+        cursor.execute("DELETE FROM assoc WHERE phone_number LIKE '+7999%%'")
+        cursor.execute("DELETE FROM users WHERE phone_number LIKE '+7999%%'")
+        cursor.execute('''
+            INSERT INTO users (phone_number, balance)
+            SELECT '+7999' || lpad(i::text, 7, '0'), 100 FROM generate_series(1, %s) AS i
+        ''', (users,))
+        cursor.execute('''
+            INSERT INTO assoc (user_id, phone_number)
+            SELECT 1000000000 + i, '+7999' || lpad(i::text, 7, '0') FROM generate_series(1, %s) AS i
+        ''', (users,))
+
+
+async def drive(name, bot, users, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def one():
+        user_id = 1000000000 + random.randint(1, users)
+        async with semaphore:
+            await bot.keyboard_handler(callback_update(user_id, 'balance'), FakeContext(user_id))
+            # The whole burst arrives at once, so latency includes time queued behind a blocked loop
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(updates)))
+    return summarize(name, samples, time.perf_counter() - started)
+
+
+async def run(args):
+    use_repo_translations()
+    db_params = db_params_from_env()
+    migrate(db_params)
+    sync_db = DatabaseManager(db_params)
+    seed(sync_db, args.users)
+
+    blocking = TelegramBot('0:bench', BlockingDatabase(sync_db, args.slow_ms))
+    async_db = SlowAsyncDatabase(db_params, (args.concurrency, args.concurrency), args.slow_ms)
+    native = TelegramBot('0:bench', async_db)
+    await async_db.connect()
+    try:
+        results = [
+            await drive('blocking', blocking, args.users, args.updates, args.concurrency),
+            await drive('async', native, args.users, args.updates, args.concurrency),
+        ]
+    finally:
+        await async_db.close()
+    report(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--slow-ms', type=float, default=0.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import json
+import os
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_repo_translations():
+    # Production reads /translations.json; benchmarks use the checked-in copy
+    from translations import catalog
+    catalog.path = os.path.join(REPO_ROOT, 'translations.json')
+    catalog.load()
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(name, samples, elapsed=None):
+    # Latencies are collected in seconds and reported in microseconds
+    result = {
+        'name': name,
+        'calls': len(samples),
+        'mean_us': sum(samples) / len(samples) * 1e6 if samples else 0.0,
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p99_us': percentile(samples, 99) * 1e6,
+    }
+    if elapsed:
+        result['throughput'] = len(samples) / elapsed
+    return result
+
+
+def measure(name, func, calls):
+    samples = []
+    started = time.perf_counter()
+    for _ in range(calls):
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+    return summarize(name, samples, time.perf_counter() - started)
+
+
+def report(results):
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+def db_params_from_env():
+    # Benchmarks run against a scratch database, never the production config
+    return {
+        'host': os.environ.get('BENCH_DB_HOST', '127.0.0.1'),
+        'port': os.environ.get('BENCH_DB_PORT', '5432'),
+        'database': os.environ.get('BENCH_DB_NAME', 'postgres'),
+        'user': os.environ.get('BENCH_DB_USER', 'postgres'),
+        'password': os.environ.get('BENCH_DB_PASSWORD', ''),
+    }
@@ -0,0 +1,47 @@
+"""Minimal stand-ins for telegram Update/CallbackContext objects.
+
+Handlers only touch a handful of attributes, so these are enough to drive
+them without a Telegram connection.
+"""
+from types import SimpleNamespace
+
+
+class FakeMessage:
+    def __init__(self, chat_id, text=None, contact=None, from_user=None):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.text = text
+        self.contact = contact
+        self.from_user = from_user or SimpleNamespace(id=chat_id, full_name='Bench', username='bench', language_code='en')
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeCallbackQuery:
+    def __init__(self, user_id, data):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = FakeMessage(user_id)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+class FakeContext:
+    def __init__(self, user_id, user_data=None):
+        self._user_id = user_id
+        self.user_data = user_data if user_data is not None else {}
+
+
+def message_update(user_id, text):
+    message = FakeMessage(user_id, text=text)
+    return SimpleNamespace(message=message, callback_query=None, effective_user=message.from_user)
+
+
+def callback_update(user_id, data):
+    query = FakeCallbackQuery(user_id, data)
+    return SimpleNamespace(message=None, callback_query=query, effective_user=query.from_user)
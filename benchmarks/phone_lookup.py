@@ -0,0 +1,74 @@
+"""Phone lookup latency and index size on a seeded users table.
+
+Builds a throwaway copy of the users table in its own schema, seeds --users
+rows and times random get_balance-style lookups without an index, with
+migration 2's unique phone_number index and with migration 10's unique
+BIGINT phone_key index, then reports the size of both indexes. The
+unindexed pass only runs --lookups / 100 queries, since each one is a full
+scan.
+
+    python -m benchmarks.phone_lookup --users 1000000 --lookups 2000
+"""
+import argparse
+import random
+
+import psycopg2
+
+from benchmarks.common import db_params_from_env, measure, report
+from phones import phone_key
+
+SCHEMA = 'bench_phone_lookup'
+
+
+def phone(i):
+    return '+7999' + str(i).zfill(7)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**db_params_from_env())
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    cursor.execute(f'CREATE SCHEMA {SCHEMA}')
+    cursor.execute(f'SET search_path TO {SCHEMA}')
+    try:
+        cursor.execute('CREATE TABLE users (id SERIAL PRIMARY KEY, phone_number TEXT NOT NULL, balance BIGINT NOT NULL, info TEXT, phone_key BIGINT)')
+        cursor.execute('''
+            INSERT INTO users (phone_number, balance, phone_key)
+            SELECT '+7999' || lpad(i::text, 7, '0'), 0, ('7999' || lpad(i::text, 7, '0'))::bigint
+            FROM generate_series(1, %s) AS i
+        ''', (args.users,))
+        cursor.execute('ANALYZE users')
+
+        def lookup():
+            cursor.execute('SELECT balance FROM users WHERE phone_number=%s', (phone(random.randint(1, args.users)),))
+            cursor.fetchone()
+
+        results = [measure('seq_scan', lookup, max(1, args.lookups // 100))]
+        cursor.execute('CREATE UNIQUE INDEX CONCURRENTLY users_phone_number_key ON users (phone_number)')
+        cursor.execute('ANALYZE users')
+        results.append(measure('unique_index', lookup, args.lookups))
+
+        def lookup_key():
+            cursor.execute('SELECT balance FROM users WHERE phone_key=%s', (phone_key(phone(random.randint(1, args.users))),))
+            cursor.fetchone()
+
+        cursor.execute('CREATE UNIQUE INDEX CONCURRENTLY users_phone_key_key ON users (phone_key)')
+        cursor.execute('ANALYZE users')
+        results.append(measure('unique_key_index', lookup_key, args.lookups))
+        cursor.execute("SELECT pg_relation_size('users_phone_number_key'), pg_relation_size('users_phone_key_key')")
+        text_bytes, key_bytes = cursor.fetchone()
+        results.append({'name': 'index_size', 'phone_number_bytes': text_bytes, 'phone_key_bytes': key_bytes})
+        report(results)
+    finally:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""POST recorded Telegram updates to a webhook-mode bot.
+
+Reads one update JSON object per line (the "result" items of getUpdates, or
+what a webhook received) and sends each to the receiver with the secret
+token header, --concurrency at a time. Run the bot with BOT_MODE = "webhook"
+and, to keep it off the real Bot API, point its base_url at
+benchmarks.stub_telegram.
+
+    python -m benchmarks.replay_webhook updates.ndjson --url http://127.0.0.1:8443/telegram --secret s3cret
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from benchmarks.common import report, summarize
+from webhook import SECRET_TOKEN_HEADER
+
+
+async def replay(updates, url, secret, concurrency):
+    samples = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(headers={SECRET_TOKEN_HEADER: secret}, timeout=30) as client:
+        async def post(update):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(url, json=update)
+                samples.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+    return samples, statuses, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('updates', help='file with one update JSON object per line')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--concurrency', type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.updates, encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    samples, statuses, elapsed = asyncio.run(replay(updates, args.url, args.secret, args.concurrency))
+    result = summarize('webhook_replay', samples, elapsed)
+    result['statuses'] = statuses
+    report([result])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Deterministic benchmark data: users, linked Telegram accounts, pending actions and an md5-chained ledger.
+
+Everything seeded here is recognisable (phones +7977..., user ids above
+FIRST_USER_ID, comment COMMENT), so cleanup() removes exactly that and
+the same --seed always produces the same rows and keys. Run it against a
+scratch database only: the seeded ledger does not link to whatever chain
+was there before.
+
+    python -m benchmarks.seed --users 10000 --pending 5000 --ledger 100000
+    python -m benchmarks.seed --cleanup
+"""
+import argparse
+import hashlib
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from benchmarks.common import db_params_from_env, report
+from migrations import migrate
+
+PHONE_PREFIX = '+7977'
+FIRST_USER_ID = 977000000
+COMMENT = 'benchmark suite'
+
+
+def phone(i):
+    return f'{PHONE_PREFIX}{i:07d}'
+
+
+def key_chain(length, seed):
+    """
+    `length` ledger keys in insertion order: md5(keys[i + 1]) == keys[i],
+    which is what API.auth expects of consecutive approvals.
+    """
+    keys = [f'benchmark-suite-{seed}']
+    for _ in range(length - 1):
+        keys.append(hashlib.md5(keys[-1].encode()).hexdigest())
+    keys.reverse()
+    return keys
+
+
+def seed(db_params, users, pending, ledger, approvals=0, seed=1):
+    """
+    Seed the data and return {'pending_ids': [...], 'approval_keys': [...]}:
+    the ids of the seeded pending actions and `approvals` keys that continue
+    the seeded ledger, to be used in that order.
+    """
+    if users < 2 or ledger < 1:
+        raise ValueError("Need at least 2 users and a ledger of at least 1 action")
+    cleanup(db_params)
+    keys = key_chain(ledger + approvals, seed)
+    conn = psycopg2.connect(**db_params)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO users (phone_number, balance)
+                SELECT %s || lpad(i::text, 7, '0'), 1000 FROM generate_series(1, %s) AS i
+            ''', (PHONE_PREFIX, users))
+            # Half the users speak each language, so both catalogs are exercised
+            cursor.execute('''
+                INSERT INTO assoc (user_id, phone_number, language)
+                SELECT %s + i, %s || lpad(i::text, 7, '0'), CASE WHEN i %% 2 = 0 THEN 'ru' ELSE 'en' END
+                FROM generate_series(1, %s) AS i
+            ''', (FIRST_USER_ID, PHONE_PREFIX, users))
+            cursor.execute('''
+                INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, comment)
+                SELECT %s || lpad((i %% %s + 1)::text, 7, '0'), %s || lpad(((i + 1) %% %s + 1)::text, 7, '0'), i %% 50 + 1, %s
+                FROM generate_series(1, %s) AS i
+                ORDER BY i
+                RETURNING id
+            ''', (PHONE_PREFIX, users, PHONE_PREFIX, users, COMMENT, pending))
+            pending_ids = sorted(id for id, in cursor.fetchall())
+            execute_values(cursor, '''
+                INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5, comment) VALUES %s
+            ''', [
+                (phone(i % users + 1), phone((i + 1) % users + 1), i % 50 + 1, key, COMMENT)
+                for i, key in enumerate(keys[:ledger])
+            ], page_size=10000)
+    finally:
+        conn.close()
+    return {'pending_ids': pending_ids, 'approval_keys': keys[ledger:]}
+
+
+def cleanup(db_params):
+    conn = psycopg2.connect(**db_params)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute('DELETE FROM outbox WHERE chat_id > %s AND chat_id < %s', (FIRST_USER_ID, FIRST_USER_ID + 10 ** 6))
+            cursor.execute('DELETE FROM bot_state WHERE id > %s AND id < %s', (FIRST_USER_ID, FIRST_USER_ID + 10 ** 6))
+            cursor.execute('DELETE FROM assoc WHERE user_id > %s AND user_id < %s', (FIRST_USER_ID, FIRST_USER_ID + 10 ** 6))
+            cursor.execute('DELETE FROM pending_actions WHERE comment = %s', (COMMENT,))
+            cursor.execute('DELETE FROM actions WHERE comment = %s', (COMMENT,))
+            cursor.execute("DELETE FROM users WHERE phone_number LIKE %s AND length(phone_number) = 12", (PHONE_PREFIX + '%',))
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--pending', type=int, default=5000)
+    parser.add_argument('--ledger', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cleanup', action='store_true', help='only remove previously seeded data')
+    args = parser.parse_args()
+
+    db_params = db_params_from_env()
+    migrate(db_params)
+    if args.cleanup:
+        cleanup(db_params)
+        return
+    seeded = seed(db_params, args.users, args.pending, args.ledger, seed=args.seed)
+    report({'users': args.users, 'pending': len(seeded['pending_ids']), 'ledger': args.ledger})
+
+
+if __name__ == '__main__':
+    main()
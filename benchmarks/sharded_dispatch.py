@@ -0,0 +1,124 @@
+"""Bot throughput with 1, 2, 4 ... sharded worker processes.
+
+Seeds --users registered users into a scratch database, starts a
+ShardedBot with each worker count in turn against benchmarks.stub_telegram,
+pushes --updates "balance" button presses from those users through the
+dispatcher as fast as the queues take them and waits until every worker
+has processed its share. Reports updates per second and the deepest worker
+queue seen. Persistence is off so only update handling is measured.
+
+    python -m benchmarks.sharded_dispatch --workers 1 2 4 --updates 5000
+"""
+import argparse
+import asyncio
+import time
+
+import psycopg2
+from telegram import Update
+
+from benchmarks.common import db_params_from_env, report, use_repo_translations
+from benchmarks.stub_telegram import StubTelegram
+from migrations import migrate
+
+FIRST_USER_ID = 910000000
+
+
+def seed(db_params, users):
+    conn = psycopg2.connect(**db_params)
+    with conn, conn.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO users (phone_number, balance)
+            SELECT '+7910' || lpad(i::text, 7, '0'), 100 FROM generate_series(1, %s) AS i
+            ON CONFLICT DO NOTHING
+        ''', (users,))
+        cursor.execute('''
+            INSERT INTO assoc (user_id, phone_number, language)
+            SELECT %s + i, '+7910' || lpad(i::text, 7, '0'), 'en' FROM generate_series(1, %s) AS i
+            ON CONFLICT DO NOTHING
+        ''', (FIRST_USER_ID, users))
+    conn.close()
+
+
+def cleanup(db_params, users):
+    conn = psycopg2.connect(**db_params)
+    with conn, conn.cursor() as cursor:
+        cursor.execute('DELETE FROM assoc WHERE user_id > %s AND user_id <= %s', (FIRST_USER_ID, FIRST_USER_ID + users))
+        cursor.execute("DELETE FROM users WHERE phone_number LIKE '+7910%%' AND length(phone_number) = 12")
+    conn.close()
+
+
+def balance_press(update_id, user_id, bot):
+    return Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'chat_instance': '1', 'data': 'balance',
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': 'x'},
+        },
+    }, bot)
+
+
+async def drive(sharded, updates, users):
+    max_depth = 0
+    started = time.perf_counter()
+    for i in range(updates):
+        await sharded.dispatch(balance_press(i + 1, FIRST_USER_ID + 1 + i % users, sharded.bot))
+    while True:
+        statistics = sharded.get_statistics()
+        max_depth = max(max_depth, *(worker['queue_depth'] for worker in statistics))
+        if sum(worker['processed'] for worker in statistics) >= updates:
+            break
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - started, max_depth, statistics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent updates per worker')
+    parser.add_argument('--telegram-delay-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    use_repo_translations()
+    db_params = db_params_from_env()
+    migrate(db_params)
+    seed(db_params, args.users)
+    stub = StubTelegram(delay=args.telegram_delay_ms / 1000).start()
+
+    from async_database import AsyncDatabaseManager
+    from bot import TelegramBot
+    from sharded import ShardedBot
+
+    def make_bot():
+        return TelegramBot(
+            '1:bench', AsyncDatabaseManager(db_params, pool_size=(1, 5)),
+            max_concurrent_updates=args.concurrency, base_url=stub.url + '/bot', persistence_flush_interval=None,
+            user_rate=None, max_update_age=None,
+        )
+
+    results = []
+    try:
+        for workers in args.workers:
+            sharded = ShardedBot(make_bot, '1:bench', workers=workers, base_url=stub.url + '/bot')
+            sharded.start_workers()
+            try:
+                elapsed, max_depth, statistics = asyncio.run(drive(sharded, args.updates, args.users))
+            finally:
+                sharded.stop_workers()
+            results.append({
+                'name': f'{workers}_workers',
+                'updates': args.updates,
+                'throughput': args.updates / elapsed,
+                'max_queue_depth': max_depth,
+                'processed_per_worker': [worker['processed'] for worker in statistics],
+            })
+    finally:
+        stub.stop()
+        cleanup(db_params, args.users)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Local stand-in for the Telegram Bot API.
+
+Answers every /bot<token>/<method> call with {"ok": true}, records the
+calls, and can be told to answer with flood-control 429s or a fixed delay,
+so notification senders can be exercised without a real bot.
+
+    python -m benchmarks.stub_telegram --port 8081
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Bot clients drop idle keep-alive connections on shutdown; that is not worth a traceback
+        if not issubclass(sys.exc_info()[0], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubTelegram:
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self.fail_next = 0
+        self.retry_after = 1
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                # requests-based senders post JSON, python-telegram-bot posts forms
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    body = json.loads(raw or b'{}')
+                else:
+                    body = dict(parse_qsl(raw.decode()))
+                status, payload = stub._answer(self.path.rsplit('/', 1)[-1], body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+        self.server = _Server((host, port), Handler)
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+        self._thread = None
+
+    def _answer(self, method, body):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.calls.append((time.monotonic(), method, body))
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                             'parameters': {'retry_after': self.retry_after}}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}}
+        if method in ('sendMessage', 'editMessageText'):
+            return 200, {'ok': True, 'result': {
+                'message_id': len(self.calls), 'date': int(time.time()),
+                'chat': {'id': body.get('chat_id', 0), 'type': 'private'}, 'text': body.get('text', ''),
+            }}
+        return 200, {'ok': True, 'result': True}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+    stub = StubTelegram(port=args.port, delay=args.delay)
+    print(f'Stub Telegram API listening on {stub.url}')
+    stub.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
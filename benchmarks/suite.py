@@ -0,0 +1,356 @@
+"""Release benchmark: bot handlers and API endpoints on seeded data, gated by thresholds.
+
+1. Seeds --users users, --pending pending actions and a --ledger long md5
+   chain with benchmarks.seed (same --seed, same data).
+2. Replays --updates synthetic Telegram updates (balance presses, /start,
+   /language and complete send flows) through a TelegramBot built like
+   main.py's, with the Bot API answered by benchmarks.stub_telegram.
+   Latency runs from putting an update on the queue to its last handler
+   finishing, with at most --in-flight updates queued.
+3. Drives each API server in --servers for --duration seconds:
+   --concurrency clients reading /pending and /lastkey, and one client
+   approving the seeded pending actions one by one along the chain.
+
+Every result has throughput and p50/p99 latency. The JSON report goes to
+stdout (and --output). Results are checked against --thresholds (absolute
+limits per result name, fnmatch patterns allowed) and, with --baseline,
+against an earlier report: throughput may drop and p99 may grow by at most
+--tolerance. Any failed check or error makes the exit status 1.
+
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --baseline bench.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import httpx
+
+from benchmarks.api_load import serve, wait_ready
+from benchmarks.common import db_params_from_env, summarize, use_repo_translations
+from benchmarks.seed import COMMENT, FIRST_USER_ID, phone, seed, cleanup
+from benchmarks.stub_telegram import StubTelegram
+from migrations import migrate
+
+DEFAULT_THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+
+def _message(update_id, user_id, text):
+    message = {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def _callback(update_id, user_id, data):
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': '1', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': 'x'},
+    }}
+
+
+def synthetic_updates(count, users, seed):
+    """
+    [(kind, update dict)] with about `count` updates. Users are taken in a
+    shuffled cycle and a session's updates are consecutive, so a send flow
+    is never interrupted by another button press of the same user.
+    """
+    rng = random.Random(seed)
+    order = list(range(1, users + 1))
+    rng.shuffle(order)
+    updates = []
+    session = 0
+    while len(updates) < count:
+        i = order[session % users]
+        user_id = FIRST_USER_ID + i
+        session += 1
+        choice = rng.random()
+        if choice < 0.6:
+            steps = [('balance', lambda n: _callback(n, user_id, 'balance'))]
+        elif choice < 0.7:
+            steps = [('start', lambda n: _message(n, user_id, '/start'))]
+        elif choice < 0.8:
+            steps = [('language', lambda n: _message(n, user_id, '/language'))]
+        else:
+            receiver = phone(i % users + 1)
+            steps = [
+                ('send', lambda n: _callback(n, user_id, 'send')),
+                ('send', lambda n: _message(n, user_id, receiver)),
+                ('send', lambda n: _message(n, user_id, '5')),
+                ('send', lambda n: _message(n, user_id, COMMENT)),
+            ]
+        for kind, build in steps:
+            updates.append((kind, build(len(updates) + 1)))
+    return updates
+
+
+async def replay_handlers(db_params, stub_url, updates, in_flight, max_concurrent_updates):
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    from async_database import AsyncDatabaseManager
+    from balance_cache import BalanceCache
+    from bot import TelegramBot
+    from session_cache import SessionCache
+
+    # The same caches as main.py, so the numbers match production behaviour
+    bot = TelegramBot(
+        '1:bench',
+        AsyncDatabaseManager(db_params, pool_size=(1, 10), session_cache=SessionCache(), balance_cache=BalanceCache()),
+        max_concurrent_updates=max_concurrent_updates, base_url=stub_url + '/bot', persistence_flush_interval=None,
+        # Synthetic users type far faster than the per-user limit; measure the handlers, not the shedding
+        user_rate=None, max_update_age=None,
+    )
+    bot._add_handlers()
+    window = asyncio.Semaphore(in_flight)
+    enqueued = {}
+    samples = {}
+    errors = []
+    done = asyncio.Event()
+    kinds = {update['update_id']: kind for kind, update in updates}
+    remaining = len(kinds)
+
+    async def finished(update, context):
+        # Group 1 runs after the bot's own handler for the same update
+        nonlocal remaining
+        kind = kinds[update.update_id]
+        samples.setdefault(kind, []).append(time.perf_counter() - enqueued.pop(update.update_id))
+        window.release()
+        remaining -= 1
+        if not remaining:
+            done.set()
+
+    async def failed(update, context):
+        errors.append(repr(context.error))
+
+    bot.application.add_handler(TypeHandler(Update, finished), group=1)
+    bot.application.add_error_handler(failed)
+    elapsed = 0.0
+
+    async def feed():
+        nonlocal elapsed
+        started = time.perf_counter()
+        for _, data in updates:
+            update = Update.de_json(data, bot.application.bot)
+            await window.acquire()
+            enqueued[update.update_id] = time.perf_counter()
+            await bot.application.update_queue.put(update)
+        await asyncio.wait_for(done.wait(), timeout=600)
+        elapsed = time.perf_counter() - started
+
+    await bot._run_application(feed)
+    results = [summarize('handlers', [sample for kind_samples in samples.values() for sample in kind_samples], elapsed)]
+    results[0]['errors'] = len(errors)
+    for kind in sorted(samples):
+        results.append(summarize(f'handlers.{kind}', samples[kind], elapsed))
+    return results
+
+
+async def drive_api(base_url, concurrency, duration, approvals):
+    samples = {'pending': [], 'lastkey': [], 'approve': []}
+    errors = {name: 0 for name in samples}
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency + 1, max_keepalive_connections=concurrency + 1)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def timed(name, request):
+            started = time.perf_counter()
+            try:
+                response = await request
+                if response.status_code != 200:
+                    errors[name] += 1
+            except httpx.HTTPError:
+                errors[name] += 1
+                response = None
+            samples[name].append(time.perf_counter() - started)
+            return response
+
+        async def read_pending():
+            # Reads authenticate against a head the approver keeps moving: keys[approved] matches it,
+            # keys[approved + 1] once the approval in flight commits. A 401 is only an error if the
+            # head stood still; otherwise the read is repeated and only the final attempt is counted.
+            while True:
+                approved = approvals.approved
+                current, following = approvals.reader_keys()
+                started = time.perf_counter()
+                try:
+                    response = await client.get('/pending', params={'md5': current, 'limit': 50})
+                    if response.status_code == 401 and following:
+                        response = await client.get('/pending', params={'md5': following, 'limit': 50})
+                except httpx.HTTPError:
+                    response = None
+                if response is not None and response.status_code == 401 and approvals.approved != approved:
+                    continue
+                if response is None or response.status_code != 200:
+                    errors['pending'] += 1
+                samples['pending'].append(time.perf_counter() - started)
+                return
+
+        async def reader(index):
+            # Alternate so every client exercises both endpoints
+            while time.perf_counter() < deadline:
+                if index % 2:
+                    await timed('lastkey', client.get('/lastkey'))
+                else:
+                    await read_pending()
+                index += 1
+
+        async def approver():
+            # Approvals extend one chain, so they are sequential by nature
+            while time.perf_counter() < deadline and approvals.remaining():
+                id, key = approvals.next()
+                response = await timed('approve', client.post(f'/approve/{id}', json={'md5': key}))
+                if response is None or response.status_code != 200:
+                    # Every later key depends on this one
+                    break
+                approvals.approved += 1
+
+        await asyncio.gather(approver(), *(reader(index) for index in range(concurrency)))
+    return samples, errors
+
+
+class Approvals:
+    # Seeded (pending id, key) pairs, consumed in chain order across all servers
+    def __init__(self, pending_ids, keys):
+        self.pending_ids = pending_ids
+        self.keys = keys
+        self.approved = 0
+
+    def remaining(self):
+        return self.approved < min(len(self.pending_ids), len(self.keys) - 1)
+
+    def next(self):
+        return self.pending_ids[self.approved], self.keys[self.approved]
+
+    def reader_keys(self):
+        # md5 of keys[approved] is the current head; keys[approved + 1] works once the next approval commits
+        following = self.keys[self.approved + 1] if self.approved + 1 < len(self.keys) else None
+        return self.keys[self.approved], following
+
+
+def check(results, thresholds, baseline, tolerance):
+    checks = []
+
+    def add(name, metric, value, limit, ok):
+        checks.append({'name': name, 'metric': metric, 'value': value, 'limit': limit, 'passed': ok})
+
+    previous = {result['name']: result for result in baseline or []}
+    for result in results:
+        name = result['name']
+        if result.get('errors'):
+            add(name, 'errors', result['errors'], 0, False)
+        for pattern, limits in thresholds.items():
+            if not fnmatch.fnmatchcase(name, pattern):
+                continue
+            if 'min_throughput' in limits:
+                add(name, 'throughput', result.get('throughput', 0.0), limits['min_throughput'],
+                    result.get('throughput', 0.0) >= limits['min_throughput'])
+            for metric in ('p50_us', 'p99_us'):
+                if f'max_{metric}' in limits:
+                    add(name, metric, result[metric], limits[f'max_{metric}'], result[metric] <= limits[f'max_{metric}'])
+        if name in previous:
+            before = previous[name]
+            if before.get('throughput'):
+                limit = before['throughput'] * (1 - tolerance)
+                add(name, 'throughput_vs_baseline', result.get('throughput', 0.0), limit, result.get('throughput', 0.0) >= limit)
+            if before.get('p99_us'):
+                limit = before['p99_us'] * (1 + tolerance)
+                add(name, 'p99_us_vs_baseline', result['p99_us'], limit, result['p99_us'] <= limit)
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--pending', type=int, default=5000)
+    parser.add_argument('--ledger', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--parts', nargs='+', default=['handlers', 'api'], choices=['handlers', 'api'])
+    parser.add_argument('--updates', type=int, default=4000)
+    parser.add_argument('--in-flight', type=int, default=64, help='updates queued at once in the handler replay')
+    parser.add_argument('--bot-concurrency', type=int, default=16, help="the bot's max_concurrent_updates")
+    parser.add_argument('--servers', nargs='+', default=['waitress', 'asgi'], choices=['waitress', 'asgi'])
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent API readers')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per API server')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--waitress-threads', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5051)
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('--thresholds', default=DEFAULT_THRESHOLDS, help='JSON {result name pattern: limits}; "" disables')
+    parser.add_argument('--baseline', help='an earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--keep-data', action='store_true', help='leave the seeded rows in place')
+    args = parser.parse_args()
+
+    use_repo_translations()
+    db_params = db_params_from_env()
+    migrate(db_params)
+    # One key per seeded pending action, plus one that keeps authenticating reads after the last approval
+    approvals_needed = args.pending + 1 if 'api' in args.parts else 0
+    seeded = seed(db_params, args.users, args.pending, args.ledger, approvals=approvals_needed, seed=args.seed)
+    stub = StubTelegram().start()
+
+    results = []
+    try:
+        if 'handlers' in args.parts:
+            updates = synthetic_updates(args.updates, args.users, args.seed)
+            results.extend(asyncio.run(replay_handlers(db_params, stub.url, updates, args.in_flight, args.bot_concurrency)))
+
+        if 'api' in args.parts:
+            approvals = Approvals(seeded['pending_ids'], seeded['approval_keys'])
+            for server in args.servers:
+                process = multiprocessing.Process(
+                    target=serve, args=(server, args.port, args.pool_size, args.waitress_threads, stub.url))
+                process.start()
+                base_url = f'http://127.0.0.1:{args.port}'
+                try:
+                    wait_ready(base_url)
+                    samples, errors = asyncio.run(drive_api(base_url, args.concurrency, args.duration, approvals))
+                finally:
+                    process.terminate()
+                    process.join()
+                for name in ('pending', 'lastkey', 'approve'):
+                    result = summarize(f'api.{server}.{name}', samples[name], args.duration)
+                    result['errors'] = errors[name]
+                    results.append(result)
+    finally:
+        stub.stop()
+        if not args.keep_data:
+            cleanup(db_params)
+
+    thresholds = {}
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    checks = check(results, thresholds, baseline, args.tolerance)
+
+    output = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'thresholds', 'baseline')},
+        'results': results,
+        'checks': checks,
+        'passed': all(item['passed'] for item in checks),
+    }
+    text = json.dumps(output, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    sys.exit(0 if output['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
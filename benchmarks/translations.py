@@ -0,0 +1,38 @@
+"""Per-call cost of get_translation: re-reading the file vs the in-memory catalog.
+
+    python -m benchmarks.translations --calls 20000
+"""
+import argparse
+import json
+import os
+
+from benchmarks.common import REPO_ROOT, measure, report
+from translations import TranslationCatalog
+
+
+def legacy_get_translation(path, lang, key, **kwargs):
+    # The pre-catalog implementation: open and parse the file on every call
+    with open(path, 'r') as f:
+        translations = json.load(f)
+    return translations[lang][key].format(**kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=os.path.join(REPO_ROOT, 'translations.json'))
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+
+    catalog = TranslationCatalog(args.path)
+    catalog.load()
+    kwargs = {'amount': 100, 'phone': '+79990000000'}
+
+    report([
+        measure('legacy', lambda: legacy_get_translation(args.path, 'ru', 'transfer_request_sent_key', **kwargs), args.calls),
+        measure('catalog', lambda: catalog.get('ru', 'transfer_request_sent_key', **kwargs), args.calls),
+        measure('catalog_plain', lambda: catalog.get('ru', 'button_balance'), args.calls),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
-import re
 import math
 import asyncio
 from decimal import Decimal
-import requests
-from database import DatabaseManager
+from admin_notifications import AdminNotifier
+from admission import THROTTLED, AdmissionControl, AdmissionQueue
+from async_database import AsyncDatabaseManager
+from balance_cache import BALANCE_CHANNEL
+from listener import AsyncDatabaseListener
+from metrics import start_http_server, timed_handler
+import phones
+from persistence import PostgresPersistence
+from telegram_request import TimedRequest
+from update_processor import PerUserUpdateProcessor
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, KeyboardButton, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CallbackContext,
@@ -27,13 +35,80 @@ default_language_code = 'en'
 
 class TelegramBot:
 
-    def __init__(self, TOKEN: str, db: DatabaseManager):
+    def __init__(self, TOKEN: str, db: AsyncDatabaseManager, admin_notification_window=10.0,
+                 max_concurrent_updates=16, base_url='https://api.telegram.org/bot', persistence_flush_interval=5.0,
+                 metrics_port=None, user_rate=1.0, user_burst=5, max_update_age=30.0):
         self._db = db
-        self.application = Application.builder().token(TOKEN).build()
+        # Prometheus exporter for this process, None disables it
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # Signups are coalesced into digests for the admin group
+        self.admin_notifier = AdminNotifier(TOKENTG_MILITCORP_BOT, MILITCORP_GROUP_ID, window=admin_notification_window, base_url=base_url)
+        # Floods are shed before they reach the handlers: per-user rate limit and a maximum update age
+        self.admission = AdmissionControl(rate=user_rate, burst=user_burst, max_update_age=max_update_age)
+        # Updates of different users run concurrently, each user's in order
+        self.update_processor = PerUserUpdateProcessor(max_concurrent_updates, admission=self.admission, on_shed=self._on_shed)
+        builder = (
+            Application.builder()
+            .token(TOKEN)
+            .update_queue(AdmissionQueue(self.admission))
+            .base_url(base_url)
+            # Same pool sizes as PTB's defaults, with every Bot API call timed
+            .request(TimedRequest(connection_pool_size=256))
+            .get_updates_request(TimedRequest(connection_pool_size=1))
+            .concurrent_updates(self.update_processor)
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+        )
+        # user_data (the send flow state) lives in Postgres; None keeps it in memory only
+        if persistence_flush_interval is not None:
+            builder.persistence(PostgresPersistence(db, flush_interval=persistence_flush_interval))
+        self.application = builder.build()
+        self.listener = None
+
+    async def _post_init(self, application: Application) -> None:
+        # The pool belongs to the bot's own event loop, so it is opened here
+        await self._db.connect()
+        await self.admin_notifier.start()
+        if self.metrics_port is not None:
+            self.metrics_server = start_http_server(self.metrics_port)
+        # Balances change in the API process; the users trigger tells us which
+        if self._db.balance_cache:
+            self.listener = AsyncDatabaseListener(
+                self._db.db_params,
+                {BALANCE_CHANNEL: self._db.balance_cache.on_notify},
+                on_reconnect=self._db.balance_cache.clear,
+            )
+            self.listener.start()
+
+    async def _post_shutdown(self, application: Application) -> None:
+        if self.listener:
+            await self.listener.stop()
+        await self.admin_notifier.stop()
+        await self._db.close()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+
+    def _on_shed(self, update: Update, reason: str) -> None:
+        # Stale updates are dropped silently, their sender has most likely moved on
+        if reason == THROTTLED and self.admission.should_reply(update):
+            self.application.create_task(self._reply_busy(update), update=update)
+
+    async def _reply_busy(self, update: Update) -> None:
+        user_lang = await self._db.get_user_language(update.effective_user.id) or default_language_code
+        text = get_translation(user_lang, 'busy_key')
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text)
+        except TelegramError as e:
+            logger.warning(f"Failed to send busy reply to {update.effective_user.id}: {e}")
 
     async def actions_command(self, update: Update, context: CallbackContext) -> None:
         user_id = update.message.chat.id
-        user_lang = self._db.get_user_language(user_id) or default_language_code
+        user_lang = await self._db.get_user_language(user_id) or default_language_code
         balance_text = get_translation(user_lang, 'button_balance')
         send_text = get_translation(user_lang, 'button_send')
         stats_text = get_translation(user_lang, 'button_stats')
@@ -53,26 +128,19 @@ class TelegramBot:
 
         await update.message.reply_text(actions_message_text, reply_markup=localized_op_markup)
 
-    def send_admin_notification(self, message: str) -> None:
-        url = f"https://api.telegram.org/bot{TOKENTG_MILITCORP_BOT}/sendMessage"
-        payload = {
-            "chat_id": MILITCORP_GROUP_ID,
-            "text": message,
-            "parse_mode": "Markdown"
-        }
-        response = requests.post(url, json=payload)
-        if response.status_code != 200:
-            logger.error(f"Failed to send message: {response.status_code} - {response.text}")
+    def send_admin_notification(self, message: str, compact: str = None) -> None:
+        # Queued only; AdminNotifier sends in the background
+        self.admin_notifier.notify(message, compact)
 
 
     # Command handler for /start command
     async def start(self, update: Update, context: CallbackContext) -> None:
         user_id = update.message.chat.id
-        phone = self._db.get_assoc(user_id)
+        phone = await self._db.get_assoc(user_id)
         user = update.message.from_user
         
         # Определение языка пользователя, если он зарегистрирован, иначе использование языка по умолчанию
-        user_lang = self._db.get_user_language(user_id) if phone else default_language_code
+        user_lang = await self._db.get_user_language(user_id) if phone else default_language_code
 
         # Получение локализованных текстов
         send_phone_text = get_translation(user_lang, 'send_phone_button')
@@ -93,17 +161,12 @@ class TelegramBot:
     # Message handler for receiving phone number
     async def phone_auth(self, update: Update, context: CallbackContext) -> None:
         user_id = update.message.chat.id
-        user_lang = self._db.get_user_language(user_id) or default_language_code
+        user_lang = await self._db.get_user_language(user_id) or default_language_code
         user = update.message.from_user
 
         if update.message.contact:
-            # Функция для очистки номера телефона
-            def clean_phone(phone_number):
-                match = re.findall(r'\d', phone_number)
-                cleaned_number = '+' + ''.join(match)
-                return cleaned_number
-
-            phone_number = clean_phone(update.message.contact.phone_number)
+            # Telegram shares contacts with or without the leading '+'
+            phone_number = phones.normalize(update.message.contact.phone_number)
             contact_id = update.message.contact.user_id
 
             # Переменные для локализации текста
@@ -123,18 +186,34 @@ class TelegramBot:
                 ]
             )
 
-            phone = self._db.get_assoc(user_id)
+            phone = await self._db.get_assoc(user_id)
 
             if phone:
                 await update.message.reply_text(unclear_context_text, reply_markup=localized_op_markup)
             elif not contact_id == user_id:
                 await update.message.reply_text(not_your_contact_text, reply_markup=localized_op_markup)
+            elif not phone_number:
+                # Same answer as a message without a contact
+                await update.message.reply_text(get_translation(user_lang, 'unauthorized_key'))
             else:
                 # Store the user in the database
-                self._db.add_assoc(user_id, phone_number)
+                if not await self._db.add_assoc(user_id, phone_number):
+                    # The number stays with the account that linked it first; moving it is up to the admins
+                    owner = await self._db.get_reverse_assoc(phone_number)
+                    if owner and owner[0] == user_id:
+                        await update.message.reply_text(unclear_context_text, reply_markup=localized_op_markup)
+                    else:
+                        await update.message.reply_text(get_translation(user_lang, 'phone_already_linked'))
+                        self.send_admin_notification(
+                            f"Phone already linked to another account(тел уже привязан к другому аккаунту):\n"
+                            f"ID: `{user.id}`\n"
+                            f"Username: `{user.username}`\n"
+                            f"Phone: `{phone_number}`"
+                        )
+                    return
 
-                if not self._db.get_user(phone_number):
-                    self._db.add_user(phone_number)
+                if not await self._db.get_user(phone_number):
+                    await self._db.add_user(phone_number)
 
                 await update.message.reply_text(number_linked_text, reply_markup=ReplyKeyboardRemove())
                 await update.message.reply_text(phone_auth_message_text, reply_markup=localized_op_markup)
@@ -147,7 +226,9 @@ class TelegramBot:
 					f"Language(Язык юзера в ТГ): `{user.language_code}`\n"
                     f"Phone(предоставленный тел): `{phone_number}`"
                 )
-                self.send_admin_notification(notification_message)
+                # One line per user when several signups end up in one digest
+                compact_message = f"`{user.id}` `{user.full_name}` `{user.username}` {user.language_code} `{phone_number}`"
+                self.send_admin_notification(notification_message, compact_message)
         else:
             # Если контактные данные отсутствуют, отправляем сообщение об ошибке
             error_text = get_translation(user_lang, 'unauthorized_key')
@@ -158,12 +239,12 @@ class TelegramBot:
         query = update.callback_query
         user_id = query.from_user.id
         button_data = query.data
-        user_lang = self._db.get_user_language(user_id) or default_language_code
+        user_lang = await self._db.get_user_language(user_id) or default_language_code
 
         unauthorized_text = get_translation(user_lang, 'unauthorized_key')
         enter_phone_text = get_translation(user_lang, 'input_send_phone')
         unknown_command_text = get_translation(user_lang, 'non_comand')
-        phone = self._db.get_assoc(user_id)
+        phone = await self._db.get_assoc(user_id)
         if not phone:
             await query.message.reply_text(unauthorized_text)
             await query.answer()
@@ -174,7 +255,7 @@ class TelegramBot:
 
         # Check if the pressed button has the callback_data 'button_A'
         if button_data == 'balance':
-            balanc_bcr = self._db.get_balance(phone)[0]
+            balanc_bcr = (await self._db.get_balance(phone[0]))[0]
             balance_check_text = get_translation(user_lang, 'balance_key', balanc_bcr=balanc_bcr)
             await query.message.reply_text(balance_check_text)
         elif button_data == 'send':
@@ -189,22 +270,6 @@ class TelegramBot:
 
     # Message handler for sending balance
     async def send_handler(self, update: Update, context: CallbackContext) -> None:
-        def clean_phone_number(phone_number):
-
-            if not phone_number.startswith("+"):
-                return None
-            
-            if len(phone_number) > 15:
-                return None
-
-            match = re.findall(r'\d', phone_number)
-
-            if match:
-                cleaned_number = '+' + ''.join(match)
-                return cleaned_number
-            else:
-                return None
-
         def clean_int(input_string):
             if len(input_string) > 16:
                 return 0
@@ -227,11 +292,11 @@ class TelegramBot:
             return
 
         user_id = context._user_id
-        user_lang = self._db.get_user_language(user_id) or default_language_code
-        snd_phone = self._db.get_assoc(user_id)
+        user_lang = await self._db.get_user_language(user_id) or default_language_code
+        snd_phone = await self._db.get_assoc(user_id)
         recv_phone = context.user_data.get("phone")
         recv_amount = context.user_data.get("amount")
-        phone = self._db.get_assoc(user_id)
+        phone = await self._db.get_assoc(user_id)
 
         unauthorized_text = get_translation(user_lang, 'unauthorized_key')
         user_not_found_text = get_translation(user_lang, 'user_not_found_key')
@@ -247,9 +312,9 @@ class TelegramBot:
         
         if recv_phone == None:
             # Handling phone
-            phone = clean_phone_number(update.message.text)
+            phone = phones.normalize(update.message.text, require_plus=True)
             if phone:
-                user = self._db.get_user(phone)
+                user = await self._db.get_user(phone)
                 
                 if not user:
                     await update.message.reply_text(user_not_found_text)
@@ -272,10 +337,10 @@ class TelegramBot:
             comment = update.message.text
             context.user_data['phone'] = None
             context.user_data['amount'] = None
-            sender_info = self._db.get_user_info_with_balance(snd_phone[0])
-            receiver_info = self._db.get_user_info_with_balance(recv_phone)
+            sender_info = await self._db.get_user_info_with_balance(snd_phone[0])
+            receiver_info = await self._db.get_user_info_with_balance(recv_phone)
 
-            self._db.create_pending_action(
+            await self._db.create_pending_action(
                 amount=recv_amount,
                 user_phone_number=snd_phone[0],
                 receiver_phone_number=recv_phone,
@@ -305,7 +370,7 @@ class TelegramBot:
                 await update.message.reply_text(text)
             return
 
-        statistics = self._db.get_users_statistics()
+        statistics = await self._db.get_users_statistics()
         if statistics:
             message = (
                     f"`Всего пользователей:`* {statistics['total_users']}*\n"
@@ -332,25 +397,95 @@ class TelegramBot:
         user_id = query.from_user.id
         
         # Сохранение выбранного языка в базе данных
-        self._db.set_user_language(user_id, language_code)
+        await self._db.set_user_language(user_id, language_code)
         
         # Отправка подтверждения пользователю
         language_set_text = get_translation(language_code, 'language_set_key', language_code=language_code) 
         await query.edit_message_text(text=language_set_text)
         await query.answer()
 
-    def run(self):
-
+    def _add_handlers(self):
+        # Every callback is timed under its own name, see metrics.py
         # Add other handlers after the ConversationHandlers
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(CommandHandler("statistics", self.stats_command))
-        self.application.add_handler(CommandHandler("balance_bcr", self.actions_command))
-        self.application.add_handler(CommandHandler("language", self.language_command))
-        self.application.add_handler(MessageHandler(filters.CONTACT, self.phone_auth))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.send_handler))
-        self.application.add_handler(CallbackQueryHandler(self.stats_command, pattern='^get_stats$'))
-        self.application.add_handler(CallbackQueryHandler(self.language_callback_handler, pattern='^(en|ru)$'))
-        self.application.add_handler(CallbackQueryHandler(self.keyboard_handler))
+        self.application.add_handler(CommandHandler("start", timed_handler(self.start)))
+        self.application.add_handler(CommandHandler("statistics", timed_handler(self.stats_command)))
+        self.application.add_handler(CommandHandler("balance_bcr", timed_handler(self.actions_command)))
+        self.application.add_handler(CommandHandler("language", timed_handler(self.language_command)))
+        self.application.add_handler(MessageHandler(filters.CONTACT, timed_handler(self.phone_auth)))
+        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(self.send_handler)))
+        self.application.add_handler(CallbackQueryHandler(timed_handler(self.stats_command), pattern='^get_stats$'))
+        self.application.add_handler(CallbackQueryHandler(timed_handler(self.language_callback_handler), pattern='^(en|ru)$'))
+        self.application.add_handler(CallbackQueryHandler(timed_handler(self.keyboard_handler)))
+
+    def run(self, mode='polling', webhook_listen='0.0.0.0', webhook_port=8443, webhook_path='/telegram',
+            webhook_secret=None, webhook_url=None):
+        self._add_handlers()
 
         # Start the bot
-        self.application.run_polling(allowed_updates=Update.ALL_TYPES)
\ No newline at end of file
+        if mode == 'webhook':
+            asyncio.run(self._run_webhook(webhook_listen, webhook_port, webhook_path, webhook_secret, webhook_url))
+        else:
+            self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+    async def _run_webhook(self, listen, port, path, secret, webhook_url):
+        """
+        Serve Telegram webhooks from our own receiver instead of polling.
+
+        webhook_url is the public https address Telegram should call; when it
+        is None the webhook is not (re)registered, which is what local runs
+        that POST recorded updates want.
+        """
+        import uvicorn
+        from webhook import WebhookReceiver, WebhookServer
+
+        if not secret:
+            raise ValueError("Webhook mode needs a secret token")
+        receiver = WebhookReceiver(self.application.bot, self.application.update_queue.put, secret, url_path=path)
+        server = WebhookServer(uvicorn.Config(receiver.app, host=listen, port=port, log_level='warning'))
+
+        async def serve():
+            if webhook_url:
+                await self.application.bot.set_webhook(
+                    url=webhook_url + path,
+                    secret_token=secret,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            await server.serve()
+
+        await self._run_application(serve)
+
+    async def _run_application(self, serve):
+        # Same lifecycle as run_polling: initialize, post_init, start ... stop, shutdown, post_shutdown
+        await self.application.initialize()
+        await self._post_init(self.application)
+        try:
+            await self.application.start()
+            try:
+                await serve()
+            finally:
+                await self.application.stop()
+        finally:
+            await self.application.shutdown()
+            await self._post_shutdown(self.application)
+
+    def run_worker(self, updates, on_processed=None, metrics_port=None):
+        """
+        Process updates received by a sharded.ShardedBot dispatcher: update
+        dicts arrive on the multiprocessing queue `updates`, None ends the run.
+        metrics_port, when given, replaces the one passed to the constructor,
+        so every worker can export on its own port.
+        """
+        if metrics_port is not None:
+            self.metrics_port = metrics_port
+        self._add_handlers()
+        self.update_processor.on_processed = on_processed
+
+        async def consume():
+            loop = asyncio.get_running_loop()
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    return
+                await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+        asyncio.run(self._run_application(consume))
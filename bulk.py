@@ -0,0 +1,325 @@
+"""Bulk import of users and export of users / the actions ledger through COPY.
+
+Data is streamed in both directions, so memory use does not depend on the
+size of the file. Two formats are supported:
+
+    csv     header line with column names, then one row per line
+    ndjson  one JSON object per line
+
+Importing users is an upsert keyed by the phone's canonical key
+(phones.phone_key), so '+7 999 000-00-00' updates the user stored as
+'+79990000000': new phones are inserted (balance defaults to 0), known ones
+are updated, and a missing or empty value keeps what the user already has.
+When a phone appears more than once, the last row wins; rows whose phone
+has no digits or more than 15 are skipped.
+
+    python bulk.py import-users users.csv
+    python bulk.py export-actions --after-id 1000 --phone +79990000000 --format ndjson -o actions.ndjson
+    python bulk.py export-users -o users.csv
+"""
+import argparse
+import asyncio
+import json
+import logging
+import queue
+import sys
+import threading
+
+from phones import phone_key
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'ndjson')
+
+USER_COLUMNS = (
+    'phone_number', 'balance', 'info', 'mir_karta', 'mir_account', 'balance_mir_karta',
+    'bcr_plast_karta_nomer', 'bcr_plast_karta_srok', 'bcr_plast_karta_cvv',
+)
+ACTION_COLUMNS = ('id', 'user_phone_number', 'receiver_phone_number', 'amount', 'md5', 'comment')
+
+# NDJSON lines go through COPY ... CSV with quote and delimiter characters that
+# cannot occur in JSON text, so every line arrives as one untouched field
+NDJSON_COPY_OPTIONS = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
+
+
+def _check_format(format):
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, expected one of {', '.join(FORMATS)}")
+
+
+def parse_user_header(line):
+    """Column list of a users CSV header line; raises ValueError for unknown columns."""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8-sig')
+    columns = [column.strip().strip('"').lower() for column in line.strip().split(',')]
+    unknown = [column for column in columns if column not in USER_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown users columns: {', '.join(unknown)}")
+    if 'phone_number' not in columns:
+        raise ValueError("users import needs a phone_number column")
+    if len(set(columns)) != len(columns):
+        raise ValueError("Duplicate columns in header")
+    return columns
+
+
+def _create_import_table_sql(format):
+    # pos keeps the file order, so the last row of a repeated phone wins
+    if format == 'ndjson':
+        return 'CREATE TEMP TABLE users_import (pos BIGSERIAL, line TEXT) ON COMMIT DROP'
+    columns = ', '.join(f'{column} TEXT' for column in USER_COLUMNS)
+    return f'CREATE TEMP TABLE users_import (pos BIGSERIAL, {columns}) ON COMMIT DROP'
+
+
+def _upsert_users_sql(format):
+    if format == 'ndjson':
+        fields = ', '.join(f"NULLIF(l->>'{column}', '') AS {column}" for column in USER_COLUMNS)
+        source = f'SELECT pos, {fields} FROM (SELECT pos, line::jsonb AS l FROM users_import) lines'
+    else:
+        source = f"SELECT pos, {', '.join(USER_COLUMNS)} FROM users_import"
+    values = [column for column in USER_COLUMNS if column != 'phone_number']
+    return f'''
+        WITH source AS (
+            SELECT DISTINCT ON (phone_key) *
+            FROM (SELECT s.*, phone_key(s.phone_number) AS phone_key FROM ({source}) s) s
+            WHERE phone_key IS NOT NULL
+            ORDER BY phone_key, pos DESC
+        ),
+        updated AS (
+            UPDATE users u SET
+                balance = COALESCE(s.balance::bigint, u.balance),
+                {', '.join(f'{column} = COALESCE(s.{column}, u.{column})' for column in values if column != 'balance')}
+            FROM source s
+            WHERE u.phone_key = s.phone_key
+            RETURNING u.phone_key
+        ),
+        inserted AS (
+            INSERT INTO users ({', '.join(USER_COLUMNS)})
+            SELECT s.phone_number, COALESCE(s.balance::bigint, 0), {', '.join(f's.{column}' for column in values if column != 'balance')}
+            FROM source s
+            WHERE NOT EXISTS (SELECT 1 FROM updated WHERE updated.phone_key = s.phone_key)
+            ON CONFLICT (phone_key) DO NOTHING
+            RETURNING 1
+        )
+        SELECT (SELECT count(*) FROM users_import), (SELECT count(*) FROM inserted), (SELECT count(*) FROM updated)
+    '''
+
+
+def _actions_query(after_id=None, to_id=None, phone=None, placeholder='%s'):
+    # Returns (query, params); placeholder is '%s' for psycopg2 and '$' for asyncpg
+    conditions = []
+    params = []
+    for condition, value in (('id > ', after_id), ('id <= ', to_id)):
+        if value is not None:
+            params.append(value)
+            conditions.append(condition + (f'${len(params)}' if placeholder == '$' else '%s'))
+    if phone is not None:
+        params.extend([phone_key(phone)] * 2)
+        if placeholder == '$':
+            conditions.append(f'(user_phone_key = ${len(params) - 1} OR receiver_phone_key = ${len(params)})')
+        else:
+            conditions.append('(user_phone_key = %s OR receiver_phone_key = %s)')
+    query = f"SELECT {', '.join(ACTION_COLUMNS)} FROM actions"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query + ' ORDER BY id', params
+
+
+def _users_query():
+    return f"SELECT {', '.join(USER_COLUMNS)} FROM users ORDER BY id"
+
+
+def _copy_out_sql(query, format):
+    if format == 'ndjson':
+        return f'COPY (SELECT row_to_json(r)::text FROM ({query}) r) TO STDOUT WITH ({NDJSON_COPY_OPTIONS})'
+    return f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)'
+
+
+def import_users(db, stream, format='csv'):
+    """
+    Upsert users from a readable binary or text stream. Returns
+    {'rows': lines read, 'inserted': new users, 'updated': existing users}.
+    """
+    _check_format(format)
+    with db._transaction() as cursor:
+        cursor.execute(_create_import_table_sql(format))
+        if format == 'ndjson':
+            cursor.copy_expert(f'COPY users_import (line) FROM STDIN WITH ({NDJSON_COPY_OPTIONS})', stream)
+        else:
+            columns = parse_user_header(stream.readline())
+            cursor.copy_expert(f"COPY users_import ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", stream)
+        cursor.execute(_upsert_users_sql(format))
+        rows, inserted, updated = cursor.fetchone()
+    return {'rows': rows, 'inserted': inserted, 'updated': updated}
+
+
+def export_actions(db, out, format='csv', after_id=None, to_id=None, phone=None):
+    """Write actions in id order to the writable stream `out`."""
+    _check_format(format)
+    query, params = _actions_query(after_id, to_id, phone)
+    with db._transaction() as cursor:
+        cursor.copy_expert(_copy_out_sql(cursor.mogrify(query, params).decode(), format), out)
+
+
+def export_users(db, out, format='csv'):
+    _check_format(format)
+    with db._transaction() as cursor:
+        cursor.copy_expert(_copy_out_sql(_users_query(), format), out)
+
+
+class _ChunkWriter:
+    # File-like target for copy_expert that hands chunks to a bounded queue
+    def __init__(self, chunks, closed):
+        self.chunks = chunks
+        self.closed = closed
+
+    def write(self, data):
+        while True:
+            if self.closed.is_set():
+                raise IOError("Export consumer went away")
+            try:
+                self.chunks.put(data, timeout=1)
+                return len(data)
+            except queue.Full:
+                pass
+
+
+def stream_export(export, db, *args, max_chunks=16, **kwargs):
+    """
+    Run export(db, out, *args, **kwargs) in a thread and yield its output chunk by chunk,
+    holding at most max_chunks in memory. Closing the generator aborts the
+    COPY, e.g. when an HTTP client disconnects.
+    """
+    chunks = queue.Queue(max_chunks)
+    closed = threading.Event()
+    done = object()
+    error = []
+
+    def run():
+        try:
+            export(db, _ChunkWriter(chunks, closed), *args, **kwargs)
+        except Exception as e:
+            error.append(e)
+        finally:
+            while not closed.is_set():
+                try:
+                    chunks.put(done, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    thread = threading.Thread(target=run, name='bulk-export', daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if error:
+            raise error[0]
+    finally:
+        closed.set()
+        thread.join()
+
+
+async def import_users_async(db, chunks, format='csv'):
+    """import_users for AsyncDatabaseManager; chunks is an async iterator of bytes."""
+    _check_format(format)
+    async with db._transaction() as conn:
+        await conn.execute(_create_import_table_sql(format))
+        if format == 'ndjson':
+            await conn.copy_to_table('users_import', source=chunks, columns=['line'],
+                                     format='csv', quote='\x01', delimiter='\x02')
+        else:
+            header = b''
+            async for chunk in chunks:
+                header += chunk
+                if b'\n' in header:
+                    break
+            header, _, rest = header.partition(b'\n')
+            columns = parse_user_header(header)
+
+            async def body():
+                if rest:
+                    yield rest
+                async for chunk in chunks:
+                    yield chunk
+
+            await conn.copy_to_table('users_import', source=body(), columns=columns, format='csv')
+        rows, inserted, updated = await conn.fetchrow(_upsert_users_sql(format))
+    return {'rows': rows, 'inserted': inserted, 'updated': updated}
+
+
+async def stream_actions_async(db, format='csv', after_id=None, to_id=None, phone=None, max_chunks=16):
+    """Async generator of export chunks of the actions ledger from an AsyncDatabaseManager."""
+    _check_format(format)
+    query, params = _actions_query(after_id, to_id, phone, placeholder='$')
+    if format == 'ndjson':
+        query = f'SELECT row_to_json(r)::text FROM ({query}) r'
+        options = {'format': 'csv', 'quote': '\x01', 'delimiter': '\x02'}
+    else:
+        options = {'format': 'csv', 'header': True}
+    chunks = asyncio.Queue(max_chunks)
+    done = object()
+
+    async def put(chunk):
+        # asyncpg hands out a reused buffer, so copy it before queueing
+        await chunks.put(bytes(chunk))
+
+    async def produce():
+        try:
+            async with db._transaction() as conn:
+                await conn.copy_from_query(query, *params, output=put, **options)
+        finally:
+            await chunks.put(done)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        # Re-raise a failed COPY instead of ending the response as if it were complete
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+if __name__ == "__main__":
+    from database import DatabaseManager
+    from main import DB_PARAMS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    import_parser = subcommands.add_parser('import-users', help='upsert users from a file (- for stdin)')
+    import_parser.add_argument('file')
+    export_actions_parser = subcommands.add_parser('export-actions', help='write the actions ledger')
+    export_actions_parser.add_argument('--after-id', type=int)
+    export_actions_parser.add_argument('--to-id', type=int)
+    export_actions_parser.add_argument('--phone', help='actions sent or received by this phone')
+    export_users_parser = subcommands.add_parser('export-users', help='write all users')
+    for subparser in (import_parser, export_actions_parser, export_users_parser):
+        subparser.add_argument('--format', choices=FORMATS, default='csv')
+    for subparser in (export_actions_parser, export_users_parser):
+        subparser.add_argument('-o', '--output', default='-', help='file to write, - for stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = DatabaseManager(DB_PARAMS)
+    if args.command == 'import-users':
+        source = sys.stdin.buffer if args.file == '-' else open(args.file, 'rb')
+        with source:
+            print(json.dumps(import_users(db, source, args.format)))
+    else:
+        target = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+        with target:
+            if args.command == 'export-actions':
+                export_actions(db, target, args.format, after_id=args.after_id, to_id=args.to_id, phone=args.phone)
+            else:
+                export_users(db, target, args.format)
@@ -1,256 +1,635 @@
+import hashlib
+import json
+import os
 import psycopg2
-from threading import Lock
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from metrics import DB_LOCK_HOLD_SECONDS, DB_LOCK_WAIT_SECONDS, instrument_methods, log_slow_query
+from migrations import REBUILD_USERS_STATISTICS
+from phones import phone_key
+from queries import STATEMENTS
+from replicas import ReplicaRouter
+
+# pg_advisory_xact_lock key that serializes appends to the md5-chained actions ledger
+LEDGER_LOCK_ID = 7202
+
+# Read-your-writes key of the pending actions list, see replicas.py
+PENDING_KEY = ('pending',)
+
+
+def _phone(phone_number):
+    return ('phone', phone_key(phone_number))
+
+
+def _user(user_id):
+    return ('user', user_id)
+
+
+# Guards the post-fork reconnect; replaced in the child so it can never be inherited locked
+_fork_lock = Lock()
+
+
+def _reset_fork_lock():
+    global _fork_lock
+    _fork_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_fork_lock)
+
+
+class WaitCounter:
+    # Accumulates wait/hold durations so the pool can be sized from real numbers
+    def __init__(self):
+        self._lock = Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'total_seconds': self.total,
+                'avg_seconds': self.total / self.count if self.count else 0.0,
+                'max_seconds': self.max,
+            }
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    # Logs statements slower than slow_query_seconds, set per cursor by DatabaseManager
+    slow_query_seconds = None
+
+    def execute(self, query, vars=None):
+        started = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            log_slow_query('sync', self.slow_query_seconds, perf_counter() - started, query)
+
+
+def users_statistics_from_row(row):
+    total_users, positive_balance_users, zero_balance_users, negative_balance_users, total_balance, users_without_info = row
+    # Собираем статистику в словарь
+    return {
+        'total_users': total_users,
+        'positive_balance_users': positive_balance_users,
+        'zero_balance_users': zero_balance_users,
+        'negative_balance_users': negative_balance_users,
+        'overall_zero': 'Да' if total_balance == 0 else 'Нет',
+        'users_without_info': users_without_info
+    }
+
 
 class DatabaseManager:
-    def __init__(self, db_params={'host': 'your_host', 'database': 'your_database', 'user': 'your_user', 'password': 'your_password', 'port': 'your_port'}):
-        # Connect to the database
-        self.conn = psycopg2.connect(**db_params)
-        self.cursor = self.conn.cursor()
+    def __init__(self, db_params={'host': 'your_host', 'database': 'your_database', 'user': 'your_user', 'password': 'your_password', 'port': 'your_port'}, pool_size=None, session_cache=None, balance_cache=None,
+                 slow_query_seconds=None, replicas=None, replica_check_interval=5.0, replica_max_lag_seconds=10.0,
+                 read_your_writes_seconds=5.0):
+        """
+        pool_size: None keeps a single connection serialized by self.lock,
+        (minconn, maxconn) enables the pooled mode where every call checks out
+        its own connection.
+        session_cache: optional SessionCache for assoc/language lookups.
+        balance_cache: optional BalanceCache for get_balance; it is kept
+        current by a listener on BALANCE_CHANNEL, see balance_cache.py.
+        slow_query_seconds: statements taking at least this long are logged,
+        see metrics.py; None disables the log.
+        replicas: db_params of read replicas. Read-only methods are spread
+        over them, see replicas.py for health checks and read-your-writes.
+
+        The schema is managed by migrations.migrate(), which must run first.
+        """
+        self.db_params = db_params
+        self.pool_size = pool_size
+        self.session_cache = session_cache
+        self.balance_cache = balance_cache
+        self.slow_query_seconds = slow_query_seconds
+        self.conn = None
+        self.cursor = None
+        self.pool = None
         self.lock = Lock()
-
-        # Create the users table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                phone_number TEXT NOT NULL,
-                balance BIGINT NOT NULL,
-                info TEXT,
-				mir_karta TEXT,
-				mir_account TEXT,
-				balance_mir_karta TEXT,
-				bcr_plast_karta_nomer TEXT,
-				bcr_plast_karta_srok TEXT,
-				bcr_plast_karta_cvv TEXT
-            )
-        ''')
-
-        # Create the telegram-phone table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS assoc (
-                user_id BIGINT NOT NULL PRIMARY KEY,
-                phone_number TEXT NOT NULL,
-                language VARCHAR(3) DEFAULT 'ru'
+        self.lock_wait = WaitCounter()
+        self.lock_hold = WaitCounter()
+        self.pool_wait = WaitCounter()
+        # Connections inherited through fork; never closed in the child,
+        # since closing them would terminate the parent's sessions
+        self._inherited = []
+        self._connect()
+        self.router = None
+        if replicas:
+            self.router = ReplicaRouter(
+                replicas,
+                lambda db_params: DatabaseManager(db_params, pool_size=pool_size, slow_query_seconds=slow_query_seconds),
+                check_interval=replica_check_interval,
+                max_lag_seconds=replica_max_lag_seconds,
+                read_your_writes_seconds=read_your_writes_seconds,
             )
-        ''')
-
-        # Create the pending_actions table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pending_actions (
-                id SERIAL PRIMARY KEY,
-                user_phone_number TEXT NOT NULL,
-                receiver_phone_number TEXT NOT NULL,
-                amount BIGINT NOT NULL,
-                comment TEXT NOT NULL,
-                sender_info TEXT,
-                receiver_info TEXT
-            )
-        ''')
-
-        # Create the actions table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS actions (
-                id SERIAL PRIMARY KEY,
-                user_phone_number TEXT NOT NULL,
-                receiver_phone_number TEXT NOT NULL,
-                amount BIGINT NOT NULL,
-                md5 TEXT NOT NULL,
-                comment TEXT
-            )
-        ''')
 
-        self.conn.commit()
+    def _connect(self):
+        self._pid = os.getpid()
+        if self.pool_size:
+            minconn, maxconn = self.pool_size
+            self.pool = ThreadedConnectionPool(minconn, maxconn, **self.db_params)
+            self._slots = BoundedSemaphore(maxconn)
+        else:
+            self.conn = psycopg2.connect(**self.db_params)
+            self.cursor = self._cursor(self.conn)
+
+    def _cursor(self, conn):
+        cursor = conn.cursor(cursor_factory=TimedCursor)
+        cursor.slow_query_seconds = self.slow_query_seconds
+        return cursor
+
+    def _check_fork(self):
+        if self._pid == os.getpid():
+            return
+        with _fork_lock:
+            if self._pid == os.getpid():
+                return
+            self._inherited.append((self.conn, self.cursor, self.pool))
+            self.conn = self.cursor = self.pool = None
+            self.lock = Lock()
+            self._connect()
+
+    @contextmanager
+    def _transaction(self):
+        # One transaction per call: commit on success, rollback on any error
+        self._check_fork()
+        if self.pool is None:
+            started = perf_counter()
+            with self.lock:
+                acquired = perf_counter()
+                self.lock_wait.add(acquired - started)
+                DB_LOCK_WAIT_SECONDS.observe(acquired - started)
+                if self.conn.closed:
+                    # The server dropped us; reconnect instead of failing forever
+                    self._connect()
+                try:
+                    yield self.cursor
+                    self.conn.commit()
+                except BaseException:
+                    if not self.conn.closed:
+                        self.conn.rollback()
+                    raise
+                finally:
+                    held = perf_counter() - acquired
+                    self.lock_hold.add(held)
+                    DB_LOCK_HOLD_SECONDS.observe(held)
+            return
+
+        started = perf_counter()
+        self._slots.acquire()
+        self.pool_wait.add(perf_counter() - started)
+        try:
+            conn = self.pool.getconn()
+            try:
+                with self._cursor(conn) as cursor:
+                    yield cursor
+                conn.commit()
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def _read(self, keys, name, params=(), many=False):
+        # A read-only prepared statement, on a replica when one can serve `keys`
+        replica = self.router.choose(keys) if self.router else None
+        if replica is not None:
+            try:
+                with replica.manager._transaction() as cursor:
+                    STATEMENTS.execute(cursor, name, params)
+                    return cursor.fetchall() if many else cursor.fetchone()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # Retried on the primary; the replica gets reads again once a health check passes
+                replica.mark_down(e)
+        with self._transaction() as cursor:
+            STATEMENTS.execute(cursor, name, params)
+            return cursor.fetchall() if many else cursor.fetchone()
+
+    def _wrote(self, *keys):
+        if self.router:
+            self.router.wrote(keys)
+
+    def get_pool_statistics(self):
+        statistics = {
+            'mode': 'pool' if self.pool_size else 'single',
+            'lock_wait': self.lock_wait.snapshot(),
+            'lock_hold': self.lock_hold.snapshot(),
+            'pool_wait': self.pool_wait.snapshot(),
+        }
+        if self.router:
+            statistics['replicas'] = self.router.get_statistics()
+        return statistics
+
+    def get_statement_statistics(self):
+        # Per prepared statement, shared by every DatabaseManager in the process
+        return STATEMENTS.get_statistics()
 
     def get_users_statistics(self):
-        with self.lock:
-            try:
-                # Общее количество пользователей
-                self.cursor.execute("SELECT COUNT(*) FROM users")
-                total_users = self.cursor.fetchone()[0]
-
-                # Количество пользователей с положительным балансом
-                self.cursor.execute("SELECT COUNT(*) FROM users WHERE balance > 0")
-                positive_balance_users = self.cursor.fetchone()[0]
-
-                # Количество пользователей с нулевым балансом
-                self.cursor.execute("SELECT COUNT(*) FROM users WHERE balance = 0")
-                zero_balance_users = self.cursor.fetchone()[0]
-
-                # Количество пользователей с отрицательным балансом
-                self.cursor.execute("SELECT COUNT(*) FROM users WHERE balance < 0")
-                negative_balance_users = self.cursor.fetchone()[0]
-
-                # Общий баланс (да/нет)
-                self.cursor.execute("SELECT SUM(balance) FROM users")
-                total_balance = self.cursor.fetchone()[0]
-                overall_zero = 'Да' if total_balance == 0 else 'Нет'
-
-                # Количество пользователей без информации
-                self.cursor.execute("SELECT COUNT(*) FROM users WHERE info IS NULL OR info = ''")
-                users_without_info = self.cursor.fetchone()[0]
-
-                # Собираем статистику в словарь
-                statistics = {
-                    'total_users': total_users,
-                    'positive_balance_users': positive_balance_users,
-                    'zero_balance_users': zero_balance_users,
-                    'negative_balance_users': negative_balance_users,
-                    'overall_zero': overall_zero,
-                    'users_without_info': users_without_info
-                }
-                return statistics
-            except psycopg2.Error as e:
-                print(f"Error fetching users statistics: {e}")
-                return None
+        # Counters are maintained by triggers on users (migration 3), so this is O(1)
+        try:
+            row = self._read((), 'get_users_statistics')
+            if row is None:
+                row = self.rebuild_users_statistics()
+            return users_statistics_from_row(row)
+        except psycopg2.Error as e:
+            print(f"Error fetching users statistics: {e}")
+            return None
+
+    def rebuild_users_statistics(self):
+        # Fallback: recount everything in one scan, blocking writers to users meanwhile
+        with self._transaction() as cursor:
+            cursor.execute('LOCK TABLE users IN SHARE MODE')
+            cursor.execute(REBUILD_USERS_STATISTICS + '''
+                RETURNING total_users, positive_balance_users, zero_balance_users,
+                          negative_balance_users, total_balance, users_without_info
+            ''')
+            return cursor.fetchone()
 
     def add_user(self, phone_number):
         # Self-explanatory
-        with self.lock:
-            self.cursor.execute('INSERT INTO users (phone_number, balance) VALUES (%s, 0)', (phone_number,))
-            self.conn.commit()
+        with self._transaction() as cursor:
+            STATEMENTS.execute(cursor, 'add_user', (phone_number,))
+        self._wrote(_phone(phone_number))
 
     def get_user(self, phone_number):
         # Self-explanatory
-        with self.lock:
-            self.cursor.execute('SELECT * FROM users WHERE phone_number=%s', (phone_number,))
-            return self.cursor.fetchone()
+        return self._read([_phone(phone_number)], 'get_user', (phone_key(phone_number),))
 
     def add_assoc(self, user_id, phone_number):
-        with self.lock:
+        """Link a telegram user id to a phone number; False when either is already linked."""
+        with self._transaction() as cursor:
             # Add association between telegram user id and a phone number
-            self.cursor.execute('INSERT INTO assoc (user_id, phone_number) VALUES (%s, %s)', (user_id, phone_number))
-            self.conn.commit()
+            STATEMENTS.execute(cursor, 'add_assoc', (user_id, phone_number))
+            linked = cursor.fetchone() is not None
+        self._wrote(_user(user_id), _phone(phone_number))
+        if self.session_cache:
+            self.session_cache.invalidate(user_id)
+        return linked
+
+    def _get_session(self, user_id):
+        # (phone_number, language) for a registered user, served from the cache when possible
+        if self.session_cache:
+            session = self.session_cache.get(user_id)
+            if session:
+                return session
+            generation = self.session_cache.generation()
+        session = self._read([_user(user_id)], 'get_session', (user_id,))
+        if session and self.session_cache:
+            self.session_cache.put(user_id, session[0], session[1], generation)
+        return session
 
     def get_assoc(self, user_id):
-        with self.lock:
-            # Self-explanatory
-            self.cursor.execute('SELECT phone_number FROM assoc WHERE user_id=%s', (user_id,))
-            return self.cursor.fetchone()
+        session = self._get_session(user_id)
+        return (session[0],) if session else None
 
     def get_reverse_assoc(self, phone_number):
-        with self.lock:
-            # Self-explanatory
-            self.cursor.execute('SELECT user_id FROM assoc WHERE phone_number=%s', (phone_number,))
-            return self.cursor.fetchone()
+        return self._read([_phone(phone_number)], 'get_reverse_assoc', (phone_key(phone_number),))
 
     def get_balance(self, phone_number):
-        with self.lock:
-            self.cursor.execute('SELECT balance FROM users WHERE phone_number=%s', (phone_number,))
-            return self.cursor.fetchone()
+        key = phone_key(phone_number)
+        if self.balance_cache:
+            balance = self.balance_cache.get(key)
+            if balance is not None:
+                return (balance,)
+            generation = self.balance_cache.generation()
+        row = self._read([_phone(phone_number)], 'get_balance', (key,))
+        if row and self.balance_cache:
+            self.balance_cache.put(key, row[0], generation)
+        return row
 
     def get_all_pending_actions(self):
-        with self.lock:
-            self.cursor.execute('SELECT * FROM pending_actions')
-            return self.cursor.fetchall()
+        return self._read([PENDING_KEY], 'get_all_pending_actions', many=True)
+
+    def iter_pending_actions(self, after_id=None, limit=None, sender=None, receiver=None, batch_size=500):
+        """
+        Yield pending actions ordered by id, each with the sender's balance
+        check already joined in. after_id/limit give keyset pagination, and
+        rows are pulled from a server-side cursor batch_size at a time.
+
+        With a single connection the page is fetched whole before the first
+        row is yielded: streaming would hold self.lock, and every other
+        query, for as long as the client takes to read it.
+        """
+        conditions = []
+        params = []
+        if after_id is not None:
+            conditions.append('p.id > %s')
+            params.append(after_id)
+        if sender is not None:
+            conditions.append('p.user_phone_key = %s')
+            params.append(phone_key(sender))
+        if receiver is not None:
+            conditions.append('p.receiver_phone_key = %s')
+            params.append(phone_key(receiver))
+        query = '''
+            SELECT p.id, p.user_phone_number, p.receiver_phone_number, p.amount, p.comment,
+                   p.sender_info, p.receiver_info, COALESCE(u.balance, 0) < p.amount AS less_than_zero
+            FROM pending_actions p
+            LEFT JOIN users u ON u.phone_key = p.user_phone_key
+        '''
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY p.id'
+        if limit is not None:
+            query += ' LIMIT %s'
+            params.append(limit)
+
+        keys = [PENDING_KEY] + [_phone(phone) for phone in (sender, receiver) if phone is not None]
+        replica = self.router.choose(keys) if self.router else None
+        # Streamed rows cannot be retried elsewhere; a failing replica is only taken out for the next calls
+        manager = replica.manager if replica else self
+        try:
+            if manager.pool_size is None:
+                with manager._transaction() as cursor:
+                    cursor.execute(query, params)
+                    rows = cursor.fetchall()
+                yield from rows
+                return
+            with manager._transaction() as cursor:
+                with cursor.connection.cursor(name='pending_actions_stream') as stream:
+                    stream.itersize = batch_size
+                    stream.execute(query, params)
+                    yield from stream
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if replica:
+                replica.mark_down(e)
+            raise
 
     def get_user_info_by_phone(self, phone_number):
-        with self.lock:
-            try:
-                self.cursor.execute("SELECT info FROM users WHERE phone_number = %s", (phone_number,))
-                user_info = self.cursor.fetchone()
-                return user_info[0] if user_info else None
-            except psycopg2.Error as e:
-                print(f"Error fetching user info: {e}")
-                return None
-				
+        try:
+            user_info = self._read([_phone(phone_number)], 'get_user_info', (phone_key(phone_number),))
+            return user_info[0] if user_info else None
+        except psycopg2.Error as e:
+            print(f"Error fetching user info: {e}")
+            return None
+
     def get_user_info_with_balance(self, phone_number):
-        with self.lock:
-            try:
-                self.cursor.execute("SELECT info, balance FROM users WHERE phone_number = %s", (phone_number,))
-                user_info = self.cursor.fetchone()
-                if user_info:
-                    info, balance = user_info
-                    if info:
-                        info = f"Баланс: {balance}\n" + info.strip()
-                    else:
-                        info = f"Баланс: {balance}"
-                    return info
+        try:
+            user_info = self._read([_phone(phone_number)], 'get_user_info', (phone_key(phone_number),))
+            if user_info:
+                info, balance = user_info
+                if info:
+                    info = f"Баланс: {balance}\n" + info.strip()
                 else:
-                    return None
-            except psycopg2.Error as e:
-                print(f"Error fetching user info with balance: {e}")
+                    info = f"Баланс: {balance}"
+                return info
+            else:
                 return None
+        except psycopg2.Error as e:
+            print(f"Error fetching user info with balance: {e}")
+            return None
 
     def create_pending_action(self, user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment):
-        with self.lock:
-            try:
-                self.cursor.execute('''
-                    INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                ''', (user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment))
-                self.conn.commit()
-                return True
-            except psycopg2.Error as e:
-                print(f"Error creating pending action: {e}")
-                self.conn.rollback()
-                return False
+        try:
+            with self._transaction() as cursor:
+                STATEMENTS.execute(cursor, 'create_pending_action', (user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment))
+            self._wrote(PENDING_KEY)
+            return True
+        except psycopg2.Error as e:
+            print(f"Error creating pending action: {e}")
+            return False
+
+    @staticmethod
+    def _enqueue_notifications(cursor, notifications):
+        """
+        Queue (phone_number, template, params) notifications in the outbox as
+        part of the caller's transaction. Phones without a linked Telegram
+        account are skipped.
+        """
+        if not notifications:
+            return
+        cursor.execute('''
+            INSERT INTO outbox (chat_id, language, template, params)
+            SELECT a.user_id, a.language, n.template, n.params::jsonb
+            FROM unnest(%s::bigint[], %s::text[], %s::text[]) WITH ORDINALITY AS n(phone_key, template, params, position)
+            JOIN assoc a ON a.phone_key = n.phone_key
+            ORDER BY n.position
+        ''', (
+            [phone_key(phone) for phone, _, _ in notifications],
+            [template for _, template, _ in notifications],
+            [json.dumps(params, ensure_ascii=False) for _, _, params in notifications],
+        ))
+
+    @staticmethod
+    def _approve_notifications(user_phone_number, receiver_phone_number, amount, comment):
+        return [
+            (user_phone_number, 'approve_message_snd', {'amount': amount, 'recv_phone': receiver_phone_number, 'comment': comment}),
+            (receiver_phone_number, 'approve_message_recv', {'amount': amount, 'snd_phone': user_phone_number, 'comment': comment}),
+        ]
+
+    @staticmethod
+    def _remove_notifications(user_phone_number, receiver_phone_number, amount):
+        return [(user_phone_number, 'remove_message_snd', {'amount': amount, 'recv_phone': receiver_phone_number})]
 
     def remove_pending_action(self, id):
         # Self-explanatory
-        with self.lock:
-
-            self.cursor.execute('SELECT user_phone_number, amount FROM pending_actions WHERE id=%s', (id,))
-            result = self.cursor.fetchone()
+        with self._transaction() as cursor:
+            STATEMENTS.execute(cursor, 'remove_pending_action', (id,))
+            result = cursor.fetchone()
             if result:
-                recv_phone, amount = result
-                self.cursor.execute('DELETE FROM pending_actions WHERE id=%s', (id,))
-                self.conn.commit()
-                return recv_phone, amount
-            return None
+                snd_phone, recv_phone, amount = result
+                self._enqueue_notifications(cursor, self._remove_notifications(snd_phone, recv_phone, amount))
+        # Recorded once committed, so the read-your-writes window starts when the write is visible
+        self._wrote(PENDING_KEY)
+        return (result[0], result[2]) if result else None
 
     def apply_pending_action(self, id, md5):
-        # Retrieve data from pending_actions
-        with self.lock:
-            self.cursor.execute('''
-                SELECT user_phone_number, receiver_phone_number, amount, comment
-                FROM pending_actions
-                WHERE id = %s
-            ''', (id,))
-            pending_action_data = self.cursor.fetchone()
-
-            if pending_action_data:
+        """
+        Approve one pending action whose md5 continues the ledger chain.
+        Returns (status, data) with the statuses of apply_pending_actions:
+        data is (sender, receiver, amount, comment) when 'approved', None for
+        'not_found' and 'auth_failed'.
+
+        Safe with any number of API processes: the ledger advisory lock keeps
+        the head read here current until our row is inserted, and the pending
+        row is locked FOR UPDATE, so a concurrent approve of the same id
+        finds it gone.
+        """
+        # Balances, the pending row and the ledger entry change in one transaction
+        with self._transaction() as cursor:
+            STATEMENTS.execute(cursor, 'lock_ledger', (LEDGER_LOCK_ID,))
+            STATEMENTS.execute(cursor, 'get_last_md5')
+            head = cursor.fetchone()
+            # Retrieve data from pending_actions
+            STATEMENTS.execute(cursor, 'lock_pending_action', (id,))
+            pending_action_data = cursor.fetchone()
+            pending = {id: pending_action_data} if pending_action_data else {}
+            [(_, status, _)], _, _ = self._chain_batch([(id, md5)], head[0] if head else None, pending)
+
+            if status == 'approved':
                 user_phone_number, receiver_phone_number, amount, comment = pending_action_data
 
                 # Update sender's balance (decrease by amount)
-                self.cursor.execute('UPDATE users SET balance = balance - %s WHERE phone_number=%s', (amount, user_phone_number))
+                STATEMENTS.execute(cursor, 'add_balance', (-amount, phone_key(user_phone_number)))
 
                 # Update receiver's balance (increase by amount)
-                self.cursor.execute('UPDATE users SET balance = balance + %s WHERE phone_number=%s', (amount, receiver_phone_number))
+                STATEMENTS.execute(cursor, 'add_balance', (amount, phone_key(receiver_phone_number)))
 
                 # Remove from pending_actions
-                self.cursor.execute('DELETE FROM pending_actions WHERE id=%s', (id,))
-                self.conn.commit()
+                STATEMENTS.execute(cursor, 'delete_pending_action', (id,))
 
                 # Add to actions
-                self.cursor.execute('''
+                STATEMENTS.execute(cursor, 'insert_action', (user_phone_number, receiver_phone_number, amount, md5, comment))
+
+                # Notifications commit or roll back together with the transfer
+                self._enqueue_notifications(cursor, self._approve_notifications(user_phone_number, receiver_phone_number, amount, comment))
+        if status != 'approved':
+            return status, None
+        self._wrote(PENDING_KEY, _phone(user_phone_number), _phone(receiver_phone_number))
+        return status, (user_phone_number, receiver_phone_number, amount, comment)
+
+    def remove_pending_actions(self, ids):
+        """Delete many pending actions at once; returns {id: (user_phone_number, amount) or None}."""
+        with self._transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM pending_actions WHERE id = ANY(%s)
+                RETURNING id, user_phone_number, receiver_phone_number, amount
+            ''', (list(ids),))
+            removed = {row[0]: row[1:] for row in sorted(cursor.fetchall())}
+            self._enqueue_notifications(cursor, [
+                notification
+                for snd_phone, recv_phone, amount in removed.values()
+                for notification in self._remove_notifications(snd_phone, recv_phone, amount)
+            ])
+        self._wrote(PENDING_KEY)
+        return {id: (removed[id][0], removed[id][2]) if id in removed else None for id in ids}
+
+    @staticmethod
+    def _chain_batch(items, head, pending):
+        """
+        Walk (id, md5) items against the ledger head and the locked pending
+        rows {id: (sender, receiver, amount, comment)}. Returns the per-item
+        results, the balance delta per phone key and the ledger rows to insert.
+        """
+        results = []
+        deltas = {}
+        ledger = []
+        for id, md5 in items:
+            data = pending.pop(id, None)
+            if data is None:
+                results.append((id, 'not_found', None))
+                continue
+            if not md5 or (head is not None and hashlib.md5(md5.encode()).hexdigest() != head):
+                pending[id] = data
+                results.append((id, 'auth_failed', None))
+                continue
+            user_phone_number, receiver_phone_number, amount, comment = data
+            sender_key, receiver_key = phone_key(user_phone_number), phone_key(receiver_phone_number)
+            deltas[sender_key] = deltas.get(sender_key, 0) - amount
+            deltas[receiver_key] = deltas.get(receiver_key, 0) + amount
+            ledger.append((id, user_phone_number, receiver_phone_number, amount, md5, comment))
+            head = md5
+            results.append((id, 'approved', data))
+        return results, deltas, ledger
+
+    def apply_pending_actions(self, items):
+        """
+        Apply (id, md5) pairs in order inside one transaction.
+
+        Every md5 must hash to the ledger head left by the previous item, the
+        same check API.auth does for a single approve. Returns one
+        (id, status, data) per item, where status is 'approved', 'not_found'
+        or 'auth_failed' and data is (sender, receiver, amount, comment) for
+        approved items.
+        """
+        with self._transaction() as cursor:
+            # Serialize ledger appends and lock the rows we are about to apply
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (LEDGER_LOCK_ID,))
+            cursor.execute('SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
+            head = cursor.fetchone()
+            head = head[0] if head else None
+            cursor.execute('''
+                SELECT id, user_phone_number, receiver_phone_number, amount, comment
+                FROM pending_actions
+                WHERE id = ANY(%s)
+                FOR UPDATE
+            ''', ([id for id, _ in items],))
+            pending = {row[0]: row[1:] for row in cursor.fetchall()}
+
+            results, deltas, ledger = self._chain_batch(items, head, pending)
+
+            if ledger:
+                # One set-based UPDATE for all balances touched by the batch
+                cursor.execute('''
+                    UPDATE users u SET balance = u.balance + d.delta
+                    FROM unnest(%s::bigint[], %s::bigint[]) AS d(phone_key, delta)
+                    WHERE u.phone_key = d.phone_key
+                ''', (list(deltas), list(deltas.values())))
+                cursor.execute('DELETE FROM pending_actions WHERE id = ANY(%s)', ([entry[0] for entry in ledger],))
+                # Multi-row VALUES keeps the chain order in the serial ids
+                execute_values(cursor, '''
                     INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5, comment)
-                    VALUES (%s, %s, %s, %s, %s)
-                ''', (user_phone_number, receiver_phone_number, amount, md5, comment))
-                self.conn.commit()
-                return (user_phone_number, receiver_phone_number, amount, comment)
-            return None
+                    VALUES %s
+                ''', [entry[1:] for entry in ledger], page_size=len(ledger))
+                self._enqueue_notifications(cursor, [
+                    notification
+                    for _, snd_phone, recv_phone, amount, _, comment in ledger
+                    for notification in self._approve_notifications(snd_phone, recv_phone, amount, comment)
+                ])
+        if ledger:
+            self._wrote(PENDING_KEY, *(('phone', key) for key in deltas))
+        return results
+
+    def claim_outbox(self, limit, lease_seconds):
+        """
+        Lease up to `limit` due notifications. Leased rows are invisible to
+        other dispatchers until the lease expires, so a crashed sender's
+        messages are retried rather than lost.
+        """
+        with self._transaction() as cursor:
+            STATEMENTS.execute(cursor, 'claim_outbox', (lease_seconds, limit))
+            return sorted(cursor.fetchall())
+
+    def mark_outbox_sent(self, ids):
+        with self._transaction() as cursor:
+            STATEMENTS.execute(cursor, 'mark_outbox_sent', (list(ids),))
+
+    def retry_outbox(self, id, delay_seconds, error):
+        with self._transaction() as cursor:
+            cursor.execute('''
+                UPDATE outbox SET next_attempt_at = now() + %s * interval '1 second', last_error = %s
+                WHERE id = %s
+            ''', (delay_seconds, error, id))
+
+    def fail_outbox(self, id, error):
+        with self._transaction() as cursor:
+            cursor.execute('UPDATE outbox SET failed_at = now(), last_error = %s WHERE id = %s', (error, id))
 
     def get_last_md5(self):
         # Self-explanatory
-        with self.lock:
-            self.cursor.execute('SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
-            return self.cursor.fetchone()
+        with self._transaction() as cursor:
+            STATEMENTS.execute(cursor, 'get_last_md5')
+            return cursor.fetchone()
 
     def set_user_language(self, user_id, language_code):
-        with self.lock:
-            # SQL-запрос для обновления языка пользователя
-            query = "UPDATE assoc SET language = %s WHERE user_id = %s"
-            params = (language_code, user_id)
-            self.cursor.execute(query, params)
-            self.conn.commit()
+        with self._transaction() as cursor:
+            # Обновляем язык пользователя
+            STATEMENTS.execute(cursor, 'set_user_language', (language_code, user_id))
+        self._wrote(_user(user_id))
+        if self.session_cache:
+            self.session_cache.invalidate(user_id)
 
     def get_user_language(self, user_id):
-        with self.lock:
-            # SQL-запрос для получения языка пользователя
-            query = "SELECT language FROM assoc WHERE user_id = %s"
-            params = (user_id,)
-            self.cursor.execute(query, params)
-            result = self.cursor.fetchone()
-            if result:
-                return result[0]
-            else:
-                return None
\ No newline at end of file
+        # Язык берётся из той же строки assoc, что и телефон
+        result = self._get_session(user_id)
+        if result:
+            return result[1]
+        else:
+            return None
+
+
+instrument_methods(DatabaseManager, 'sync')
@@ -0,0 +1,163 @@
+"""md5-chained ledger helpers: the cached chain head and the offline verifier.
+
+Every row in actions stores a key whose md5 is the previous row's key, so
+verifying the chain means checking md5(row.md5) == previous.md5 in id order.
+
+    python ledger.py verify            # resume from the last checkpoint
+    python ledger.py verify --full     # re-hash the whole history
+"""
+import argparse
+import hashlib
+import json
+import logging
+import sys
+from threading import Lock
+
+import psycopg2
+
+from database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+# Sent by the actions trigger (migration 6) with the new head as payload
+LEDGER_HEAD_CHANNEL = 'ledger_head'
+
+
+class LedgerHead:
+    """
+    In-process cache of the newest actions.md5.
+
+    Updated directly after a local approve and through LISTEN ledger_head for
+    approvals made by other processes. A miss or an invalidation falls back
+    to DatabaseManager.get_last_md5.
+    """
+
+    def __init__(self, db: DatabaseManager):
+        self.db = db
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self._head = None
+        self._valid = False
+        # Same race guard as SessionCache: a read that overlapped a set or invalidate must not overwrite it
+        self._generation = 0
+
+    def get(self):
+        with self.lock:
+            if self._valid:
+                self.hits += 1
+                return self._head
+        return self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            generation = self._generation
+        return self._store(self.db.get_last_md5(), generation)
+
+    def _store(self, row, generation):
+        head = row[0] if row else None
+        with self.lock:
+            self.misses += 1
+            if generation != self._generation:
+                # A newer head arrived while we read; ours may be older than it
+                return self._head if self._valid else head
+            self._head = head
+            self._valid = True
+            return head
+
+    def set(self, md5):
+        with self.lock:
+            self._generation += 1
+            self._head = md5
+            self._valid = True
+
+    def invalidate(self):
+        with self.lock:
+            self._generation += 1
+            self._valid = False
+
+    def on_notify(self, payload):
+        # Payload is the new head; an empty payload means "unknown, reload"
+        if payload:
+            self.set(payload)
+        else:
+            self.invalidate()
+
+
+class AsyncLedgerHead(LedgerHead):
+    """LedgerHead whose misses go through AsyncDatabaseManager.get_last_md5."""
+
+    async def get(self):
+        with self.lock:
+            if self._valid:
+                self.hits += 1
+                return self._head
+        return await self.refresh()
+
+    async def refresh(self):
+        with self.lock:
+            generation = self._generation
+        return self._store(await self.db.get_last_md5(), generation)
+
+
+def _last_checkpoint(cursor):
+    cursor.execute('SELECT action_id, md5 FROM ledger_checkpoints ORDER BY action_id DESC LIMIT 1')
+    return cursor.fetchone()
+
+
+def verify(db_params, full=False, save_checkpoint=True, batch_size=10000):
+    """
+    Stream actions after the last checkpoint through a server-side cursor and
+    check every link. Returns a report dict; 'broken_link' is None when the
+    chain is intact.
+    """
+    conn = psycopg2.connect(**db_params)
+    try:
+        with conn.cursor() as cursor:
+            checkpoint = None if full else _last_checkpoint(cursor)
+            after_id, previous = checkpoint if checkpoint else (0, None)
+            if checkpoint:
+                # The anchor itself must be unchanged, or everything after it is meaningless
+                cursor.execute('SELECT md5 FROM actions WHERE id = %s', (after_id,))
+                anchor = cursor.fetchone()
+                if not anchor or anchor[0] != previous:
+                    return {'checked': 0, 'from_id': after_id, 'last_id': after_id,
+                            'broken_link': {'id': after_id, 'reason': 'checkpoint row is missing or was modified'}}
+
+        report = {'checked': 0, 'from_id': after_id, 'last_id': after_id, 'broken_link': None}
+        previous_id = after_id
+        with conn.cursor(name='ledger_verify') as stream:
+            stream.itersize = batch_size
+            stream.execute('SELECT id, md5 FROM actions WHERE id > %s ORDER BY id', (after_id,))
+            for id, md5 in stream:
+                if previous is not None and hashlib.md5(md5.encode()).hexdigest() != previous:
+                    report['broken_link'] = {'id': id, 'previous_id': previous_id, 'reason': 'md5(key) does not match the previous key'}
+                    break
+                previous, previous_id = md5, id
+                report['checked'] += 1
+        report['last_id'] = previous_id
+        conn.rollback()
+
+        if save_checkpoint and report['broken_link'] is None and report['checked']:
+            with conn.cursor() as cursor:
+                cursor.execute('INSERT INTO ledger_checkpoints (action_id, md5) VALUES (%s, %s)', (previous_id, previous))
+            conn.commit()
+        return report
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    from main import DB_PARAMS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    verify_parser = subcommands.add_parser('verify', help='check the md5 chain of the actions table')
+    verify_parser.add_argument('--full', action='store_true', help='ignore checkpoints and start from the first action')
+    verify_parser.add_argument('--no-checkpoint', action='store_true', help='do not record a new checkpoint')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result = verify(DB_PARAMS, full=args.full, save_checkpoint=not args.no_checkpoint)
+    print(json.dumps(result, indent=2))
+    sys.exit(1 if result['broken_link'] else 0)
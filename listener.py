@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import select
+import threading
+
+import asyncpg
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseListener:
+    """
+    LISTENs on Postgres channels from a dedicated connection in a daemon
+    thread and calls handlers[channel](payload) for every notification.
+
+    Notifications sent while the connection is down are lost, so after every
+    (re)connect on_reconnect() is called to let caches drop what they hold.
+    """
+
+    def __init__(self, db_params, handlers, on_reconnect=None, retry_interval=5.0):
+        self.db_params = db_params
+        self.handlers = handlers
+        self.on_reconnect = on_reconnect
+        self.retry_interval = retry_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='db-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.db_params)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    for channel in self.handlers:
+                        cursor.execute(f'LISTEN "{channel}"')
+                if self.on_reconnect:
+                    self.on_reconnect()
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.handlers[notify.channel](notify.payload)
+                        except Exception as e:
+                            logger.error(f"Listener handler for {notify.channel} failed: {e}")
+            except Exception as e:
+                # Anything else (a failing on_reconnect, a select() error) must not end the thread either
+                logger.error(f"Database listener disconnected: {e}")
+                self._stop.wait(self.retry_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+class AsyncDatabaseListener:
+    """
+    asyncpg counterpart of DatabaseListener for code running in an event
+    loop. Handlers are plain callables invoked on the loop.
+    """
+
+    def __init__(self, db_params, handlers, on_reconnect=None, retry_interval=5.0):
+        self.db_params = dict(db_params)
+        if 'port' in self.db_params:
+            self.db_params['port'] = int(self.db_params['port'])
+        self.handlers = handlers
+        self.on_reconnect = on_reconnect
+        self.retry_interval = retry_interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _dispatch(self, conn, pid, channel, payload):
+        try:
+            self.handlers[channel](payload)
+        except Exception as e:
+            logger.error(f"Listener handler for {channel} failed: {e}")
+
+    async def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(**self.db_params)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda conn: lost.set())
+                for channel in self.handlers:
+                    await conn.add_listener(channel, self._dispatch)
+                if self.on_reconnect:
+                    self.on_reconnect()
+                await lost.wait()
+                logger.error("Database listener disconnected")
+            except Exception as e:
+                # Keeps reconnecting after timeouts, protocol errors or a failing on_reconnect;
+                # CancelledError is not an Exception, so stop() still ends the task
+                logger.error(f"Database listener disconnected: {e!r}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    try:
+                        await conn.close()
+                    except Exception:
+                        conn.terminate()
+            await asyncio.sleep(self.retry_interval)
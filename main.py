@@ -1,13 +1,93 @@
 import logging
 from multiprocessing import Process
 from database import DatabaseManager
+from migrations import migrate
+from async_database import AsyncDatabaseManager
 from bot import TelegramBot
+from sharded import ShardedBot
 from api import API
+from asgi_api import AsyncAPI
+from session_cache import SessionCache
+from supervisor import APISupervisor, mark_ready, mark_stopping
+from balance_cache import BalanceCache
+from translations import catalog
+import config
 from config import TOKEN_TG_BOT, passworddb
 
 # Telegram API token
 TOKEN = TOKEN_TG_BOT
 
+DB_PARAMS = {
+    "host": "127.0.0.1",
+    "port": "5432",
+    "database": "postgres",
+    "user": "postgres",
+    "password": passworddb,
+}
+
+# (minconn, maxconn) per process, None keeps the single locked connection
+DB_POOL_SIZE = getattr(config, "DB_POOL_SIZE", (1, 10))
+# Read replicas for DatabaseManager's read-only methods, each a dict like DB_PARAMS;
+# replicas further behind than DB_REPLICA_MAX_LAG seconds are skipped, and keys a process
+# just wrote are read from the primary for DB_READ_YOUR_WRITES seconds. The bot and the
+# ASGI API read through AsyncDatabaseManager, which always uses the primary, so in practice
+# this offloads the Flask API's /pending
+DB_REPLICAS = getattr(config, "DB_REPLICAS", [])
+DB_REPLICA_MAX_LAG = getattr(config, "DB_REPLICA_MAX_LAG", 10.0)
+DB_READ_YOUR_WRITES = getattr(config, "DB_READ_YOUR_WRITES", 5.0)
+# (min_size, max_size) of the bot's asyncpg pool
+BOT_DB_POOL_SIZE = getattr(config, "BOT_DB_POOL_SIZE", (1, 10))
+# user_id -> (phone, language) cache in front of the bot's database access
+SESSION_CACHE_SIZE = getattr(config, "SESSION_CACHE_SIZE", 10000)
+SESSION_CACHE_TTL = getattr(config, "SESSION_CACHE_TTL", 300)
+# phone -> balance cache in the bot, invalidated by NOTIFY balance_changed; 0 disables it
+BALANCE_CACHE_SIZE = getattr(config, "BALANCE_CACHE_SIZE", 10000)
+BALANCE_CACHE_TTL = getattr(config, "BALANCE_CACHE_TTL", 60)
+# Seconds of signups coalesced into one admin group message
+ADMIN_NOTIFICATION_WINDOW = getattr(config, "ADMIN_NOTIFICATION_WINDOW", 10.0)
+# "polling" or "webhook"; webhook mode needs WEBHOOK_SECRET, WEBHOOK_URL registers it with Telegram
+BOT_MODE = getattr(config, "BOT_MODE", "polling")
+WEBHOOK_LISTEN = getattr(config, "WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8443)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+# Updates processed at once by the bot; one user's updates are always sequential
+BOT_MAX_CONCURRENT_UPDATES = getattr(config, "BOT_MAX_CONCURRENT_UPDATES", 16)
+# Per-user admission: updates per second and burst (None disables throttling),
+# and the age in seconds after which an update is dropped unhandled (None disables it)
+BOT_USER_RATE = getattr(config, "BOT_USER_RATE", 1.0)
+BOT_USER_BURST = getattr(config, "BOT_USER_BURST", 5)
+BOT_MAX_UPDATE_AGE = getattr(config, "BOT_MAX_UPDATE_AGE", 30.0)
+# Bot worker processes; with more than one, updates are sharded between them by user id
+BOT_WORKERS = getattr(config, "BOT_WORKERS", 1)
+# Seconds between batched writes of bot user_data to Postgres, None keeps it in memory
+BOT_PERSISTENCE_FLUSH_INTERVAL = getattr(config, "BOT_PERSISTENCE_FLUSH_INTERVAL", 5.0)
+# Port of the bot's Prometheus exporter (sharded workers use port, port + 1, ...), None disables it;
+# the API serves its metrics at /metrics
+BOT_METRICS_PORT = getattr(config, "BOT_METRICS_PORT", None)
+# Statements slower than this many seconds go to the "slow_queries" log, None disables it
+SLOW_QUERY_SECONDS = getattr(config, "SLOW_QUERY_SECONDS", 0.5)
+# "waitress" (Flask, thread per request) or "asgi" (Starlette on uvicorn, asyncpg)
+API_SERVER = getattr(config, "API_SERVER", "waitress")
+# (min_size, max_size) of the ASGI API's asyncpg pool
+API_DB_POOL_SIZE = getattr(config, "API_DB_POOL_SIZE", (1, 10))
+API_HOST = getattr(config, "API_HOST", "0.0.0.0")
+API_PORT = getattr(config, "API_PORT", 5000)
+# API worker processes; with more than one they share API_PORT through SO_REUSEPORT,
+# each with its own database connections, and are restarted when they crash
+API_WORKERS = getattr(config, "API_WORKERS", 1)
+# Seconds requests in flight get to finish after SIGTERM
+API_DRAIN_TIMEOUT = getattr(config, "API_DRAIN_TIMEOUT", 30.0)
+# Written (with the pid) once the schema is migrated and every API worker has reached the database,
+# removed on shutdown; systemd Type=notify units get READY=1 at the same moment
+API_READY_FILE = getattr(config, "API_READY_FILE", None)
+# Port of the API's Prometheus exporter (API workers use port, port + 1, ...), None disables it;
+# with API_WORKERS > 1 scrape these, since /metrics on API_PORT reaches a random worker
+API_METRICS_PORT = getattr(config, "API_METRICS_PORT", None)
+# Bot API messages per second for the outbox, split evenly between the API workers
+OUTBOX_GLOBAL_RATE = getattr(config, "OUTBOX_GLOBAL_RATE", 25)
+
 if __name__ == "__main__":
     # Set up logging
     logging.basicConfig(
@@ -15,25 +95,69 @@ if __name__ == "__main__":
         level=logging.INFO,
     )
 
-    # Set up database
-    db_manager = DatabaseManager(
-        {
-            "host": "127.0.0.1",
-            "port": "5432",
-            "database": "postgres",
-            "user": "postgres",
-            "password": passworddb,
-        }
-    )
+    # Load and validate translations once, before any process is forked
+    catalog.load()
+
+    # Bring the schema up to date before anything connects
+    migrate(DB_PARAMS)
 
-    # Run bot
-    tb = TelegramBot(TOKEN, db_manager)
-    tb_th = Process(target=tb.run)
+    # Run bot; its asyncpg pool is opened inside the bot process
+    def make_bot():
+        session_cache = SessionCache(max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+        balance_cache = BalanceCache(max_size=BALANCE_CACHE_SIZE, ttl=BALANCE_CACHE_TTL) if BALANCE_CACHE_SIZE else None
+        return TelegramBot(
+            TOKEN,
+            AsyncDatabaseManager(DB_PARAMS, pool_size=BOT_DB_POOL_SIZE, session_cache=session_cache,
+                                 balance_cache=balance_cache, slow_query_seconds=SLOW_QUERY_SECONDS),
+            admin_notification_window=ADMIN_NOTIFICATION_WINDOW,
+            max_concurrent_updates=BOT_MAX_CONCURRENT_UPDATES,
+            persistence_flush_interval=BOT_PERSISTENCE_FLUSH_INTERVAL,
+            metrics_port=BOT_METRICS_PORT,
+            user_rate=BOT_USER_RATE,
+            user_burst=BOT_USER_BURST,
+            max_update_age=BOT_MAX_UPDATE_AGE,
+        )
+
+    # Each worker builds its own bot, so pools and caches are per process
+    tb = ShardedBot(make_bot, TOKEN, workers=BOT_WORKERS, metrics_port=BOT_METRICS_PORT) if BOT_WORKERS > 1 else make_bot()
+    tb_th = Process(target=tb.run, kwargs={
+        "mode": BOT_MODE,
+        "webhook_listen": WEBHOOK_LISTEN,
+        "webhook_port": WEBHOOK_PORT,
+        "webhook_path": WEBHOOK_PATH,
+        "webhook_secret": WEBHOOK_SECRET,
+        "webhook_url": WEBHOOK_URL,
+    })
     tb_th.start()
 
+    # Built in the process that serves it, so no connection is shared across fork
+    # Every worker runs an outbox dispatcher; together they stay within OUTBOX_GLOBAL_RATE
+    outbox_global_rate = OUTBOX_GLOBAL_RATE / max(API_WORKERS, 1)
+
+    def make_api():
+        db_manager = DatabaseManager(DB_PARAMS, pool_size=DB_POOL_SIZE, slow_query_seconds=SLOW_QUERY_SECONDS,
+                                     replicas=DB_REPLICAS, replica_max_lag_seconds=DB_REPLICA_MAX_LAG,
+                                     read_your_writes_seconds=DB_READ_YOUR_WRITES)
+        if API_SERVER == "asgi":
+            # db_manager only backs the outbox dispatcher thread here
+            return AsyncAPI(TOKEN, AsyncDatabaseManager(DB_PARAMS, pool_size=API_DB_POOL_SIZE, slow_query_seconds=SLOW_QUERY_SECONDS), db_manager,
+                            outbox_global_rate=outbox_global_rate)
+        return API(TOKEN, db_manager, outbox_global_rate=outbox_global_rate)
+
     # Run API
-    api = API(TOKEN, db_manager)
-    api.run()
+    if API_WORKERS > 1:
+        def serve_api(index, sock, on_ready):
+            metrics_port = API_METRICS_PORT + index if API_METRICS_PORT is not None else None
+            make_api().run(sock=sock, on_ready=on_ready, drain_timeout=API_DRAIN_TIMEOUT, metrics_port=metrics_port)
+
+        APISupervisor(serve_api, workers=API_WORKERS, host=API_HOST, port=API_PORT,
+                      ready_file=API_READY_FILE, drain_timeout=API_DRAIN_TIMEOUT).run()
+    else:
+        try:
+            make_api().run(host=API_HOST, port=API_PORT, on_ready=lambda: mark_ready(API_READY_FILE),
+                           drain_timeout=API_DRAIN_TIMEOUT, metrics_port=API_METRICS_PORT)
+        finally:
+            mark_stopping(API_READY_FILE)
 
     # Shutdown a bot after an API
     tb_th.terminate()
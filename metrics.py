@@ -0,0 +1,254 @@
+"""
+Prometheus metrics for the API and the bot processes.
+
+Metrics live in a per-process registry and are rendered in the Prometheus
+text format, by the API's /metrics route and by start_http_server() in the
+bot and the API workers. Every process (API, bot, each sharded bot worker,
+each API worker) exports its own numbers on its own port; Prometheus adds
+them up. With several API workers behind one port, /metrics answers for
+whichever worker took the connection, so scrape their metrics ports
+instead.
+
+Statements slower than a manager's slow_query_seconds are logged to the
+"slow_queries" logger, without their parameters since those are phone
+numbers and amounts.
+"""
+import functools
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('slow_queries')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; from a cached lookup up to a Telegram call stuck in a timeout
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # label values tuple -> series state
+        self._series = {}
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            series = {key: self._copy(value) for key, value in self._series.items()}
+        for key, value in sorted(series.items()):
+            lines.extend(self._render_series(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def _render_series(self, key, value):
+        return [f'{self.name}_total{_format_labels(self.labelnames, key)} {value}']
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [per-bucket counts..., +Inf count, sum]
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    def _render_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), series):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [('le', bound)])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {series[-1]}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+HANDLER_SECONDS = Histogram('bot_handler_duration_seconds', 'Time spent in a Telegram update handler.', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors', 'Telegram update handlers that raised.', ['handler'])
+UPDATES_SHED = Counter('bot_updates_shed', 'Updates dropped by admission control instead of being handled.', ['reason'])
+DB_METHOD_SECONDS = Histogram('db_method_duration_seconds', 'Duration of database manager calls.', ['manager', 'method'])
+DB_LOCK_WAIT_SECONDS = Histogram('db_lock_wait_seconds', 'Time spent waiting for DatabaseManager.lock (single connection mode).')
+DB_LOCK_HOLD_SECONDS = Histogram('db_lock_hold_seconds', 'Time DatabaseManager.lock was held (single connection mode).')
+DB_STATEMENT_SECONDS = Histogram('db_statement_duration_seconds', 'Execution time of prepared statements (queries.STATEMENTS).', ['statement'])
+DB_SLOW_QUERIES = Counter('db_slow_queries', 'Statements slower than the slow query threshold.', ['manager'])
+TELEGRAM_REQUEST_SECONDS = Histogram('telegram_request_duration_seconds', 'Duration of outbound Bot API calls.', ['method', 'status'])
+
+
+def instrument_methods(cls, manager):
+    """Time every public method of a database manager class into DB_METHOD_SECONDS."""
+    for name, function in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.isfunction(function):
+            continue
+        # Generators hand their work out row by row; timing their creation would say nothing
+        if inspect.isgeneratorfunction(function) or inspect.isasyncgenfunction(function):
+            continue
+        setattr(cls, name, _timed_method(function, manager))
+    return cls
+
+
+def _timed_method(function, manager):
+    labels = {'manager': manager, 'method': function.__name__}
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def timed(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                DB_METHOD_SECONDS.observe(perf_counter() - started, **labels)
+    else:
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                DB_METHOD_SECONDS.observe(perf_counter() - started, **labels)
+    return timed
+
+
+def timed_handler(callback):
+    """Wrap a bot handler so its duration and failures are recorded under its name."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(perf_counter() - started, handler=name)
+
+    return timed
+
+
+def log_slow_query(manager, threshold, seconds, query):
+    if threshold is None or seconds < threshold:
+        return
+    DB_SLOW_QUERIES.inc(manager=manager)
+    if isinstance(query, bytes):
+        query = query.decode(errors='replace')
+    # One line per statement, whatever the indentation of the SQL in the source
+    statement = ' '.join(str(query).split())
+    if len(statement) > 500:
+        statement = statement[:500] + '...'
+    slow_query_logger.warning(f"Slow query ({manager}) took {seconds * 1000:.1f} ms: {statement}")
+
+
+def start_http_server(port, addr='0.0.0.0', registry=REGISTRY):
+    """Serve registry.render() on http://addr:port/metrics from a daemon thread; returns the server."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would drown the bot's own log
+            pass
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+    logger.info(f"Metrics exporter listening on {addr}:{port}")
+    return server
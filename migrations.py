@@ -0,0 +1,515 @@
+"""Versioned schema migrations.
+
+Run explicitly before starting the bot and API (main.py does it on start,
+``python migrations.py`` runs it on its own). Applied versions are recorded
+in schema_migrations. Migrations that build indexes use CREATE INDEX
+CONCURRENTLY, so they run outside a transaction and do not block writes.
+"""
+import logging
+import psycopg2
+
+from phones import MAX_DIGITS
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for pg_advisory_lock so two processes never migrate at once
+MIGRATION_LOCK_ID = 7201
+
+
+class Migration:
+    def __init__(self, version, description, steps, concurrent=False):
+        """
+        steps: SQL strings or callables taking a cursor.
+        concurrent: run in autocommit mode, required for CREATE INDEX CONCURRENTLY.
+        """
+        self.version = version
+        self.description = description
+        self.steps = steps
+        self.concurrent = concurrent
+
+
+def _drop_invalid_indexes(cursor):
+    # A failed CONCURRENTLY build leaves an INVALID index that IF NOT EXISTS would skip
+    cursor.execute('''
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema()
+    ''')
+    for (name,) in cursor.fetchall():
+        logger.warning(f"Dropping invalid index {name} left by an interrupted migration")
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+
+def _require_unique(table, column):
+    def check(cursor):
+        cursor.execute(f'''
+            SELECT {column}, COUNT(*) FROM {table}
+            WHERE {column} IS NOT NULL
+            GROUP BY {column} HAVING COUNT(*) > 1
+            ORDER BY COUNT(*) DESC LIMIT 10
+        ''')
+        duplicates = cursor.fetchall()
+        if duplicates:
+            raise RuntimeError(f"Cannot add a unique constraint on {table}.{column}, resolve duplicates first: {duplicates}")
+    return check
+
+
+def _unique_constraint(table, column):
+    # Build the index online, then attach it as a constraint (a short catalog-only lock)
+    name = f'{table}_{column}_key'
+    return [
+        _require_unique(table, column),
+        f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column})',
+        f'''
+        DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{name}') THEN
+                ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE USING INDEX {name};
+            END IF;
+        END $$
+        ''',
+    ]
+
+# (table, primary key, {text column: key column}) for every table that stores phones
+PHONE_KEY_COLUMNS = [
+    ('users', 'id', {'phone_number': 'phone_key'}),
+    ('assoc', 'user_id', {'phone_number': 'phone_key'}),
+    ('pending_actions', 'id', {'user_phone_number': 'user_phone_key', 'receiver_phone_number': 'receiver_phone_key'}),
+    ('actions', 'id', {'user_phone_number': 'user_phone_key', 'receiver_phone_number': 'receiver_phone_key'}),
+]
+
+# Must compute exactly what phones.phone_key() does
+PHONE_KEY_FUNCTION = f'''
+    CREATE OR REPLACE FUNCTION phone_key(phone TEXT) RETURNS BIGINT AS $$
+        SELECT CASE WHEN length(digits) BETWEEN 1 AND {MAX_DIGITS} THEN digits::bigint END
+        FROM (SELECT regexp_replace(phone, '[^0-9]', '', 'g') AS digits) d
+    $$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+'''
+
+
+def _phone_key_columns(table, columns):
+    # Adding a nullable column without a default is a catalog-only change; the trigger fills new rows
+    function = f'{table}_phone_keys'
+    assignments = ''.join(f'NEW.{key} := phone_key(NEW.{text});' for text, key in columns.items())
+    return [
+        *(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {key} BIGINT' for key in columns.values()),
+        f'''
+        CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+        BEGIN
+            {assignments}
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        f'DROP TRIGGER IF EXISTS {function} ON {table}',
+        f'''
+        CREATE TRIGGER {function} BEFORE INSERT OR UPDATE OF {', '.join(columns)} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {function}()
+        ''',
+    ]
+
+
+def _backfill_phone_keys(table, primary_key, columns, batch_size=10000):
+    # One short transaction per batch (the migration runs in autocommit), walking the primary key
+    def backfill(cursor):
+        assignments = ', '.join(f'{key} = phone_key(t.{text})' for text, key in columns.items())
+        stale = ' OR '.join(f't.{key} IS DISTINCT FROM phone_key(t.{text})' for text, key in columns.items())
+        last = None
+        total = 0
+        while True:
+            cursor.execute(f'''
+                WITH batch AS (
+                    SELECT {primary_key} FROM {table}
+                    WHERE %s IS NULL OR {primary_key} > %s
+                    ORDER BY {primary_key} LIMIT %s
+                ), updated AS (
+                    UPDATE {table} t SET {assignments}
+                    FROM batch WHERE t.{primary_key} = batch.{primary_key} AND ({stale})
+                    RETURNING 1
+                )
+                SELECT (SELECT MAX({primary_key}) FROM batch), (SELECT COUNT(*) FROM updated)
+            ''', (last, last, batch_size))
+            last, updated = cursor.fetchone()
+            if last is None:
+                break
+            total += updated
+        logger.info(f"Backfilled phone keys of {total} {table} rows")
+    return backfill
+
+
+# Above this many phones per statement the notification just says "everything"
+BALANCE_NOTIFY_MAX_PHONES = 100
+
+
+def _users_statistics_delta(rows):
+    # Signed aggregates of (sign, balance, info) rows taken from the trigger's transition tables
+    return f'''
+        UPDATE users_statistics s SET
+            total_users = s.total_users + d.total_users,
+            positive_balance_users = s.positive_balance_users + d.positive_balance_users,
+            zero_balance_users = s.zero_balance_users + d.zero_balance_users,
+            negative_balance_users = s.negative_balance_users + d.negative_balance_users,
+            total_balance = s.total_balance + d.total_balance,
+            users_without_info = s.users_without_info + d.users_without_info
+        FROM (
+            SELECT
+                COALESCE(SUM(sign), 0) AS total_users,
+                COALESCE(SUM(sign) FILTER (WHERE balance > 0), 0) AS positive_balance_users,
+                COALESCE(SUM(sign) FILTER (WHERE balance = 0), 0) AS zero_balance_users,
+                COALESCE(SUM(sign) FILTER (WHERE balance < 0), 0) AS negative_balance_users,
+                COALESCE(SUM(sign * balance), 0) AS total_balance,
+                COALESCE(SUM(sign) FILTER (WHERE info IS NULL OR info = ''), 0) AS users_without_info
+            FROM ({rows}) AS changed
+        ) d
+        WHERE s.id = 1;
+    '''
+
+
+REBUILD_USERS_STATISTICS = '''
+    INSERT INTO users_statistics (id, total_users, positive_balance_users, zero_balance_users,
+                                  negative_balance_users, total_balance, users_without_info)
+    SELECT 1,
+           COUNT(*),
+           COUNT(*) FILTER (WHERE balance > 0),
+           COUNT(*) FILTER (WHERE balance = 0),
+           COUNT(*) FILTER (WHERE balance < 0),
+           COALESCE(SUM(balance), 0),
+           COUNT(*) FILTER (WHERE info IS NULL OR info = '')
+    FROM users
+    ON CONFLICT (id) DO UPDATE SET
+        total_users = EXCLUDED.total_users,
+        positive_balance_users = EXCLUDED.positive_balance_users,
+        zero_balance_users = EXCLUDED.zero_balance_users,
+        negative_balance_users = EXCLUDED.negative_balance_users,
+        total_balance = EXCLUDED.total_balance,
+        users_without_info = EXCLUDED.users_without_info
+'''
+
+
+MIGRATIONS = [
+    Migration(1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            phone_number TEXT NOT NULL,
+            balance BIGINT NOT NULL,
+            info TEXT,
+            mir_karta TEXT,
+            mir_account TEXT,
+            balance_mir_karta TEXT,
+            bcr_plast_karta_nomer TEXT,
+            bcr_plast_karta_srok TEXT,
+            bcr_plast_karta_cvv TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS assoc (
+            user_id BIGINT NOT NULL PRIMARY KEY,
+            phone_number TEXT NOT NULL,
+            language VARCHAR(3) DEFAULT 'ru'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS pending_actions (
+            id SERIAL PRIMARY KEY,
+            user_phone_number TEXT NOT NULL,
+            receiver_phone_number TEXT NOT NULL,
+            amount BIGINT NOT NULL,
+            comment TEXT NOT NULL,
+            sender_info TEXT,
+            receiver_info TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS actions (
+            id SERIAL PRIMARY KEY,
+            user_phone_number TEXT NOT NULL,
+            receiver_phone_number TEXT NOT NULL,
+            amount BIGINT NOT NULL,
+            md5 TEXT NOT NULL,
+            comment TEXT
+        )
+        ''',
+    ]),
+    Migration(2, 'phone number indexes and unique constraints', [
+        _drop_invalid_indexes,
+        *_unique_constraint('users', 'phone_number'),
+        *_unique_constraint('assoc', 'phone_number'),
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS pending_actions_user_phone_number_idx ON pending_actions (user_phone_number)',
+    ], concurrent=True),
+    # Statement-level triggers keep the counters in the writing transaction,
+    # including bulk writes and edits made outside the bot
+    Migration(3, 'incrementally maintained users statistics', [
+        '''
+        CREATE TABLE IF NOT EXISTS users_statistics (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users BIGINT NOT NULL,
+            positive_balance_users BIGINT NOT NULL,
+            zero_balance_users BIGINT NOT NULL,
+            negative_balance_users BIGINT NOT NULL,
+            total_balance NUMERIC NOT NULL,
+            users_without_info BIGINT NOT NULL
+        )
+        ''',
+        f'''
+        CREATE OR REPLACE FUNCTION users_statistics_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {_users_statistics_delta("SELECT 1 AS sign, balance, info FROM new_rows")}
+            ELSIF TG_OP = 'UPDATE' THEN
+                {_users_statistics_delta("SELECT 1 AS sign, balance, info FROM new_rows UNION ALL SELECT -1, balance, info FROM old_rows")}
+            ELSE
+                {_users_statistics_delta("SELECT -1 AS sign, balance, info FROM old_rows")}
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE',
+        'DROP TRIGGER IF EXISTS users_statistics_insert ON users',
+        'DROP TRIGGER IF EXISTS users_statistics_update ON users',
+        'DROP TRIGGER IF EXISTS users_statistics_delete ON users',
+        '''
+        CREATE TRIGGER users_statistics_insert AFTER INSERT ON users
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION users_statistics_apply()
+        ''',
+        '''
+        CREATE TRIGGER users_statistics_update AFTER UPDATE ON users
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION users_statistics_apply()
+        ''',
+        '''
+        CREATE TRIGGER users_statistics_delete AFTER DELETE ON users
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION users_statistics_apply()
+        ''',
+        REBUILD_USERS_STATISTICS,
+    ]),
+    Migration(4, 'pending actions receiver index', [
+        _drop_invalid_indexes,
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS pending_actions_receiver_phone_number_idx ON pending_actions (receiver_phone_number)',
+    ], concurrent=True),
+    # Notifications are written here in the approval transaction and sent by outbox.OutboxDispatcher
+    Migration(5, 'notification outbox', [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            language VARCHAR(3),
+            template TEXT NOT NULL,
+            params JSONB NOT NULL DEFAULT '{}',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            sent_at TIMESTAMPTZ,
+            failed_at TIMESTAMPTZ,
+            last_error TEXT
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS outbox_due_idx ON outbox (next_attempt_at)
+        WHERE sent_at IS NULL AND failed_at IS NULL
+        ''',
+    ]),
+    # Lets every process keep the md5 chain head cached (ledger.LedgerHead)
+    Migration(6, 'ledger head notifications and verifier checkpoints', [
+        '''
+        CREATE OR REPLACE FUNCTION ledger_head_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('ledger_head', COALESCE((SELECT md5 FROM actions ORDER BY id DESC LIMIT 1), ''));
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS ledger_head_notify ON actions',
+        '''
+        CREATE TRIGGER ledger_head_notify AFTER INSERT OR UPDATE OR DELETE ON actions
+        FOR EACH STATEMENT EXECUTE FUNCTION ledger_head_notify()
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+            action_id INTEGER PRIMARY KEY,
+            md5 TEXT NOT NULL,
+            verified_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+    ]),
+    # python-telegram-bot user_data/chat_data, written by persistence.PostgresPersistence
+    Migration(7, 'bot conversation state', [
+        '''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            kind TEXT NOT NULL,
+            id BIGINT NOT NULL,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (kind, id)
+        )
+        ''',
+    ]),
+    # Invalidates balance_cache.BalanceCache in every process; bulk changes send '*'
+    Migration(8, 'balance change notifications', [
+        f'''
+        CREATE OR REPLACE FUNCTION balance_changed_notify() RETURNS trigger AS $$
+        DECLARE
+            phones TEXT[];
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                SELECT array_agg(DISTINCT phone_number) INTO phones FROM (
+                    SELECT unnest(ARRAY[o.phone_number, n.phone_number]) AS phone_number
+                    FROM old_rows o JOIN new_rows n USING (id)
+                    WHERE o.balance IS DISTINCT FROM n.balance OR o.phone_number IS DISTINCT FROM n.phone_number
+                ) changed;
+            ELSE
+                SELECT array_agg(DISTINCT phone_number) INTO phones FROM old_rows;
+            END IF;
+            IF phones IS NULL THEN
+                RETURN NULL;
+            ELSIF cardinality(phones) > {BALANCE_NOTIFY_MAX_PHONES} THEN
+                PERFORM pg_notify('balance_changed', '*');
+            ELSE
+                PERFORM pg_notify('balance_changed', array_to_string(phones, ','));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS balance_changed_update ON users',
+        'DROP TRIGGER IF EXISTS balance_changed_delete ON users',
+        '''
+        CREATE TRIGGER balance_changed_update AFTER UPDATE ON users
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION balance_changed_notify()
+        ''',
+        '''
+        CREATE TRIGGER balance_changed_delete AFTER DELETE ON users
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION balance_changed_notify()
+        ''',
+    ]),
+    # Phones are compared by their E.164 digits as a BIGINT (phones.phone_key), not as typed
+    Migration(9, 'phone key columns', [
+        PHONE_KEY_FUNCTION,
+        *(step for table, _, columns in PHONE_KEY_COLUMNS for step in _phone_key_columns(table, columns)),
+    ]),
+    Migration(10, 'phone key backfill and indexes', [
+        *(_backfill_phone_keys(table, primary_key, columns) for table, primary_key, columns in PHONE_KEY_COLUMNS),
+        _drop_invalid_indexes,
+        *_unique_constraint('users', 'phone_key'),
+        *_unique_constraint('assoc', 'phone_key'),
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS pending_actions_user_phone_key_idx ON pending_actions (user_phone_key)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS pending_actions_receiver_phone_key_idx ON pending_actions (receiver_phone_key)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS actions_user_phone_key_idx ON actions (user_phone_key)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS actions_receiver_phone_key_idx ON actions (receiver_phone_key)',
+        # Superseded by the key indexes above
+        'DROP INDEX CONCURRENTLY IF EXISTS pending_actions_user_phone_number_idx',
+        'DROP INDEX CONCURRENTLY IF EXISTS pending_actions_receiver_phone_number_idx',
+    ], concurrent=True),
+    # BalanceCache is keyed by phone key, so a change is announced by key rather than as typed
+    Migration(11, 'balance change notifications by phone key', [
+        f'''
+        CREATE OR REPLACE FUNCTION balance_changed_notify() RETURNS trigger AS $$
+        DECLARE
+            keys BIGINT[];
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                SELECT array_agg(DISTINCT phone_key) INTO keys FROM (
+                    SELECT unnest(ARRAY[o.phone_key, n.phone_key]) AS phone_key
+                    FROM old_rows o JOIN new_rows n USING (id)
+                    WHERE o.balance IS DISTINCT FROM n.balance OR o.phone_key IS DISTINCT FROM n.phone_key
+                ) changed
+                WHERE phone_key IS NOT NULL;
+            ELSE
+                SELECT array_agg(DISTINCT phone_key) INTO keys FROM old_rows WHERE phone_key IS NOT NULL;
+            END IF;
+            IF keys IS NULL THEN
+                RETURN NULL;
+            ELSIF cardinality(keys) > {BALANCE_NOTIFY_MAX_PHONES} THEN
+                PERFORM pg_notify('balance_changed', '*');
+            ELSE
+                PERFORM pg_notify('balance_changed', array_to_string(keys, ','));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+    ]),
+]
+
+
+def _ensure_version_table(conn):
+    with conn.cursor() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+
+
+def get_applied_versions(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('schema_migrations')")
+        if cursor.fetchone()[0] is None:
+            return set()
+        cursor.execute('SELECT version FROM schema_migrations')
+        return {version for (version,) in cursor.fetchall()}
+
+
+def get_pending_migrations(conn):
+    applied = get_applied_versions(conn)
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def _run_steps(cursor, steps):
+    for step in steps:
+        if callable(step):
+            step(cursor)
+        else:
+            cursor.execute(step)
+
+
+def migrate(db_params):
+    """Apply every pending migration in version order; returns the versions applied."""
+    conn = psycopg2.connect(**db_params)
+    conn.autocommit = True
+    applied_now = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        _ensure_version_table(conn)
+        for migration in get_pending_migrations(conn):
+            logger.info(f"Applying migration {migration.version}: {migration.description}")
+            if migration.concurrent:
+                # Steps are idempotent, so an interrupted run is simply retried
+                with conn.cursor() as cursor:
+                    _run_steps(cursor, migration.steps)
+                    cursor.execute('INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+                                   (migration.version, migration.description))
+            else:
+                conn.autocommit = False
+                try:
+                    with conn.cursor() as cursor:
+                        _run_steps(cursor, migration.steps)
+                        cursor.execute('INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+                                       (migration.version, migration.description))
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+            applied_now.append(migration.version)
+        return applied_now
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    from main import DB_PARAMS
+
+    logging.basicConfig(level=logging.INFO)
+    applied = migrate(DB_PARAMS)
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
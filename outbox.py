@@ -0,0 +1,157 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from database import DatabaseManager
+from metrics import TELEGRAM_REQUEST_SECONDS
+from ratelimit import KeyedRateLimiter, TokenBucket
+from translations import get_translation
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher:
+    """
+    Background sender for notifications queued in the outbox table.
+
+    Rows are leased in batches, rendered with the recipient's language and
+    posted to the Bot API over a keep-alive session by a small worker pool.
+    Sends are paced by a global and a per-chat token bucket, 429 responses
+    pause sending for the advertised retry_after, and other failures are
+    retried with exponential backoff until max_attempts.
+    """
+
+    def __init__(self, db: DatabaseManager, token: str, api_url='https://api.telegram.org',
+                 default_language_code='ru', workers=4, batch_size=100, poll_interval=1.0,
+                 global_rate=25, per_chat_rate=1, max_attempts=8, backoff_base=2.0, backoff_max=600.0,
+                 lease_seconds=300, request_timeout=10):
+        self.db = db
+        self.url = f"{api_url}/bot{token}/sendMessage"
+        self.default_language_code = default_language_code
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self.request_timeout = request_timeout
+
+        self.global_limit = TokenBucket(global_rate)
+        self.global_lock = threading.Lock()
+        self.chat_limit = KeyedRateLimiter(per_chat_rate)
+        self._paused_until = 0.0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbox')
+        self._thread = threading.Thread(target=self._run, name='outbox-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def wake(self):
+        # Called after a commit that queued notifications, so they go out without waiting for the next poll
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.dispatch_once()
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}")
+                claimed = 0
+            if claimed < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def dispatch_once(self):
+        """Lease one batch and send it; returns the number of rows leased."""
+        rows = self.db.claim_outbox(self.batch_size, self.lease_seconds)
+        futures = []
+        for row in rows:
+            # Reserve rate-limit slots in id order so each chat receives its messages in order
+            delay = max(self._reserve_global(), self.chat_limit.reserve(row[1]))
+            futures.append(self._executor.submit(self._send_row, row, time.monotonic() + delay))
+        sent = [future.result() for future in futures]
+        sent_ids = [id for id in sent if id is not None]
+        if sent_ids:
+            self.db.mark_outbox_sent(sent_ids)
+        return len(rows)
+
+    def _reserve_global(self):
+        with self.global_lock:
+            return max(self.global_limit.reserve(), self._paused_until - time.monotonic())
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base ** attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _send_row(self, row, not_before):
+        id, chat_id, language, template, params, attempts = row
+        try:
+            text = get_translation(language or self.default_language_code, template, **params)
+        except (KeyError, ValueError) as e:
+            self.db.fail_outbox(id, f"Cannot render {template}: {e}")
+            return None
+
+        while True:
+            wait = max(not_before, self._paused_until) - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.url, json={'chat_id': chat_id, 'text': text}, timeout=self.request_timeout)
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, method='sendMessage', status='error')
+            self._retry_or_fail(id, attempts, self._backoff(attempts), f"Request failed: {e}")
+            return None
+        TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, method='sendMessage', status=response.status_code)
+
+        if result.get('ok'):
+            return id
+        error = f"Telegram API response: {result}"
+        if response.status_code == 429:
+            # Flood control applies to the whole bot, so pause every sender
+            retry_after = (result.get('parameters') or {}).get('retry_after', 1)
+            with self.global_lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._retry_or_fail(id, attempts, retry_after, error)
+        elif 400 <= response.status_code < 500:
+            # Blocked bot, unknown chat and similar will not fix themselves
+            self.db.fail_outbox(id, error)
+            logger.warning(f"Outbox message {id} to chat {chat_id} failed for good: {error}")
+        else:
+            self._retry_or_fail(id, attempts, self._backoff(attempts), error)
+        return None
+
+    def _retry_or_fail(self, id, attempts, delay, error):
+        if attempts >= self.max_attempts:
+            self.db.fail_outbox(id, error)
+            logger.warning(f"Outbox message {id} failed after {attempts} attempts: {error}")
+        else:
+            self.db.retry_outbox(id, delay, error)
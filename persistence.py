@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from async_database import AsyncDatabaseManager
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = 'user'
+CHAT_DATA = 'chat'
+
+
+def _digest(text):
+    # Kept per user and chat for as long as the bot runs, so 16 bytes rather than the JSON itself
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+# What a deleted entry reads back as
+EMPTY = _digest('{}')
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    Keeps user_data and chat_data in the bot_state table, so the transfer
+    flow in send_handler survives restarts and can move between workers.
+
+    Nothing is read at startup: a user's (or chat's) entry is loaded the
+    first time one of their updates is processed. Writes are write-behind:
+    the Application hands over copies of touched entries every
+    update_interval seconds, entries whose JSON did not change are dropped,
+    and the rest are written as one batched upsert every flush_interval
+    seconds and on shutdown. Only JSON-serializable values are persisted.
+    """
+
+    def __init__(self, db: AsyncDatabaseManager, flush_interval=5.0, update_interval=1.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.flush_interval = flush_interval
+        # (kind, id) -> digest of the JSON text as last loaded or written
+        self._saved = {}
+        # (kind, id) -> JSON text to write, or None to delete
+        self._dirty = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.flushes = 0
+        self.written = 0
+
+    # Nothing is preloaded; entries are filled in by refresh_*_data
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def _refresh(self, kind, id, data):
+        if (kind, id) in self._saved or (kind, id) in self._dirty:
+            return
+        try:
+            stored = await self.db.get_bot_state(kind, id)
+        except Exception as e:
+            # Run the update with empty state rather than not at all; the next update retries the load
+            logger.error(f"Failed to load {kind} data of {id}: {e}")
+            return
+        self._saved[(kind, id)] = _digest(json.dumps(stored or {}, sort_keys=True))
+        if stored:
+            data.update(stored)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh(USER_DATA, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh(CHAT_DATA, chat_id, chat_data)
+
+    def _buffer(self, kind, id, data):
+        try:
+            text = json.dumps(data, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Cannot persist {kind} data of {id}: {e}")
+            return
+        if self._saved.get((kind, id)) == _digest(text):
+            self._dirty.pop((kind, id), None)
+        else:
+            self._dirty[(kind, id)] = text
+            self._start()
+
+    async def update_user_data(self, user_id, data):
+        self._buffer(USER_DATA, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._buffer(CHAT_DATA, chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._dirty[(USER_DATA, user_id)] = None
+        self._start()
+
+    async def drop_chat_data(self, chat_id):
+        self._dirty[(CHAT_DATA, chat_id)] = None
+        self._start()
+
+    def _start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._write()
+            except Exception as e:
+                # The batch stays buffered and is retried on the next run
+                logger.error(f"Failed to write bot state: {e}")
+
+    async def _write(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            upserts = [(kind, id, text) for (kind, id), text in batch.items() if text is not None]
+            deletes = [key for key, text in batch.items() if text is None]
+            try:
+                await self.db.save_bot_state(upserts, deletes)
+            except BaseException:
+                # Keep anything newer that arrived while we were writing (also on cancellation)
+                self._dirty = {**batch, **self._dirty}
+                raise
+            for kind, id, text in upserts:
+                self._saved[(kind, id)] = _digest(text)
+            for key in deletes:
+                self._saved[key] = EMPTY
+            self.flushes += 1
+            self.written += len(batch)
+
+    async def flush(self):
+        # Called by Application.shutdown after its last update_persistence run
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._write()
@@ -0,0 +1,43 @@
+"""
+Phone number normalization shared by the bot, the database managers and bulk import.
+
+Every phone is stored as typed or shared ('+7 999 123-45-67', '79991234567'),
+and compared by its canonical key: the E.164 digits as a BIGINT. The
+phone_key() SQL function (migration 9) computes the same key, and triggers
+keep the *_phone_key columns filled from the text columns.
+"""
+import re
+
+# E.164 numbers have at most 15 digits, so the key always fits in a BIGINT
+MAX_DIGITS = 15
+
+# ASCII only: \d would also accept other scripts' digits, which the SQL side strips
+_NON_DIGITS = re.compile(r'[^0-9]')
+
+
+def _digits(phone_number):
+    if phone_number is None:
+        return None
+    digits = _NON_DIGITS.sub('', phone_number)
+    if not digits or len(digits) > MAX_DIGITS:
+        return None
+    return digits
+
+
+def normalize(phone_number, require_plus=False):
+    """
+    '+<digits>' for a phone number in any formatting, or None if it cannot be
+    one. require_plus rejects numbers typed without the international prefix.
+    """
+    if phone_number is None:
+        return None
+    if require_plus and not phone_number.strip().startswith('+'):
+        return None
+    digits = _digits(phone_number)
+    return '+' + digits if digits else None
+
+
+def phone_key(phone_number):
+    """The canonical BIGINT key of a phone number, None if it cannot be one."""
+    digits = _digits(phone_number)
+    return int(digits) if digits else None
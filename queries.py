@@ -0,0 +1,152 @@
+"""
+Server-side prepared statements for DatabaseManager's hot queries.
+
+Each statement is PREPAREd on a connection the first time that connection
+runs it and EXECUTEd by name from then on, so Postgres parses and plans it
+once per session instead of on every call. Prepared names are tracked per
+connection object: a reconnect, a fork or a pool replacing a connection
+gives a new object, which prepares again. Prepared statements survive
+rollbacks, so a failed transaction does not lose them.
+
+Calls and durations are kept per statement (STATEMENTS.get_statistics())
+and exported as db_statement_duration_seconds{statement}.
+"""
+import logging
+import weakref
+from threading import Lock
+from time import perf_counter
+
+import psycopg2
+import psycopg2.errors
+
+from metrics import DB_STATEMENT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class Statement:
+    def __init__(self, name, types, sql):
+        self.name = name
+        self.types = tuple(types)
+        self.sql = sql
+        self.prepare_sql = f"PREPARE {name} ({', '.join(self.types)}) AS {sql}" if self.types else f'PREPARE {name} AS {sql}'
+        # Parameters are still interpolated by psycopg2, as literals of the prepared types
+        self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * len(self.types))})" if self.types else f'EXECUTE {name}'
+        self._lock = Lock()
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self.calls += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+        DB_STATEMENT_SECONDS.observe(seconds, statement=self.name)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'total_seconds': self.total,
+                'avg_seconds': self.total / self.calls if self.calls else 0.0,
+                'max_seconds': self.max,
+            }
+
+
+class StatementRegistry:
+    def __init__(self):
+        self._statements = {}
+        # connection -> names prepared on it; entries go away with the connection
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = Lock()
+
+    def add(self, name, types, sql):
+        """Register `sql` (with $1, $2... placeholders of the given types) under `name`."""
+        if name in self._statements:
+            raise ValueError(f"Statement {name} is already registered")
+        statement = self._statements[name] = Statement(name, types, sql)
+        return statement
+
+    def _prepared_on(self, conn):
+        with self._lock:
+            prepared = self._prepared.get(conn)
+            if prepared is None:
+                prepared = self._prepared[conn] = set()
+            return prepared
+
+    def execute(self, cursor, name, params=()):
+        """Run statement `name` on the cursor, preparing it on this connection first if needed."""
+        statement = self._statements[name]
+        # A connection is only used by one thread at a time, so its set needs no lock
+        prepared = self._prepared_on(cursor.connection)
+        if name not in prepared:
+            cursor.execute(statement.prepare_sql)
+            prepared.add(name)
+        started = perf_counter()
+        try:
+            cursor.execute(statement.execute_sql, params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # Deallocated behind our back (DISCARD ALL, a pooler); prepare everything again next time
+            logger.warning(f"Prepared statement {name} disappeared, re-preparing on the next call")
+            prepared.clear()
+            raise
+        statement.record(perf_counter() - started)
+
+    def get_statistics(self):
+        # Busiest first: the statements worth looking at
+        statistics = {name: statement.snapshot() for name, statement in self._statements.items()}
+        return dict(sorted(statistics.items(), key=lambda item: item[1]['total_seconds'], reverse=True))
+
+
+STATEMENTS = StatementRegistry()
+
+STATEMENTS.add('add_user', ['text'], 'INSERT INTO users (phone_number, balance) VALUES ($1, 0)')
+STATEMENTS.add('get_user', ['bigint'], 'SELECT * FROM users WHERE phone_key = $1')
+# Nothing is inserted when the phone (or the user) is already linked; RETURNING tells the two apart
+STATEMENTS.add('add_assoc', ['bigint', 'text'],
+               'INSERT INTO assoc (user_id, phone_number) VALUES ($1, $2) ON CONFLICT DO NOTHING RETURNING user_id')
+STATEMENTS.add('get_session', ['bigint'], 'SELECT phone_number, language FROM assoc WHERE user_id = $1')
+STATEMENTS.add('get_reverse_assoc', ['bigint'], 'SELECT user_id FROM assoc WHERE phone_key = $1')
+STATEMENTS.add('set_user_language', ['text', 'bigint'], 'UPDATE assoc SET language = $1 WHERE user_id = $2')
+STATEMENTS.add('get_balance', ['bigint'], 'SELECT balance FROM users WHERE phone_key = $1')
+STATEMENTS.add('get_user_info', ['bigint'], 'SELECT info, balance FROM users WHERE phone_key = $1')
+STATEMENTS.add('get_all_pending_actions', [], 'SELECT * FROM pending_actions')
+STATEMENTS.add('get_users_statistics', [], '''
+    SELECT total_users, positive_balance_users, zero_balance_users,
+           negative_balance_users, total_balance, users_without_info
+    FROM users_statistics WHERE id = 1
+''')
+STATEMENTS.add('create_pending_action', ['text', 'text', 'bigint', 'text', 'text', 'text'], '''
+    INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, sender_info, receiver_info, comment)
+    VALUES ($1, $2, $3, $4, $5, $6)
+''')
+STATEMENTS.add('remove_pending_action', ['integer'],
+               'DELETE FROM pending_actions WHERE id = $1 RETURNING user_phone_number, receiver_phone_number, amount')
+STATEMENTS.add('lock_pending_action', ['integer'], '''
+    SELECT user_phone_number, receiver_phone_number, amount, comment
+    FROM pending_actions
+    WHERE id = $1
+    FOR UPDATE
+''')
+STATEMENTS.add('add_balance', ['bigint', 'bigint'], 'UPDATE users SET balance = balance + $1 WHERE phone_key = $2')
+STATEMENTS.add('delete_pending_action', ['integer'], 'DELETE FROM pending_actions WHERE id = $1')
+STATEMENTS.add('insert_action', ['text', 'text', 'bigint', 'text', 'text'], '''
+    INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5, comment)
+    VALUES ($1, $2, $3, $4, $5)
+''')
+STATEMENTS.add('get_last_md5', [], 'SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
+STATEMENTS.add('lock_ledger', ['bigint'], 'SELECT pg_advisory_xact_lock($1)')
+STATEMENTS.add('claim_outbox', ['double precision', 'integer'], '''
+    UPDATE outbox SET attempts = attempts + 1, next_attempt_at = now() + $1 * interval '1 second'
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE sent_at IS NULL AND failed_at IS NULL AND next_attempt_at <= now()
+        ORDER BY id
+        LIMIT $2
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, chat_id, language, template, params, attempts
+''')
+STATEMENTS.add('mark_outbox_sent', ['bigint[]'], 'UPDATE outbox SET sent_at = now(), last_error = NULL WHERE id = ANY($1)')
@@ -0,0 +1,171 @@
+"""
+Read replica routing for DatabaseManager.
+
+Read-only methods (balances, assoc lookups, pending action lists, users
+statistics) go to the replicas in round-robin order, everything else and
+every read that cannot be served by a replica goes to the primary:
+
+- A background thread checks every replica each check_interval seconds. A
+  replica that cannot be reached, has lost its connection to the primary
+  or replays more than max_lag_seconds behind it gets no reads until a
+  later check passes. A replica
+  that fails a read is taken out right away and the read is retried on the
+  primary.
+- After a write, the keys it touched (a user id, a phone key, the pending
+  actions list) are read from the primary for read_your_writes_seconds,
+  so nobody reads back an older version of what they just changed. This
+  only covers writes made by the same process.
+
+To try it locally, run a second instance as a streaming standby of the
+first and list it in DB_REPLICAS:
+
+    pg_basebackup -h 127.0.0.1 -p 5432 -U postgres -D /tmp/replica -R
+    pg_ctl -D /tmp/replica -o '-p 5433' start
+"""
+import logging
+import os
+import threading
+from itertools import count
+from time import monotonic
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# Seconds the replica's replay is behind, 0 when it has replayed everything it received, NULL
+# when it is not streaming from the primary: having replayed all it received then says nothing
+# about how far behind it is. pg_stat_wal_receiver only shows the status to superusers and
+# pg_read_all_stats members, so the replica's role needs one of those
+LAG_QUERY = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+
+class Replica:
+    def __init__(self, db_params, connect):
+        self.db_params = db_params
+        self.name = f"{db_params.get('host')}:{db_params.get('port')}"
+        self._connect = connect
+        self.manager = None
+        self.healthy = False
+        self.lag = None
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+
+    def check(self, max_lag_seconds):
+        try:
+            if self.manager is None:
+                self.manager = self._connect(self.db_params)
+            with self.manager._transaction() as cursor:
+                cursor.execute(LAG_QUERY)
+                lag = cursor.fetchone()[0]
+        except psycopg2.Error as e:
+            self.mark_down(e)
+            return
+        if lag is None:
+            self.lag = None
+            self.mark_down('not streaming from the primary')
+            return
+        self.lag = float(lag)
+        healthy = max_lag_seconds is None or self.lag <= max_lag_seconds
+        if healthy != self.healthy:
+            logger.info(f"Replica {self.name} is {'back' if healthy else f'{self.lag:.1f}s behind, skipping it'}")
+        self.healthy = healthy
+
+    def mark_down(self, error):
+        if self.healthy:
+            logger.warning(f"Replica {self.name} is down: {error}")
+        self.healthy = False
+        self.failures += 1
+        self.last_error = str(error)
+
+
+class ReplicaRouter:
+    def __init__(self, replicas, connect, check_interval=5.0, max_lag_seconds=10.0, read_your_writes_seconds=5.0):
+        """
+        replicas: db_params of every replica.
+        connect: db_params -> DatabaseManager for one replica.
+        """
+        self.replicas = [Replica(db_params, connect) for db_params in replicas]
+        self.check_interval = check_interval
+        self.max_lag_seconds = max_lag_seconds
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self._next = count()
+        self._lock = threading.Lock()
+        # key -> monotonic time until which it is read from the primary
+        self._written = {}
+        self._checker_pid = None
+        self.primary_reads = 0
+        self.check()
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check(self.max_lag_seconds)
+
+    def _run_checks(self, stop):
+        while not stop.wait(self.check_interval):
+            self.check()
+
+    def _ensure_checker(self):
+        # Threads do not survive fork, so each process starts its own
+        pid = os.getpid()
+        if self._checker_pid == pid:
+            return
+        with self._lock:
+            if self._checker_pid == pid:
+                return
+            self._checker_pid = pid
+            self._stop = threading.Event()
+            threading.Thread(target=self._run_checks, args=(self._stop,), name='replica-checks', daemon=True).start()
+
+    def wrote(self, keys):
+        until = monotonic() + self.read_your_writes_seconds
+        with self._lock:
+            for key in keys:
+                self._written[key] = until
+            if len(self._written) > 10000:
+                now = monotonic()
+                self._written = {key: until for key, until in self._written.items() if until > now}
+
+    def _recently_written(self, keys):
+        now = monotonic()
+        with self._lock:
+            return any(self._written.get(key, 0) > now for key in keys)
+
+    def choose(self, keys=()):
+        """A healthy replica to read `keys` from, or None to read from the primary."""
+        self._ensure_checker()
+        if not self._recently_written(keys):
+            healthy = [replica for replica in self.replicas if replica.healthy]
+            if healthy:
+                replica = healthy[next(self._next) % len(healthy)]
+                replica.reads += 1
+                return replica
+        self.primary_reads += 1
+        return None
+
+    def stop(self):
+        if self._checker_pid is not None:
+            self._stop.set()
+
+    def get_statistics(self):
+        return {
+            'primary_reads': self.primary_reads,
+            'replicas': [
+                {
+                    'name': replica.name,
+                    'healthy': replica.healthy,
+                    'lag_seconds': replica.lag,
+                    'reads': replica.reads,
+                    'failures': replica.failures,
+                    'last_error': replica.last_error,
+                }
+                for replica in self.replicas
+            ],
+        }
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class SessionCache:
+    """Bounded LRU/TTL cache of user_id -> (phone_number, language).
+
+    DatabaseManager and AsyncDatabaseManager consult it in get_assoc and
+    get_user_language and invalidate entries in add_assoc and
+    set_user_language, so handlers need no changes.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Bumped on every invalidation; a read that raced with a write must not repopulate
+        self._generation = 0
+
+    def generation(self):
+        return self._generation
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                value, expires = entry
+                if expires > monotonic():
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return value
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, phone_number, language, generation):
+        with self.lock:
+            if generation != self._generation:
+                return
+            self._entries[user_id] = ((phone_number, language), monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+    def get_statistics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+
+from telegram import Bot, Update
+
+from update_processor import PerUserUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedBot:
+    """
+    Receives updates once and spreads them over `workers` bot processes.
+
+    Every update goes to worker user_id % workers (chat id when there is no
+    user), so one user's updates always land on the same worker and stay in
+    order there, while different users are handled on different cores.
+    bot_factory builds a TelegramBot inside each worker process, so every
+    worker has its own database pool and caches. With metrics_port set,
+    worker i exports its Prometheus metrics on metrics_port + i.
+    """
+
+    def __init__(self, bot_factory, token, workers=2, base_url='https://api.telegram.org/bot',
+                 max_queue_size=10000, metrics_interval=60.0, metrics_port=None):
+        self.bot_factory = bot_factory
+        self.bot = Bot(token, base_url=base_url)
+        self.workers = workers
+        self.metrics_interval = metrics_interval
+        self.metrics_port = metrics_port
+        self.queues = [multiprocessing.Queue(max_queue_size) for _ in range(workers)]
+        # Shared with the workers: updates routed to / finished by each one
+        self.dispatched = [multiprocessing.Value('q', 0) for _ in range(workers)]
+        self.processed = [multiprocessing.Value('q', 0) for _ in range(workers)]
+        self.processes = []
+        # Next getUpdates offset: one past the last update handed to a worker
+        self._offset = None
+
+    def _worker(self, index):
+        # Ctrl-C reaches the whole process group; the dispatcher decides when workers stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        processed = self.processed[index]
+
+        def on_processed():
+            with processed.get_lock():
+                processed.value += 1
+
+        metrics_port = self.metrics_port + index if self.metrics_port is not None else None
+        self.bot_factory().run_worker(self.queues[index], on_processed=on_processed, metrics_port=metrics_port)
+
+    def start_workers(self):
+        for index in range(self.workers):
+            process = multiprocessing.Process(target=self._worker, args=(index,), name=f'bot-worker-{index}')
+            process.start()
+            self.processes.append(process)
+
+    def stop_workers(self, timeout=30):
+        # Workers finish what is already queued before they see the sentinel
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.processes = []
+
+    def shard(self, update: Update):
+        key = PerUserUpdateProcessor.key(update)
+        return key % self.workers if key is not None else 0
+
+    async def dispatch(self, update: Update):
+        index = self.shard(update)
+        # put blocks only when a worker's queue is full, which is the back-pressure we want
+        await asyncio.get_running_loop().run_in_executor(None, self.queues[index].put, update.to_dict())
+        with self.dispatched[index].get_lock():
+            self.dispatched[index].value += 1
+
+    def get_statistics(self):
+        statistics = []
+        for index in range(self.workers):
+            dispatched = self.dispatched[index].value
+            processed = self.processed[index].value
+            statistics.append({
+                'worker': index,
+                'alive': index < len(self.processes) and self.processes[index].is_alive(),
+                'queue_depth': self.queues[index].qsize(),
+                'in_flight': dispatched - processed,
+                'dispatched': dispatched,
+                'processed': processed,
+            })
+        return statistics
+
+    async def _log_statistics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            for worker in self.get_statistics():
+                logger.info(f"Bot worker {worker['worker']}: queue depth {worker['queue_depth']}, "
+                            f"in flight {worker['in_flight']}, processed {worker['processed']}")
+
+    async def _poll(self):
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=self._offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.error(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.dispatch(update)
+                self._offset = update.update_id + 1
+
+    async def _confirm_offset(self):
+        # Telegram only forgets updates once a getUpdates call passes an offset beyond them;
+        # without this the last batch would be delivered and dispatched again after a restart
+        if self._offset is None:
+            return
+        try:
+            await self.bot.get_updates(offset=self._offset, timeout=0, allowed_updates=Update.ALL_TYPES)
+        except Exception as e:
+            logger.error(f"Could not confirm update offset {self._offset}: {e}")
+
+    async def _serve_webhook(self, listen, port, path, secret, webhook_url):
+        import uvicorn
+        from webhook import WebhookReceiver, WebhookServer
+
+        if not secret:
+            raise ValueError("Webhook mode needs a secret token")
+        if webhook_url:
+            await self.bot.set_webhook(url=webhook_url + path, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        receiver = WebhookReceiver(self.bot, self.dispatch, secret, url_path=path)
+        await WebhookServer(uvicorn.Config(receiver.app, host=listen, port=port, log_level='warning')).serve()
+
+    async def _run(self, mode, webhook_listen, webhook_port, webhook_path, webhook_secret, webhook_url):
+        await self.bot.initialize()
+        metrics = asyncio.create_task(self._log_statistics())
+        try:
+            if mode == 'webhook':
+                await self._serve_webhook(webhook_listen, webhook_port, webhook_path, webhook_secret, webhook_url)
+            else:
+                # Polling and webhooks are exclusive on Telegram's side
+                await self.bot.delete_webhook()
+                receiver = asyncio.create_task(self._poll())
+                stop = asyncio.Event()
+                loop = asyncio.get_running_loop()
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    loop.add_signal_handler(sig, stop.set)
+                await stop.wait()
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+                await self._confirm_offset()
+        finally:
+            metrics.cancel()
+            await self.bot.shutdown()
+
+    def run(self, mode='polling', webhook_listen='0.0.0.0', webhook_port=8443, webhook_path='/telegram',
+            webhook_secret=None, webhook_url=None):
+        """Same arguments as TelegramBot.run; returns after SIGTERM/SIGINT once the workers are drained."""
+        self.start_workers()
+        try:
+            asyncio.run(self._run(mode, webhook_listen, webhook_port, webhook_path, webhook_secret, webhook_url))
+        finally:
+            started = time.monotonic()
+            self.stop_workers()
+            logger.info(f"Bot workers stopped in {time.monotonic() - started:.1f}s")
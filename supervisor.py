@@ -0,0 +1,221 @@
+"""
+Multi-process API: a supervisor running N API workers on one port.
+
+Every worker binds its own SO_REUSEPORT socket on host:port, so the
+kernel spreads new connections over the workers without a shared accept
+queue, and builds its API (and with it every database connection) after
+fork. A crashed worker is started again; on SIGTERM or SIGINT the workers
+stop accepting, finish their in-flight requests and exit.
+
+Readiness is signalled once migrations have run (main.py does that before
+starting the supervisor) and every worker has checked its database
+connection: ready_file is written with the supervisor's pid and systemd
+gets READY=1 when the service is Type=notify. Both are withdrawn as soon
+as shutdown begins.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+from multiprocessing.connection import wait
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+def listen_socket(host, port, backlog=2048):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def sd_notify(state):
+    """Send `state` to systemd's NOTIFY_SOCKET; does nothing when not started by systemd."""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError as e:
+        logger.warning(f"sd_notify failed: {e}")
+        return False
+    return True
+
+
+def mark_ready(ready_file=None, status=None):
+    if ready_file:
+        # Written whole or not at all, for whatever polls it
+        tmp = f'{ready_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(f'{os.getpid()}\n')
+        os.replace(tmp, ready_file)
+    sd_notify('READY=1' + (f'\nSTATUS={status}' if status else ''))
+    logger.info(f"API ready{f': {status}' if status else ''}")
+
+
+def mark_stopping(ready_file=None):
+    if ready_file:
+        try:
+            os.unlink(ready_file)
+        except FileNotFoundError:
+            pass
+    sd_notify('STOPPING=1')
+
+
+class _Slot:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        # Read end of the pipe the worker reports readiness on
+        self.conn = None
+        self.ready = False
+        self.started = None
+        self.restart_at = 0.0
+        self.failures = 0
+        self.restarts = 0
+
+
+class APISupervisor:
+    def __init__(self, serve, workers=2, host='0.0.0.0', port=5000, backlog=2048, ready_file=None,
+                 drain_timeout=30.0, restart_delay=1.0, max_restart_delay=30.0):
+        """
+        serve(index, sock, on_ready) runs in each worker: it builds the API
+        there, serves on the listening socket, calls on_ready() once its
+        database connection is checked and returns after draining on SIGTERM.
+        index (0 to workers - 1) stays with the slot across restarts, for
+        anything a worker needs to own alone, like its metrics port.
+
+        A worker that exits is restarted after restart_delay seconds, doubled
+        for every crash in a row up to max_restart_delay; one that ran for
+        max_restart_delay seconds starts the count over.
+        """
+        self.serve = serve
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.ready_file = ready_file
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.slots = [_Slot(index) for index in range(workers)]
+        self.ready = False
+        self._stopping = False
+
+    def _worker(self, index, writer):
+        # The supervisor's handlers came along with fork: SIGTERM is for serve to drain on,
+        # and Ctrl-C reaches the whole process group, so only the supervisor acts on it
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sock = listen_socket(self.host, self.port, self.backlog)
+
+        def on_ready():
+            writer.send(os.getpid())
+            writer.close()
+
+        self.serve(index, sock, on_ready)
+
+    def _start(self, slot):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=self._worker, args=(slot.index, writer), name=f'api-worker-{slot.index}')
+        process.start()
+        writer.close()
+        slot.process, slot.conn, slot.ready, slot.started = process, reader, False, monotonic()
+
+    def _exited(self, slot):
+        process = slot.process
+        process.join()
+        slot.conn.close()
+        slot.process, slot.conn, slot.ready = None, None, False
+        if self._stopping:
+            return
+        ran = monotonic() - slot.started
+        slot.failures = 1 if ran >= self.max_restart_delay else slot.failures + 1
+        delay = min(self.restart_delay * 2 ** (slot.failures - 1), self.max_restart_delay)
+        slot.restart_at = monotonic() + delay
+        slot.restarts += 1
+        logger.error(f"API worker {slot.index} (pid {process.pid}) exited with code {process.exitcode} "
+                     f"after {ran:.1f}s, restarting in {delay:.1f}s")
+
+    def _poll(self, timeout):
+        now = monotonic()
+        for slot in self.slots:
+            if slot.process is None and now >= slot.restart_at:
+                self._start(slot)
+        waiting = {}
+        for slot in self.slots:
+            if slot.process is not None:
+                waiting[slot.process.sentinel] = slot
+                if not slot.ready:
+                    waiting[slot.conn] = slot
+        pending_restart = [slot.restart_at - now for slot in self.slots if slot.process is None]
+        for handle in wait(list(waiting), max(0.0, min([timeout] + pending_restart))):
+            slot = waiting[handle]
+            if slot.process is None:
+                # Its exit was handled through the other handle in this same batch
+                continue
+            if handle is slot.conn:
+                try:
+                    slot.conn.recv()
+                except EOFError:
+                    # Died before it was ready; the sentinel tells the rest
+                    continue
+                slot.ready = True
+                logger.info(f"API worker {slot.index} (pid {slot.process.pid}) is ready")
+            else:
+                self._exited(slot)
+        if not self.ready and all(slot.ready for slot in self.slots):
+            self.ready = True
+            mark_ready(self.ready_file, f'{len(self.slots)} API workers on {self.host}:{self.port}')
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _shutdown(self):
+        mark_stopping(self.ready_file)
+        running = [slot for slot in self.slots if slot.process is not None]
+        logger.info(f"Draining {len(running)} API workers")
+        for slot in running:
+            slot.process.terminate()
+        # Workers get drain_timeout for requests in flight, plus a little for their own cleanup
+        deadline = monotonic() + self.drain_timeout + 10
+        for slot in running:
+            slot.process.join(max(0.0, deadline - monotonic()))
+        for slot in running:
+            if slot.process.is_alive():
+                logger.warning(f"API worker {slot.index} (pid {slot.process.pid}) did not drain in time, killing it")
+                slot.process.kill()
+                slot.process.join()
+            slot.conn.close()
+            slot.process, slot.conn, slot.ready = None, None, False
+
+    def get_statistics(self):
+        return [
+            {
+                'worker': slot.index,
+                'pid': slot.process.pid if slot.process is not None else None,
+                'ready': slot.ready,
+                'restarts': slot.restarts,
+            }
+            for slot in self.slots
+        ]
+
+    def run(self):
+        """Start the workers and keep them running; returns after SIGTERM/SIGINT once they have drained."""
+        previous = {sig: signal.signal(sig, self._stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            while not self._stopping:
+                self._poll(1.0)
+        finally:
+            self._shutdown()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
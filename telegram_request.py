@@ -0,0 +1,19 @@
+from time import perf_counter
+
+from telegram.request import HTTPXRequest
+
+from metrics import TELEGRAM_REQUEST_SECONDS
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest that records every Bot API call in TELEGRAM_REQUEST_SECONDS."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        started = perf_counter()
+        status = 'error'
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            return status, payload
+        finally:
+            # The Bot API method is the last path segment: .../bot<token>/sendMessage
+            TELEGRAM_REQUEST_SECONDS.observe(perf_counter() - started, method=url.rsplit('/', 1)[-1], status=status)
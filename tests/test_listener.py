@@ -0,0 +1,75 @@
+import asyncio
+
+import listener
+from listener import AsyncDatabaseListener
+
+
+class FakeConnection:
+    def __init__(self):
+        self.listeners = {}
+        self.on_terminate = None
+        self.closed = False
+
+    def add_termination_listener(self, callback):
+        self.on_terminate = callback
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    def notify(self, channel, payload):
+        self.listeners[channel](self, 0, channel, payload)
+
+    def drop(self):
+        self.closed = True
+        self.on_terminate(self)
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+    def terminate(self):
+        self.closed = True
+
+
+def test_async_listener_keeps_reconnecting_after_any_error(monkeypatch):
+    async def scenario():
+        connections = []
+        failures = [asyncio.TimeoutError(), RuntimeError('protocol error')]
+
+        async def connect(**db_params):
+            if failures:
+                raise failures.pop(0)
+            connections.append(FakeConnection())
+            return connections[-1]
+
+        monkeypatch.setattr(listener.asyncpg, 'connect', connect)
+        reconnects = []
+
+        def on_reconnect():
+            reconnects.append(len(connections))
+            if len(reconnects) == 1:
+                raise ValueError('cache refused to clear')
+
+        payloads = []
+        db_listener = AsyncDatabaseListener({'port': '5432'}, {'balance': payloads.append}, on_reconnect=on_reconnect, retry_interval=0.01)
+        db_listener.start()
+
+        async def wait_for(condition):
+            while not condition():
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(wait_for(lambda: len(reconnects) == 2), timeout=2)
+        connections[-1].notify('balance', '79000000000')
+        connections[-1].drop()
+        await asyncio.wait_for(wait_for(lambda: len(reconnects) == 3), timeout=2)
+        connections[-1].notify('balance', '*')
+        await db_listener.stop()
+        return connections, reconnects, payloads, db_listener
+
+    connections, reconnects, payloads, db_listener = asyncio.run(scenario())
+    assert reconnects == [1, 2, 3]
+    assert payloads == ['79000000000', '*']
+    assert all(conn.closed for conn in connections)
+    assert db_listener._task is None
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.stub_telegram import StubTelegram
+from outbox import OutboxDispatcher
+
+
+class FakeOutboxDB:
+    """The outbox methods of DatabaseManager over an in-memory table."""
+
+    def __init__(self, rows):
+        # id -> row state, with the columns claim_outbox works on
+        self.rows = {
+            id: {'chat_id': chat_id, 'template': template, 'params': params, 'attempts': 0,
+                 'next_attempt_at': 0.0, 'sent': False, 'failed': False, 'errors': []}
+            for id, (chat_id, template, params) in enumerate(rows, 1)
+        }
+        self.retries = []
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def claim_outbox(self, limit, lease_seconds):
+        now = time.monotonic()
+        claimed = []
+        with self.lock:
+            for id, row in sorted(self.rows.items()):
+                if row['sent'] or row['failed'] or row['next_attempt_at'] > now or len(claimed) == limit:
+                    continue
+                row['attempts'] += 1
+                row['next_attempt_at'] = now + lease_seconds
+                claimed.append((id, row['chat_id'], 'en', row['template'], row['params'], row['attempts']))
+        return claimed
+
+    def mark_outbox_sent(self, ids):
+        with self.lock:
+            for id in ids:
+                self.rows[id]['sent'] = True
+            self._check_finished()
+
+    def retry_outbox(self, id, delay_seconds, error):
+        with self.lock:
+            self.retries.append((id, delay_seconds))
+            self.rows[id]['next_attempt_at'] = time.monotonic() + delay_seconds
+            self.rows[id]['errors'].append(error)
+
+    def fail_outbox(self, id, error):
+        with self.lock:
+            self.rows[id]['failed'] = True
+            self.rows[id]['errors'].append(error)
+            self._check_finished()
+
+    def _check_finished(self):
+        if all(row['sent'] or row['failed'] for row in self.rows.values()):
+            self.finished.set()
+
+
+@pytest.fixture
+def stub():
+    stub = StubTelegram().start()
+    yield stub
+    stub.stop()
+
+
+def run_dispatcher(db, stub, **kwargs):
+    dispatcher = OutboxDispatcher(db, '1:test', api_url=stub.url, poll_interval=0.05, global_rate=1000, per_chat_rate=1000, **kwargs)
+    dispatcher.start()
+    try:
+        assert db.finished.wait(10), db.rows
+    finally:
+        dispatcher.stop()
+
+
+def remove_message(amount):
+    return 'remove_message_snd', {'amount': amount, 'recv_phone': '+70000000000'}
+
+
+def test_429_pauses_every_chat_and_the_message_is_retried(stub):
+    stub.fail_next = 1
+    stub.retry_after = 1
+    db = FakeOutboxDB([(1, *remove_message(1)), (2, *remove_message(2))])
+
+    run_dispatcher(db, stub, workers=1)
+
+    assert all(row['sent'] for row in db.rows.values())
+    assert db.retries == [(1, 1)]
+    assert '429' in db.rows[1]['errors'][0]
+    assert db.rows[1]['attempts'] == 2
+    calls = [(at, body['chat_id']) for at, method, body in stub.calls if method == 'sendMessage']
+    assert [chat_id for _, chat_id in calls] == [1, 2, 1]
+    # Nothing went out, to any chat, before retry_after had passed
+    flood_at = calls[0][0]
+    assert all(at - flood_at >= 0.9 for at, _ in calls[1:])
+
+
+def test_gives_up_after_max_attempts(stub):
+    stub.fail_next = 10
+    stub.retry_after = 0
+    db = FakeOutboxDB([(1, *remove_message(1))])
+
+    run_dispatcher(db, stub, max_attempts=3)
+
+    row = db.rows[1]
+    assert row['failed'] and not row['sent']
+    assert row['attempts'] == 3
+    assert db.retries == [(1, 0), (1, 0)]
+
+
+def test_unrenderable_message_fails_without_a_request(stub):
+    db = FakeOutboxDB([(1, 'no_such_template', {})])
+
+    run_dispatcher(db, stub)
+
+    assert db.rows[1]['failed']
+    assert 'no_such_template' in db.rows[1]['errors'][0]
+    assert stub.calls == []
@@ -0,0 +1,95 @@
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import pytest
+
+from replicas import ReplicaRouter
+
+
+class FakeReplicaManager:
+    """Answers LAG_QUERY with whatever lag is set, or fails like a lost connection."""
+
+    def __init__(self, lag=0.0):
+        self.lag = lag
+        self.error = None
+
+    @contextmanager
+    def _transaction(self):
+        if self.error:
+            raise self.error
+        yield self
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchone(self):
+        return (self.lag,)
+
+
+@pytest.fixture
+def managers():
+    return {'a': FakeReplicaManager(), 'b': FakeReplicaManager()}
+
+
+@pytest.fixture
+def make_router(managers):
+    routers = []
+
+    def make(names=('a', 'b'), **kwargs):
+        kwargs.setdefault('check_interval', 3600)
+        router = ReplicaRouter([{'host': name, 'port': 5432} for name in names], lambda db_params: managers[db_params['host']], **kwargs)
+        routers.append(router)
+        return router
+
+    yield make
+    for router in routers:
+        router.stop()
+
+
+def chosen(router, keys=()):
+    replica = router.choose(keys)
+    return replica.db_params['host'] if replica else None
+
+
+def test_reads_alternate_between_healthy_replicas(make_router):
+    router = make_router()
+    assert sorted(chosen(router) for _ in range(4)) == ['a', 'a', 'b', 'b']
+
+
+def test_lagging_replica_is_skipped_until_it_catches_up(make_router, managers):
+    managers['a'].lag = 30.0
+    router = make_router(max_lag_seconds=10.0)
+    assert {chosen(router) for _ in range(4)} == {'b'}
+
+    managers['a'].lag = 1.0
+    router.check()
+    assert {chosen(router) for _ in range(4)} == {'a', 'b'}
+
+
+@pytest.mark.parametrize('failure', ['not streaming', 'unreachable'])
+def test_replica_that_lost_the_primary_or_the_connection_is_down(make_router, managers, failure):
+    if failure == 'not streaming':
+        # LAG_QUERY gives NULL when the standby has no WAL receiver
+        managers['a'].lag = None
+    else:
+        managers['a'].error = psycopg2.OperationalError('connection refused')
+    router = make_router(names=('a',))
+
+    assert chosen(router) is None
+    assert router.get_statistics()['replicas'][0]['healthy'] is False
+    assert router.primary_reads == 1
+
+    managers['a'].lag, managers['a'].error = 0.0, None
+    router.check()
+    assert chosen(router) == 'a'
+
+
+def test_written_keys_are_read_from_the_primary_for_a_while(make_router):
+    router = make_router(names=('a',), read_your_writes_seconds=0.2)
+    router.wrote([('phone', 7)])
+
+    assert chosen(router, [('phone', 7)]) is None
+    assert chosen(router, [('phone', 8)]) == 'a'
+    time.sleep(0.25)
+    assert chosen(router, [('phone', 7)]) == 'a'
@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from telegram import Chat, Message, Update, User
+
+from update_processor import PerUserUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, 'Test', False)
+    message = Message(update_id, datetime.now(timezone.utc), Chat(user_id, Chat.PRIVATE), from_user=user, text='x')
+    return Update(update_id, message=message)
+
+
+def test_updates_of_one_user_run_one_at_a_time_in_order():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4)
+        started = []
+        running = 0
+        most_running = 0
+
+        async def handle(index):
+            nonlocal running, most_running
+            started.append(index)
+            running += 1
+            most_running = max(most_running, running)
+            # Later updates would overtake if they were let through
+            await asyncio.sleep(0.01 * (5 - index))
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(make_update(index, 1), handle(index)) for index in range(5)))
+        return started, most_running, processor
+
+    started, most_running, processor = asyncio.run(scenario())
+    assert started == [0, 1, 2, 3, 4]
+    assert most_running == 1
+    assert processor._locks == {}
+    assert processor.processed == 5
+
+
+def test_flooding_user_does_not_hold_slots_others_need():
+    async def scenario():
+        processor = PerUserUpdateProcessor(2)
+        release = asyncio.Event()
+        done = []
+
+        async def flood(index):
+            await release.wait()
+            done.append(('flood', index))
+
+        async def other():
+            done.append(('other', 0))
+
+        flooding = [asyncio.create_task(processor.process_update(make_update(index, 1), flood(index))) for index in range(10)]
+        await asyncio.sleep(0)
+        # Only one of user 1's updates holds a slot; the other one stays free for user 2
+        await asyncio.wait_for(processor.process_update(make_update(100, 2), other()), timeout=1)
+        first = list(done)
+        release.set()
+        await asyncio.gather(*flooding)
+        return first, done
+
+    first, done = asyncio.run(scenario())
+    assert first == [('other', 0)]
+    assert [index for kind, index in done if kind == 'flood'] == list(range(10))
+
+
+def test_slots_bound_concurrency_across_users():
+    async def scenario():
+        processor = PerUserUpdateProcessor(2)
+        release = asyncio.Event()
+
+        async def handle():
+            await release.wait()
+
+        tasks = [asyncio.create_task(processor.process_update(make_update(index, index % 3), handle())) for index in range(6)]
+        await asyncio.sleep(0.01)
+        busy = processor.current_concurrent_updates
+        release.set()
+        await asyncio.gather(*tasks)
+        return busy, processor.current_concurrent_updates, processor.max_concurrent_updates
+
+    busy, idle, maximum = asyncio.run(scenario())
+    assert (busy, idle, maximum) == (2, 0, 2)
+
+
+def test_shed_updates_skip_the_handler():
+    class RejectOdd:
+        def admit(self, update):
+            return 'odd' if update.update_id % 2 else None
+
+    async def scenario():
+        shed = []
+        handled = []
+        processor = PerUserUpdateProcessor(2, admission=RejectOdd(), on_shed=lambda update, reason: shed.append((update.update_id, reason)))
+
+        async def handle(index):
+            handled.append(index)
+
+        await asyncio.gather(*(processor.process_update(make_update(index, 1), handle(index)) for index in range(4)))
+        return handled, shed, processor.current_concurrent_updates
+
+    handled, shed, current = asyncio.run(scenario())
+    assert handled == [0, 2]
+    assert shed == [(1, 'odd'), (3, 'odd')]
+    assert current == 0
+
+
+def test_rejects_non_positive_limits():
+    with pytest.raises(ValueError):
+        PerUserUpdateProcessor(0)
@@ -1,8 +1,107 @@
-import json
-
-def get_translation(lang, key, **kwargs):
-    translations_file_path = '/translations.json'
-    with open(translations_file_path, 'r') as f:
-        translations = json.load(f)
-    # Используем метод format() для вставки переменных в строку перевода
-    return translations[lang][key].format(**kwargs)
\ No newline at end of file
+import json
+import logging
+import os
+import string
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+translations_file_path = '/translations.json'
+
+
+class TranslationCatalog:
+    """In-memory translation catalog.
+
+    The file is parsed once, every template is split into literal text and
+    placeholders up front, and the file is only re-read when its mtime changes
+    (checked at most once per ``check_interval`` seconds).
+    """
+
+    def __init__(self, path=translations_file_path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self._templates = {}
+        self._mtime = None
+        self._next_check = 0.0
+
+    @staticmethod
+    def _compile(template):
+        # Шаблон без плейсхолдеров отдаём как есть, остальные разбираем один раз
+        parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if conversion or spec or (field is not None and not field.isidentifier()):
+                # Сложные поля оставляем на str.format
+                return template.format
+            parts.append((literal, field))
+        if all(field is None for _, field in parts):
+            return ''.join(literal for literal, _ in parts)
+        return tuple(parts)
+
+    @staticmethod
+    def _placeholders(template):
+        return {field for _, field, _, _ in string.Formatter().parse(template) if field}
+
+    def _validate(self, translations):
+        # Every locale must provide the same keys with the same placeholders
+        locales = list(translations)
+        keys = set().union(*(translations[lang].keys() for lang in locales))
+        errors = []
+        for lang in locales:
+            missing = keys - translations[lang].keys()
+            if missing:
+                errors.append(f"{lang}: missing keys {sorted(missing)}")
+        for key in sorted(keys):
+            fields = {lang: self._placeholders(translations[lang][key]) for lang in locales if key in translations[lang]}
+            if len(set(map(frozenset, fields.values()))) > 1:
+                errors.append(f"{key}: placeholders differ between locales {fields}")
+        if errors:
+            raise ValueError(f"Invalid translations file {self.path}:\n" + "\n".join(errors))
+
+    def load(self):
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.path, 'r') as f:
+                translations = json.load(f)
+            self._validate(translations)
+            self._templates = {
+                lang: {key: self._compile(value) for key, value in entries.items()}
+                for lang, entries in translations.items()
+            }
+            self._mtime = mtime
+
+    def reload_if_changed(self):
+        if self._mtime is None:
+            self.load()
+            return
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            if os.stat(self.path).st_mtime_ns != self._mtime:
+                self.load()
+        except (OSError, ValueError) as e:
+            # Keep serving the last good catalog if the new file is broken
+            logger.error(f"Failed to reload translations: {e}")
+
+    def get(self, lang, key, **kwargs):
+        self.reload_if_changed()
+        template = self._templates[lang][key]
+        if isinstance(template, str):
+            return template
+        if isinstance(template, tuple):
+            return ''.join(literal if field is None else literal + format(kwargs[field]) for literal, field in template)
+        # Шаблон со сложными полями
+        return template(**kwargs)
+
+
+catalog = TranslationCatalog()
+
+
+def get_translation(lang, key, **kwargs):
+    # Используем предкомпилированный шаблон вместо чтения файла на каждый вызов
+    return catalog.get(lang, key, **kwargs)
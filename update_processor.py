@@ -0,0 +1,106 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Size of BaseUpdateProcessor's own semaphore, see PerUserUpdateProcessor
+_UNBOUNDED = 2 ** 31
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to max_concurrent_updates updates at once, but never two
+    from the same user: the send flow keeps its state in user_data and
+    expects phone, amount and comment to be handled in the order they were
+    typed.
+
+    Updates of one user wait on that user's lock in arrival order (asyncio
+    locks are FIFO) and only then take one of the max_concurrent_updates
+    slots, so a user flooding the bot queues behind themselves without
+    holding slots everyone else needs. BaseUpdateProcessor takes its own
+    semaphore before do_process_update, ahead of the user's lock, so it is
+    created unbounded and the slots live here instead.
+
+    With an admission.AdmissionControl, every update is checked once it gets
+    a slot; shed updates never reach the handlers and are passed to
+    on_shed(update, reason) instead.
+    """
+
+    def __init__(self, max_concurrent_updates: int, on_processed=None, admission=None, on_shed=None):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(_UNBOUNDED)
+        self._slot_count = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # Updates holding one of _slots right now
+        self._running = 0
+        self.admission = admission
+        self.on_shed = on_shed
+        # user_id -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+        # Called after every update, e.g. to feed a sharded worker's statistics
+        self.on_processed = on_processed
+        self.processed = 0
+
+    @property
+    def max_concurrent_updates(self):
+        # BaseUpdateProcessor.__init__ sizes its semaphore from this before _slot_count is set
+        return getattr(self, '_slot_count', _UNBOUNDED)
+
+    @property
+    def current_concurrent_updates(self):
+        # The base class counts its own unbounded semaphore, which updates waiting on their user also hold
+        return self._running
+
+    @staticmethod
+    def key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            self.processed += 1
+            if self.on_processed:
+                self.on_processed()
+
+    async def _process_in_order(self, update, coroutine):
+        key = self.key(update)
+        if key is None:
+            await self._process(update, coroutine)
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._process(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _process(self, update, coroutine):
+        async with self._slots:
+            self._running += 1
+            try:
+                reason = self.admission.admit(update) if self.admission else None
+                if reason:
+                    # Application.process_update never runs for this update
+                    coroutine.close()
+                    if self.on_shed:
+                        self.on_shed(update, reason)
+                    return
+                await coroutine
+            finally:
+                self._running -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,91 @@
+import contextlib
+import hmac
+import json
+import logging
+import signal
+
+import uvicorn
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookReceiver:
+    """
+    Minimal ASGI endpoint for Telegram webhooks.
+
+    Checks the secret token Telegram echoes back in every request, decodes
+    the body into an Update and hands it to put_update: the application's
+    update_queue.put, where it is processed exactly like a polled update, or
+    the sharded dispatcher. Anything that can POST JSON with the right header
+    can feed it, which is how recorded updates are replayed locally.
+    """
+
+    def __init__(self, bot: Bot, put_update, secret_token: str, url_path='/telegram', max_body_size=1024 * 1024):
+        self.bot = bot
+        self.put_update = put_update
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self.received = 0
+        self.rejected = 0
+        self.app = Starlette(routes=[Route(url_path, self.receive, methods=['POST'])])
+
+    async def receive(self, request: Request):
+        token = request.headers.get(SECRET_TOKEN_HEADER, '')
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            self.rejected += 1
+            return PlainTextResponse('Forbidden', status_code=403)
+
+        body = await self._read_body(request)
+        if body is None:
+            self.rejected += 1
+            return PlainTextResponse('Payload too large', status_code=413)
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Malformed webhook update: {e}")
+            self.rejected += 1
+            return PlainTextResponse('Bad request', status_code=400)
+
+        # Answer right away; processing happens on the application's own tasks
+        await self.put_update(update)
+        self.received += 1
+        return PlainTextResponse('OK')
+
+    async def _read_body(self, request: Request):
+        """The request body, or None as soon as it is known to exceed max_body_size."""
+        # A declared length is enough to refuse without reading anything
+        try:
+            if int(request.headers.get('content-length', 0)) > self.max_body_size:
+                return None
+        except ValueError:
+            pass
+        # Chunked or lying clients are cut off while reading, not after buffering it all
+        chunks = []
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > self.max_body_size:
+                return None
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class WebhookServer(uvicorn.Server):
+    # uvicorn re-raises SIGTERM/SIGINT once it has stopped, which would kill
+    # the process before the bot's own shutdown (and admin digest flush) runs
+    @contextlib.contextmanager
+    def capture_signals(self):
+        original_handlers = {sig: signal.signal(sig, self.handle_exit) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            yield
+        finally:
+            for sig, handler in original_handlers.items():
+                signal.signal(sig, handler)